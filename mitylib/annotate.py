@@ -0,0 +1,779 @@
+"""
+Annotates mity variants in memory from the sources of a vcfanno config.
+"""
+
+import hashlib
+import json
+import logging
+import mmap
+import os
+import sqlite3
+import struct
+import time
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import pysam
+
+from mitylib.util import MityUtil
+
+try:
+    import tomllib
+except ModuleNotFoundError:  # Python < 3.11
+    import tomli as tomllib
+
+logger = logging.getLogger(__name__)
+
+
+class Annotator:
+    """
+    A native replacement for vcfanno in mity report.
+
+    The [[annotation]] sources of a vcfanno config are read once into memory.
+    Only the 'self' op is supported:
+        - VCF sources with 'fields' are joined to variants by (contig, pos,
+          ref, alt), and the value of Number=A and Number=R fields for the
+          matching alt is used
+        - BED sources with 'columns' are joined to variants by overlap with the
+          reference allele
+    If several source records match a variant, their values are joined with
+    commas, as vcfanno does.
+    """
+
+    def __init__(self, config_path: str, base_path: Optional[str] = None):
+        self.config_path = config_path
+        self.base_path = base_path
+
+        # per source: (names, {(contig, pos, ref, alt): [values, ...]})
+        self.vcf_sources: List[Tuple[List[str], Dict[Tuple[str, int, str, str], list]]] = []
+        # per source: (names, {contig: (starts, ends, rows)})
+        self.bed_sources: List[Tuple[List[str], Dict[str, Tuple[Any, Any, list]]]] = []
+        # the annotation names, in the order of the config
+        self.names: List[str] = []
+        # the paths of the annotation sources
+        self.sources: List[str] = []
+
+        self.load_config()
+
+    def load_config(self):
+        """
+        Read the vcfanno config and load every annotation source.
+        """
+        with open(self.config_path, "rb") as config_file:
+            config = tomllib.load(config_file)
+
+        unsupported = set(config) - {"annotation"}
+        if unsupported:
+            raise ValueError(
+                f"{self.config_path} has {', '.join(sorted(unsupported))} sections, which "
+                "the native annotator does not support. Use --annotator vcfanno"
+            )
+
+        for annotation in config.get("annotation", []):
+            ops = annotation.get("ops", [])
+            if any(op != "self" for op in ops):
+                raise ValueError(
+                    f"The native annotator only supports the 'self' op, not {ops} in "
+                    f"{self.config_path}. Use --annotator vcfanno"
+                )
+
+            path = annotation["file"]
+            if self.base_path is not None and not os.path.isabs(path):
+                path = os.path.join(self.base_path, path)
+
+            names = annotation["names"]
+            if "fields" in annotation:
+                self.vcf_sources.append((names, self.load_vcf(path, annotation["fields"])))
+            elif "columns" in annotation:
+                self.bed_sources.append((names, self.load_bed(path, annotation["columns"])))
+            else:
+                raise ValueError(f"The annotation of {path} has no fields or columns")
+            self.names.extend(names)
+            self.sources.append(path)
+
+        logger.debug(
+            "Loaded %s VCF and %s BED annotation sources",
+            len(self.vcf_sources),
+            len(self.bed_sources),
+        )
+
+    def load_vcf(self, path: str, fields: List[str]) -> Dict[Tuple[str, int, str, str], list]:
+        """
+        Read the fields of each alt of a VCF source.
+
+        Returns:
+            - dict: A list of the field values, or None for missing fields, of
+              each (contig, pos, ref, alt).
+        """
+        records: Dict[Tuple[str, int, str, str], list] = {}
+
+        with pysam.VariantFile(path) as vcf:
+            numbers = {
+                field: vcf.header.info[field].number if field in vcf.header.info else None
+                for field in fields
+            }
+            for variant in vcf:
+                for i, alt in enumerate(variant.alts or ()):
+                    values = []
+                    for field in fields:
+                        value = None
+                        if numbers[field] is not None:
+                            value = variant.info.get(field)
+                        if isinstance(value, tuple) and numbers[field] in ("A", "R"):
+                            index = i if numbers[field] == "A" else i + 1
+                            # some sources have fewer values than alts
+                            value = value[index] if index < len(value) else None
+                        values.append(value)
+                    records.setdefault((variant.chrom, variant.pos, variant.ref, alt), []).append(
+                        values
+                    )
+
+        return records
+
+    def load_bed(self, path: str, columns: List[int]) -> Dict[str, Tuple[Any, Any, list]]:
+        """
+        Read the columns of a BED source, which are numbered from 1.
+
+        Returns:
+            - dict: The start and end arrays, and the column values of each row,
+              by contig.
+        """
+        rows: Dict[str, list] = {}
+
+        with pysam.TabixFile(path, parser=pysam.asTuple()) as bed:
+            for contig in bed.contigs:
+                for row in bed.fetch(contig):
+                    rows.setdefault(contig, []).append(
+                        (int(row[1]), int(row[2]), [row[column - 1] for column in columns])
+                    )
+
+        return {
+            contig: (
+                np.array([row[0] for row in contig_rows], dtype=np.int64),
+                np.array([row[1] for row in contig_rows], dtype=np.int64),
+                [row[2] for row in contig_rows],
+            )
+            for contig, contig_rows in rows.items()
+        }
+
+    @staticmethod
+    def join_values(values: list) -> Any:
+        """
+        Join the values of several matching source records with commas.
+        """
+        values = [value for value in values if value is not None]
+        if not values:
+            return None
+        if len(values) == 1:
+            return values[0]
+        return ",".join(
+            ",".join(map(str, value)) if isinstance(value, tuple) else str(value)
+            for value in values
+        )
+
+    def annotate(self, variant: pysam.VariantRecord) -> Dict[str, Any]:
+        """
+        Returns the annotations of the first alt of a variant, by name.
+        Annotations without a value are left out, as vcfanno leaves them out of
+        INFO.
+        """
+        annotations = {}
+        alt = variant.alts[0] if variant.alts else None
+
+        for names, records in self.vcf_sources:
+            matches = records.get((variant.chrom, variant.pos, variant.ref, alt), [])
+            for i, name in enumerate(names):
+                value = self.join_values([values[i] for values in matches])
+                if value is not None:
+                    annotations[name] = value
+
+        for names, contigs in self.bed_sources:
+            if variant.chrom not in contigs:
+                continue
+            starts, ends, rows = contigs[variant.chrom]
+            # BED rows are 0-based and half open
+            overlaps = np.flatnonzero((starts < variant.stop) & (ends > variant.start))
+            for i, name in enumerate(names):
+                value = self.join_values([rows[row][i] for row in overlaps])
+                if value is not None:
+                    annotations[name] = value
+
+        return annotations
+
+
+class AnnotationBundle:
+    """
+    The annotation sources of a vcfanno config, compiled into one position
+    indexed file that is read with mmap.
+
+    The file is MAGIC, the length of a JSON metadata block and the metadata,
+    followed by the arrays listed in the metadata. For each contig:
+        - vcf_offsets: the VCF rows at 1-based position pos are
+          vcf_offsets[pos]:vcf_offsets[pos + 1]
+        - vcf_alleles: the ref and alt of each VCF row
+        - vcf_values: the joined value of each VCF annotation name, per row
+        - bed_offsets and bed_rows: the BED rows that cover 0-based position
+          pos are bed_rows[bed_offsets[pos]:bed_offsets[pos + 1]]
+    and bed_values, the value of each BED annotation name per BED row. Every
+    allele and value is the index of a JSON encoded string in a string pool,
+    or -1 for no value. Annotating a variant only reads the rows at its
+    positions.
+
+    The metadata records the checksum of the config and of every source, and
+    load() compiles the bundle again when any of them changes.
+    """
+
+    MAGIC = b"MITYANN1"
+    VERSION = 1
+    # the bytes before the metadata: MAGIC and the metadata length
+    PREFIX_SIZE = 16
+
+    def __init__(self, bundle_path: str):
+        self.bundle_path = bundle_path
+
+        with open(bundle_path, "rb") as bundle_file:
+            self.buffer = mmap.mmap(bundle_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.metadata = self.read_metadata(self.buffer)
+
+        data_start = self.get_data_start(self.metadata_size)
+        self.arrays = {
+            name: np.frombuffer(
+                self.buffer,
+                dtype=np.dtype(dtype),
+                count=int(np.prod(shape)),
+                offset=data_start + offset,
+            ).reshape(shape)
+            for name, (offset, dtype, shape) in self.metadata["arrays"].items()
+        }
+
+        self.names: List[str] = self.metadata["names"]
+        self.sources: List[str] = [source["path"] for source in self.metadata["sources"]]
+        self.vcf_names: List[str] = self.metadata["vcf_names"]
+        self.bed_names: List[str] = self.metadata["bed_names"]
+        self.contigs = set(self.metadata["contigs"])
+
+    @property
+    def metadata_size(self) -> int:
+        """
+        The size of the metadata block, in bytes.
+        """
+        return struct.unpack_from("<Q", self.buffer, len(self.MAGIC))[0]
+
+    @classmethod
+    def get_data_start(cls, metadata_size: int) -> int:
+        """
+        Returns the offset of the arrays, which start on an 8 byte boundary
+        after the metadata.
+        """
+        return -(-(cls.PREFIX_SIZE + metadata_size) // 8) * 8
+
+    @classmethod
+    def read_metadata(cls, bundle_file: Union[BinaryIO, mmap.mmap]) -> Dict[str, Any]:
+        """
+        Reads the metadata of a bundle.
+
+        Parameters:
+            - bundle_file: An open bundle, at its start.
+
+        Returns:
+            - dict: The metadata.
+        """
+        prefix = bundle_file.read(cls.PREFIX_SIZE)
+        if len(prefix) != cls.PREFIX_SIZE or prefix[: len(cls.MAGIC)] != cls.MAGIC:
+            raise ValueError(f"{getattr(bundle_file, 'name', 'The file')} is not a mity bundle")
+        (metadata_size,) = struct.unpack_from("<Q", prefix, len(cls.MAGIC))
+        return json.loads(bundle_file.read(metadata_size))
+
+    @staticmethod
+    def get_default_path(config_path: str, base_path: Optional[str] = None) -> str:
+        """
+        Returns the path of the bundle of a vcfanno config in the mity cache
+        directory, which is keyed by the paths of the config and base path.
+        """
+        key = f"{os.path.abspath(config_path)}:{os.path.abspath(base_path or '')}"
+        return os.path.join(
+            MityUtil.get_cache_dir(),
+            "annotations",
+            os.path.splitext(os.path.basename(config_path))[0]
+            + "."
+            + hashlib.sha1(key.encode("utf-8")).hexdigest()
+            + ".bundle",
+        )
+
+    @classmethod
+    def is_current(
+        cls, bundle_path: str, config_path: str, base_path: Optional[str] = None
+    ) -> bool:
+        """
+        Checks that a bundle exists and was compiled from the current contents
+        of a vcfanno config and its sources.
+        """
+        if not os.path.exists(bundle_path):
+            return False
+
+        try:
+            with open(bundle_path, "rb") as bundle_file:
+                metadata = cls.read_metadata(bundle_file)
+        except (ValueError, struct.error):
+            return False
+
+        if metadata.get("version") != cls.VERSION:
+            return False
+        if metadata["base_path"] != (os.path.abspath(base_path) if base_path else None):
+            return False
+        for source in [metadata["config"]] + metadata["sources"]:
+            if not os.path.exists(source["path"]):
+                return False
+            if MityUtil.get_file_checksum(source["path"]) != source["sha256"]:
+                logger.debug("%s has changed since the bundle was compiled", source["path"])
+                return False
+        return True
+
+    @classmethod
+    def load(
+        cls,
+        config_path: str,
+        base_path: Optional[str] = None,
+        bundle_path: Optional[str] = None,
+    ) -> Union["AnnotationBundle", Annotator]:
+        """
+        Loads the bundle of a vcfanno config, and compiles it first if it is
+        missing or out of date. If the bundle cannot be written the sources are
+        annotated from memory instead.
+
+        Parameters:
+            - config_path (str): The vcfanno config.
+            - base_path (str, optional): The base path of the annotation sources.
+            - bundle_path (str, optional): The bundle. Default: a bundle in the
+              mity cache directory.
+
+        Returns:
+            - AnnotationBundle or Annotator: The annotator.
+        """
+        if bundle_path is None:
+            bundle_path = cls.get_default_path(config_path, base_path)
+
+        if cls.is_current(bundle_path, config_path, base_path):
+            logger.debug("Using the annotation bundle %s", bundle_path)
+            return cls(bundle_path)
+
+        logger.info("Compiling the annotation bundle %s", bundle_path)
+        annotator = Annotator(config_path, base_path)
+        try:
+            cls.compile(annotator, bundle_path)
+        except OSError as error:
+            logger.warning(
+                "Could not write the annotation bundle %s (%s), annotating from the sources",
+                bundle_path,
+                error,
+            )
+            return annotator
+        return cls(bundle_path)
+
+    @classmethod
+    def compile(cls, annotator: Annotator, bundle_path: str) -> None:
+        """
+        Writes the annotation sources loaded by an Annotator to a bundle.
+
+        Parameters:
+            - annotator (Annotator): The annotation sources.
+            - bundle_path (str): The bundle to write.
+        """
+        strings: Dict[str, int] = {}
+
+        def add_value(value: Any) -> int:
+            if value is None:
+                return -1
+            return strings.setdefault(json.dumps(value), len(strings))
+
+        vcf_names = [name for names, _ in annotator.vcf_sources for name in names]
+        bed_names = [name for names, _ in annotator.bed_sources for name in names]
+
+        # VCF rows: the values are joined at compile time, as they are keyed by
+        # (contig, pos, ref, alt)
+        keys = sorted(set().union(*(records for _, records in annotator.vcf_sources)))
+        key_rows = {key: row for row, key in enumerate(keys)}
+        vcf_values = np.full((len(keys), len(vcf_names)), -1, dtype=np.int32)
+        column = 0
+        for names, records in annotator.vcf_sources:
+            for key, matches in records.items():
+                for i in range(len(names)):
+                    vcf_values[key_rows[key], column + i] = add_value(
+                        annotator.join_values([match[i] for match in matches])
+                    )
+            column += len(names)
+        vcf_rows: Dict[str, List[int]] = {}
+        for row, key in enumerate(keys):
+            vcf_rows.setdefault(key[0], []).append(row)
+
+        # BED rows: the values are joined when annotating, as a variant may
+        # cover several positions
+        bed_values: List[List[int]] = []
+        bed_rows: Dict[str, List[Tuple[int, int, int]]] = {}
+        column = 0
+        for names, contigs in annotator.bed_sources:
+            for contig, (starts, ends, rows) in contigs.items():
+                for start, end, row in zip(starts, ends, rows):
+                    values = [-1] * len(bed_names)
+                    for i, value in enumerate(row):
+                        values[column + i] = add_value(value)
+                    bed_rows.setdefault(contig, []).append((int(start), int(end), len(bed_values)))
+                    bed_values.append(values)
+            column += len(names)
+
+        arrays: Dict[str, Any] = {}
+        contigs = sorted(set(vcf_rows) | set(bed_rows))
+        for contig in contigs:
+            # the keys are sorted, so the rows of a contig are sorted by position
+            rows = vcf_rows.get(contig, [])
+            positions = np.array([keys[row][1] for row in rows], dtype=np.int64)
+            length = int(positions.max()) + 2 if rows else 1
+            arrays[f"{contig}/vcf_offsets"] = np.searchsorted(
+                positions, np.arange(length), side="left"
+            ).astype(np.int32)
+            arrays[f"{contig}/vcf_alleles"] = np.array(
+                [[add_value(keys[row][2]), add_value(keys[row][3])] for row in rows],
+                dtype=np.int32,
+            ).reshape(len(rows), 2)
+            arrays[f"{contig}/vcf_values"] = vcf_values[rows]
+
+            rows = bed_rows.get(contig, [])
+            length = max((end for _, end, _ in rows), default=0)
+            covered = [[] for _ in range(length)]
+            for start, end, row in rows:
+                for pos in range(max(start, 0), end):
+                    covered[pos].append(row)
+            arrays[f"{contig}/bed_offsets"] = np.concatenate(
+                [[0], np.cumsum([len(pos_rows) for pos_rows in covered], dtype=np.int64)]
+            ).astype(np.int32)
+            arrays[f"{contig}/bed_rows"] = np.array(
+                [row for pos_rows in covered for row in pos_rows], dtype=np.int32
+            )
+
+        arrays["bed_values"] = np.array(bed_values, dtype=np.int32).reshape(
+            len(bed_values), len(bed_names)
+        )
+        encoded = [string.encode("utf-8") for string in strings]
+        arrays["string_offsets"] = np.concatenate(
+            [[0], np.cumsum([len(string) for string in encoded], dtype=np.int64)]
+        ).astype(np.int64)
+        arrays["string_data"] = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+        # the offset of each array after the start of the arrays
+        layout = {}
+        offset = 0
+        for name, array in arrays.items():
+            layout[name] = [offset, array.dtype.str, list(array.shape)]
+            offset += -(-array.nbytes // 8) * 8
+
+        metadata = {
+            "version": cls.VERSION,
+            "config": {
+                "path": os.path.abspath(annotator.config_path),
+                "sha256": MityUtil.get_file_checksum(annotator.config_path),
+            },
+            "base_path": os.path.abspath(annotator.base_path) if annotator.base_path else None,
+            "sources": [
+                {"path": os.path.abspath(path), "sha256": MityUtil.get_file_checksum(path)}
+                for path in annotator.sources
+            ],
+            "names": annotator.names,
+            "vcf_names": vcf_names,
+            "bed_names": bed_names,
+            "contigs": contigs,
+            "arrays": layout,
+        }
+        metadata_bytes = json.dumps(metadata).encode("utf-8")
+
+        bundle_dir = os.path.dirname(bundle_path)
+        if bundle_dir:
+            os.makedirs(bundle_dir, exist_ok=True)
+        tmp_path = f"{bundle_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as bundle_file:
+            bundle_file.write(cls.MAGIC + struct.pack("<Q", len(metadata_bytes)))
+            bundle_file.write(metadata_bytes)
+            padding = cls.get_data_start(len(metadata_bytes)) - bundle_file.tell()
+            bundle_file.write(b"\0" * padding)
+            for array in arrays.values():
+                data = np.ascontiguousarray(array).tobytes()
+                bundle_file.write(data + b"\0" * (-len(data) % 8))
+        os.replace(tmp_path, bundle_path)
+
+    def get_value(self, index: int) -> Any:
+        """
+        Returns a value of the string pool, or None for -1.
+        """
+        if index < 0:
+            return None
+        offsets = self.arrays["string_offsets"]
+        data = self.arrays["string_data"][offsets[index] : offsets[index + 1]]
+        value = json.loads(data.tobytes())
+        return tuple(value) if isinstance(value, list) else value
+
+    def annotate(self, variant: pysam.VariantRecord) -> Dict[str, Any]:
+        """
+        Returns the annotations of the first alt of a variant, by name, as
+        Annotator.annotate does.
+        """
+        annotations = {}
+        if variant.chrom not in self.contigs:
+            return annotations
+        alt = variant.alts[0] if variant.alts else None
+
+        offsets = self.arrays[f"{variant.chrom}/vcf_offsets"]
+        if variant.pos + 1 < len(offsets):
+            alleles = self.arrays[f"{variant.chrom}/vcf_alleles"]
+            values = self.arrays[f"{variant.chrom}/vcf_values"]
+            for row in range(offsets[variant.pos], offsets[variant.pos + 1]):
+                if (
+                    self.get_value(alleles[row, 0]) == variant.ref
+                    and self.get_value(alleles[row, 1]) == alt
+                ):
+                    for name, index in zip(self.vcf_names, values[row]):
+                        value = self.get_value(index)
+                        if value is not None:
+                            annotations[name] = value
+                    break
+
+        offsets = self.arrays[f"{variant.chrom}/bed_offsets"]
+        start = max(variant.start, 0)
+        stop = min(variant.stop, len(offsets) - 1)
+        if start < stop:
+            bed_rows = self.arrays[f"{variant.chrom}/bed_rows"]
+            rows = np.unique(bed_rows[offsets[start] : offsets[stop]])
+            values = self.arrays["bed_values"]
+            for i, name in enumerate(self.bed_names):
+                value = Annotator.join_values([self.get_value(index) for index in values[rows, i]])
+                if value is not None:
+                    annotations[name] = value
+
+        return annotations
+
+
+class AnnotationCache:
+    """
+    A persistent SQLite cache of the annotations of variants, shared by every
+    mity report run.
+
+    Annotations are keyed by (contig, pos, ref, alt) and by a hash of the
+    vcfanno config, its sources and the report config, so a change to any of
+    them starts a new set of entries. Variants found in the cache are not
+    annotated again, and the annotations of the other variants are written to
+    the cache in one transaction when the cache is closed. The cache then
+    evicts its least recently used variants beyond max_variants. It can be
+    used as a context manager, which closes it.
+    """
+
+    DEFAULT_MAX_VARIANTS = 1_000_000
+
+    def __init__(
+        self,
+        annotator: Union[Annotator, AnnotationBundle],
+        cache_path: str,
+        config_key: str,
+        max_variants: int = DEFAULT_MAX_VARIANTS,
+    ):
+        self.annotator = annotator
+        self.cache_path = cache_path
+        self.config_key = config_key
+        self.max_variants = max_variants
+
+        self.names = annotator.names
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        # the encoded annotations of the misses, by key
+        self.pending: Dict[Tuple[str, int, str, str], str] = {}
+        # the keys of the hits
+        self.used: set = set()
+
+        cache_dir = os.path.dirname(cache_path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.connection: Optional[sqlite3.Connection] = sqlite3.connect(cache_path, timeout=60)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS annotations ("
+                "config TEXT NOT NULL, contig TEXT NOT NULL, pos INTEGER NOT NULL, "
+                "ref TEXT NOT NULL, alt TEXT NOT NULL, annotations TEXT NOT NULL, "
+                "used REAL NOT NULL, PRIMARY KEY (config, contig, pos, ref, alt))"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS annotations_used ON annotations (used)"
+            )
+
+    def __enter__(self) -> "AnnotationCache":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    @staticmethod
+    def get_default_path() -> str:
+        """
+        Returns the path of the annotation cache in the mity cache directory.
+        """
+        return os.path.join(MityUtil.get_cache_dir(), "annotations.sqlite")
+
+    @staticmethod
+    def get_config_key(paths: List[str]) -> str:
+        """
+        Returns a hash of the contents of the files that the annotations of a
+        variant depend on.
+
+        Parameters:
+            - paths (list): The vcfanno config, its sources and the report
+              config.
+        """
+        checksums = ":".join(MityUtil.get_file_checksum(path) for path in paths)
+        return hashlib.sha256(checksums.encode("utf-8")).hexdigest()
+
+    def annotate(self, variant: pysam.VariantRecord) -> Dict[str, Any]:
+        """
+        Returns the annotations of the first alt of a variant, by name, from
+        the cache or from the annotator.
+        """
+        if not variant.alts:
+            return self.annotator.annotate(variant)
+
+        key = (variant.chrom, variant.pos, variant.ref, variant.alts[0])
+        encoded = self.pending.get(key)
+        if encoded is None:
+            row = self.connection.execute(
+                "SELECT annotations FROM annotations "
+                "WHERE config = ? AND contig = ? AND pos = ? AND ref = ? AND alt = ?",
+                (self.config_key,) + key,
+            ).fetchone()
+            if row is not None:
+                encoded = row[0]
+                self.used.add(key)
+
+        if encoded is None:
+            self.misses += 1
+            annotations = self.annotator.annotate(variant)
+            self.pending[key] = json.dumps(annotations)
+            return annotations
+
+        self.hits += 1
+        return {
+            name: tuple(value) if isinstance(value, list) else value
+            for name, value in json.loads(encoded).items()
+        }
+
+    def close(self) -> None:
+        """
+        Writes the annotations of the misses, marks the hits as used, and
+        evicts the least recently used variants beyond max_variants. Closing a
+        closed cache does nothing.
+        """
+        if self.connection is None:
+            return
+
+        used = time.time()
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO annotations VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (self.config_key,) + key + (encoded, used)
+                    for key, encoded in self.pending.items()
+                ],
+            )
+            self.connection.executemany(
+                "UPDATE annotations SET used = ? "
+                "WHERE config = ? AND contig = ? AND pos = ? AND ref = ? AND alt = ?",
+                [(used, self.config_key) + key for key in self.used],
+            )
+            (num_variants,) = self.connection.execute("SELECT COUNT(*) FROM annotations").fetchone()
+            if num_variants > self.max_variants:
+                self.evicted = self.connection.execute(
+                    "DELETE FROM annotations WHERE rowid IN "
+                    "(SELECT rowid FROM annotations ORDER BY used LIMIT ?)",
+                    (num_variants - self.max_variants,),
+                ).rowcount
+        self.connection.close()
+        self.connection = None
+        self.pending = {}
+        self.used = set()
+
+
+class AnnotationLookup:
+    """
+    The annotations of a set of variants, annotated once and looked up by
+    (contig, pos, ref, alts), e.g. the distinct variants of every vcf of a
+    mity report.
+
+    info_records holds the INFO header line of each name, e.g. as vcfanno
+    wrote it, so an annotated vcf can declare the annotations the same way.
+    """
+
+    def __init__(
+        self,
+        names: List[str],
+        annotations: Dict[Tuple[str, int, str, Tuple[str, ...]], Dict[str, Any]],
+        info_records: Optional[Dict[str, str]] = None,
+    ):
+        self.names = names
+        self.annotations = annotations
+        self.info_records = info_records or {}
+
+    @staticmethod
+    def get_key(variant: pysam.VariantRecord) -> Tuple[str, int, str, Tuple[str, ...]]:
+        """
+        Returns the key of a variant.
+        """
+        return (variant.chrom, variant.pos, variant.ref, tuple(variant.alts or ()))
+
+    def annotate(self, variant: pysam.VariantRecord) -> Dict[str, Any]:
+        """
+        Returns the annotations of a variant, by name.
+        """
+        return self.annotations.get(self.get_key(variant), {})
+
+
+class CompileAnnotations:
+    """
+    Mity annotations compile.
+
+    Compiles the annotation sources of a vcfanno config into an annotation
+    bundle, which the native annotator of mity report loads with mmap instead
+    of reading the sources.
+    """
+
+    def __init__(
+        self,
+        debug,
+        contig="MT",
+        vcfanno_config=None,
+        vcfanno_base_path=None,
+        bundle=None,
+    ):
+        self.debug = debug
+        self.contig = contig
+        self.vcfanno_config = vcfanno_config
+        self.vcfanno_base_path = vcfanno_base_path
+        self.bundle = bundle
+
+        self.run()
+
+    def run(self):
+        """
+        Run mity annotations compile.
+        """
+        if self.debug:
+            logger.setLevel(logging.DEBUG)
+            logger.debug("Entered debug mode.")
+        else:
+            logger.setLevel(logging.INFO)
+
+        self.vcfanno_config, self.vcfanno_base_path = MityUtil.select_vcfanno_config(
+            self.contig, self.vcfanno_config, self.vcfanno_base_path
+        )
+        if self.bundle is None:
+            self.bundle = AnnotationBundle.get_default_path(
+                self.vcfanno_config, self.vcfanno_base_path
+            )
+
+        AnnotationBundle.compile(
+            Annotator(self.vcfanno_config, self.vcfanno_base_path), self.bundle
+        )
+        logger.info("Wrote the annotation bundle to %s", self.bundle)
@@ -2,14 +2,22 @@
 
 import subprocess
 import logging
+import os
 import os.path
+import shlex
 import sys
-from typing import Any, Optional, Tuple
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Optional, Tuple
 import urllib.request
 
 import pysam
+import pysam.bcftools
 
+from mitylib.extract import Extract
 from mitylib.normalise import Normalise
+from mitylib.pileup import PILEUP_SUFFIX, PileupCaller
 from mitylib.util import MityUtil
 
 logger = logging.getLogger(__name__)
@@ -25,6 +33,12 @@ class Call:
     MIN_AF = 0.01
     MIN_AC = 4
     P_VAL = 0.002
+    TILE_OVERLAP = 500
+    # INFO fields that are summed (or averaged) when combining batches of samples
+    BATCH_INFO_RULES = (
+        "NS:sum,DP:sum,DPB:sum,RO:sum,AO:sum,QR:sum,QA:sum,"
+        "SRF:sum,SRR:sum,SAF:sum,SAR:sum,MQM:avg,MQMR:avg"
+    )
 
     def __init__(
         self,
@@ -43,6 +57,13 @@ class Call:
         region=None,
         bam_list=False,
         keep=False,
+        threads=1,
+        batch_size=None,
+        cache_dir=None,
+        engine="freebayes",
+        stream=False,
+        blacklist=None,
+        output_type="vcf",
     ):
         self.debug = debug
         self.files = files[0]
@@ -59,12 +80,23 @@ class Call:
         self.region = region
         self.bam_list = bam_list
         self.keep = keep
+        self.threads = threads
+        self.batch_size = batch_size
+        self.cache_dir = cache_dir
+        self.engine = engine
+        self.stream = stream
+        self.blacklist = blacklist
+        self.output_type = output_type
+
+        self.input_files = []
+        self.bam_summaries = {}
 
         self.file_string = ""
         self.normalised_vcf_path = ""
         self.call_vcf_path = ""
 
         self.mity_cmd = ""
+        self.mity_cmd_line = ""
         self.sed_cmd = ""
 
         self.run()
@@ -82,18 +114,47 @@ class Call:
 
         if self.bam_list:
             self.get_files_from_list()
+        self.input_files = self.files
+        if self.cache_dir is not None:
+            self.extract_files()
+        if any(file_name.endswith(PILEUP_SUFFIX) for file_name in self.files):
+            self.load_pileup_summaries()
         self.run_checks()
         self.set_strings()
         self.set_region()
         self.set_mity_cmd()
 
-        self.run_freebayes()
+        if self.stream:
+            self.run_streaming()
+            return
+
+        if self.engine == "pileup":
+            self.run_pileup()
+        elif self.batch_size is not None and len(self.files) > self.batch_size:
+            self.run_freebayes_batched()
+        elif self.threads > 1:
+            self.run_freebayes_tiled()
+        else:
+            self.run_freebayes()
+
+        if self.output_type == "bcf":
+            self.convert_to_bcf()
 
         if self.normalise:
             self.run_normalise()
-        else:
+        elif self.output_type == "vcf":
             MityUtil.tabix(self.call_vcf_path)
 
+    def convert_to_bcf(self):
+        """
+        Converts the bgzipped vcf from freebayes or the pileup engine to a CSI
+        indexed bcf, which mity normalise reads much faster than vcf text.
+        """
+        bcf_path = self.call_vcf_path.replace(".vcf.gz", MityUtil.OUTPUT_TYPES["bcf"])
+        MityUtil.convert_to_bcf(self.call_vcf_path, bcf_path)
+        os.remove(self.call_vcf_path)
+        self.call_vcf_path = bcf_path
+
     def run_normalise(self):
         """
         Run mity normalise.
@@ -111,29 +172,71 @@ class Call:
                 p=self.p,
                 genome=self.genome,
                 keep=self.keep,
+                threads=self.threads,
+                blacklist=self.blacklist,
+                output_type=self.output_type,
             )
         finally:
             if not self.keep:
                 os.remove(self.call_vcf_path)
+                if os.path.exists(self.call_vcf_path + ".csi"):
+                    os.remove(self.call_vcf_path + ".csi")
 
-    def run_freebayes(self):
+    def make_freebayes_call(
+        self,
+        region: str,
+        output_path: str,
+        files: Optional[List[str]] = None,
+        variant_input: Optional[str] = None,
+    ) -> str:
         """
-        Run freebayes.
+        Make the freebayes command for a region, writing a bgzipped vcf to
+        output_path.
+
+        Keyword Arguments:
+            - files (list): Call only these BAM / CRAM files instead of all files.
+            - variant_input (str): Only genotype the alleles in this vcf.
+        """
+        return (
+            f"set -o pipefail && {self.make_freebayes_args(region, files, variant_input)} "
+            f"| sed 's/##source/##freebayesSource/' "
+            f"| sed 's/##commandline/##freebayesCommandline/' "
+            f"| {self.sed_cmd} | bgzip > {output_path}"
+        )
+
+    def make_freebayes_args(
+        self,
+        region: str,
+        files: Optional[List[str]] = None,
+        variant_input: Optional[str] = None,
+    ) -> str:
+        """
+        Make the freebayes command line for a region, which writes to stdout.
+        See make_freebayes_call for the keyword arguments.
         """
-        freebayes_call = (
-            f"set -o pipefail && freebayes -f {self.reference} {self.file_string} "
+        file_string = self.file_string
+        if files is not None:
+            file_string = self.make_file_string(files)
+
+        variant_input_args = ""
+        if variant_input is not None:
+            variant_input_args = f" --variant-input {variant_input} --only-use-input-alleles"
+
+        return (
+            f"freebayes -f {self.reference} {file_string} "
             f"--min-mapping-quality {self.min_mq} "
             f"--min-base-quality {self.min_bq} "
             f"--min-alternate-fraction {self.min_af} "
             f"--min-alternate-count {self.min_ac} "
             f"--ploidy 2 "
-            f"--region {self.region} "
-            f"| sed 's/##source/##freebayesSource/' "
-            f"| sed 's/##commandline/##freebayesCommandline/' "
-            f"| {self.sed_cmd} | bgzip > {self.call_vcf_path}"
+            f"--region {region}"
+            f"{variant_input_args}"
         )
 
-        logger.info("Running FreeBayes in sensitive mode")
+    def run_freebayes_call(self, freebayes_call: str) -> subprocess.CompletedProcess:
+        """
+        Run a freebayes command made by make_freebayes_call.
+        """
         logger.debug(freebayes_call)
         res = subprocess.run(
             freebayes_call,
@@ -144,6 +247,28 @@ class Call:
             check=False,
         )
         logger.debug("Freebayes result code: %s", res.returncode)
+        return res
+
+    def run_freebayes_calls(self, freebayes_calls: List[str]):
+        """
+        Run freebayes commands in parallel, using at most self.threads processes.
+        """
+        with ThreadPoolExecutor(max_workers=max(self.threads, 1)) as executor:
+            results = list(executor.map(self.run_freebayes_call, freebayes_calls))
+
+        failed = [res for res in results if res.returncode != 0]
+        if failed:
+            logger.error("FreeBayes failed: %s", failed[0].stderr)
+            exit(1)
+
+    def run_freebayes(self):
+        """
+        Run freebayes.
+        """
+        freebayes_call = self.make_freebayes_call(self.region, self.call_vcf_path)
+
+        logger.info("Running FreeBayes in sensitive mode")
+        res = self.run_freebayes_call(freebayes_call)
 
         if res.returncode != 0:
             logger.error("FreeBayes failed: %s", res.stderr)
@@ -152,6 +277,327 @@ class Call:
         if os.path.isfile(self.call_vcf_path):
             logger.debug("Finished running FreeBayes")
 
+    def run_streaming(self):
+        """
+        Run freebayes and mity normalise as one stream. The freebayes output is
+        read directly by python, the header is rewritten in memory, and each
+        variant is normalised and filtered as it is called. Only the final
+        normalised vcf is written.
+        """
+        freebayes_args = shlex.split(self.make_freebayes_args(self.region))
+
+        logger.info("Running FreeBayes in sensitive mode, streaming into mity normalise")
+        logger.debug(" ".join(freebayes_args))
+
+        with tempfile.TemporaryFile("w+") as stderr_file:
+            process = subprocess.Popen(
+                freebayes_args, stdout=subprocess.PIPE, stderr=stderr_file, text=True
+            )
+            read_fd, write_fd = os.pipe()
+            rewrite_thread = threading.Thread(
+                target=self.rewrite_freebayes_output, args=(process.stdout, write_fd)
+            )
+            rewrite_thread.start()
+
+            try:
+                with (
+                    os.fdopen(read_fd, "r") as stream_file,
+                    pysam.VariantFile(stream_file) as stream,
+                ):
+                    Normalise(
+                        debug=self.debug,
+                        vcf=None,
+                        reference_fasta=self.reference,
+                        prefix=self.prefix,
+                        output_dir=self.output_dir,
+                        allsamples=False,
+                        p=self.p,
+                        genome=self.genome,
+                        keep=self.keep,
+                        stream=stream,
+                        blacklist=self.blacklist,
+                        output_type=self.output_type,
+                    )
+            except Exception as error:
+                # the read end of the pipe is closed, so the rewrite thread stops
+                # with EPIPE once freebayes is killed
+                process.kill()
+                rewrite_thread.join()
+                process.wait()
+                stderr_file.seek(0)
+                raise error from RuntimeError(f"FreeBayes stderr: {stderr_file.read()}")
+
+            rewrite_thread.join()
+            process.wait()
+
+            if process.returncode != 0:
+                stderr_file.seek(0)
+                logger.error("FreeBayes failed: %s", stderr_file.read())
+                exit(1)
+
+        logger.debug("Finished running FreeBayes and mity normalise")
+
+    def rewrite_freebayes_output(self, freebayes_stdout, write_fd: int):
+        """
+        Copy the freebayes output to write_fd, renaming the freebayes header
+        lines and adding the mity command line.
+        """
+        pipe = os.fdopen(write_fd, "w")
+        try:
+            for line in freebayes_stdout:
+                if line.startswith("##"):
+                    line = self.rewrite_header_line(line)
+                pipe.write(line)
+            pipe.flush()
+        except BrokenPipeError:
+            # the reader stopped early, the error is handled in run_streaming
+            pass
+        finally:
+            # closing the write end ends the stream for the reader
+            try:
+                pipe.close()
+            except BrokenPipeError:
+                pass
+
+    def rewrite_header_line(self, line: str) -> str:
+        """
+        Rewrite a freebayes header line, in the same way as the sed commands
+        in make_freebayes_call.
+        """
+        if line.startswith("##source"):
+            return line.replace("##source", "##freebayesSource", 1)
+        if line.startswith("##commandline"):
+            return line.replace("##commandline", "##freebayesCommandline", 1)
+        if line.startswith("##phasing=none"):
+            return line.replace("##phasing=none", self.mity_cmd_line, 1)
+        return line
+
+    def run_pileup(self):
+        """
+        Call SNVs with the pileup engine instead of freebayes.
+        """
+        contig, start, end = self.parse_region(self.region)
+        _, contig_length = self.bam_get_mt_contig(self.files[0])
+
+        logger.info("Running the pileup caller")
+        PileupCaller(
+            files=self.files,
+            reference=self.reference,
+            contig=contig,
+            contig_length=contig_length,
+            start=start,
+            end=end,
+            min_mq=self.min_mq,
+            min_bq=self.min_bq,
+            min_af=self.min_af,
+            min_ac=self.min_ac,
+            header_lines=[self.mity_cmd_line],
+        ).call(self.call_vcf_path)
+
+        logger.debug("Finished running the pileup caller")
+
+    def run_freebayes_tiled(self):
+        """
+        Run freebayes over overlapping tiles of the region in parallel, then
+        stitch the tiles back into one vcf.
+        """
+        tiles = self.make_tiles()
+        tile_paths = [
+            self.call_vcf_path.replace(".vcf.gz", f".tile{i}.vcf.gz") for i in range(len(tiles))
+        ]
+        freebayes_calls = [
+            self.make_freebayes_call(tile_region, tile_path)
+            for (_, _, tile_region), tile_path in zip(tiles, tile_paths)
+        ]
+
+        logger.info(
+            "Running FreeBayes in sensitive mode over %s tiles with %s threads",
+            len(tiles),
+            self.threads,
+        )
+        self.run_freebayes_calls(freebayes_calls)
+
+        self.stitch_tiles(tiles, tile_paths)
+
+        if not self.keep:
+            for tile_path in tile_paths:
+                os.remove(tile_path)
+
+        logger.debug("Finished running FreeBayes")
+
+    def run_freebayes_batched(self):
+        """
+        Call the samples in batches of self.batch_size, and combine the batches
+        into one multi-sample vcf.
+
+        This runs in two rounds:
+            1. Each batch is called independently to discover variants.
+            2. Each batch is genotyped at the union of all discovered alleles,
+               so that every sample has values at every site.
+        The genotyped batches are then merged with bcftools merge.
+        """
+        batches = [
+            self.files[i : i + self.batch_size] for i in range(0, len(self.files), self.batch_size)
+        ]
+        discovery_paths = [
+            self.call_vcf_path.replace(".vcf.gz", f".batch{i}.discovery.vcf.gz")
+            for i in range(len(batches))
+        ]
+        genotyped_paths = [
+            self.call_vcf_path.replace(".vcf.gz", f".batch{i}.vcf.gz") for i in range(len(batches))
+        ]
+        sites_path = self.call_vcf_path.replace(".vcf.gz", ".sites.vcf.gz")
+        merged_path = self.call_vcf_path.replace(".vcf.gz", ".batches.vcf.gz")
+
+        logger.info(
+            "Running FreeBayes in sensitive mode over %s batches of up to %s samples",
+            len(batches),
+            self.batch_size,
+        )
+        self.run_freebayes_calls(
+            [
+                self.make_freebayes_call(self.region, path, files=batch)
+                for batch, path in zip(batches, discovery_paths)
+            ]
+        )
+        self.make_sites(discovery_paths, sites_path)
+
+        logger.info("Genotyping all batches at %s", sites_path)
+        self.run_freebayes_calls(
+            [
+                self.make_freebayes_call(self.region, path, files=batch, variant_input=sites_path)
+                for batch, path in zip(batches, genotyped_paths)
+            ]
+        )
+        for path in genotyped_paths:
+            MityUtil.tabix(path)
+
+        pysam.bcftools.merge(
+            "-i",
+            self.BATCH_INFO_RULES,
+            "-O",
+            "z",
+            "-o",
+            merged_path,
+            *genotyped_paths,
+            catch_stdout=False,
+        )
+        self.fill_missing_genotypes(merged_path, self.call_vcf_path)
+
+        if not self.keep:
+            for path in discovery_paths + genotyped_paths:
+                os.remove(path)
+                os.remove(path + ".tbi")
+            os.remove(sites_path)
+            os.remove(sites_path + ".tbi")
+            os.remove(merged_path)
+
+        logger.debug("Finished running FreeBayes")
+
+    def make_sites(self, vcf_paths: List[str], sites_path: str):
+        """
+        Make a sites-only vcf of the union of alleles in vcf_paths.
+        """
+        for path in vcf_paths:
+            MityUtil.tabix(path)
+
+        merged_path = sites_path.replace(".vcf.gz", ".merged.vcf.gz")
+        pysam.bcftools.merge(
+            "-m", "all", "-O", "z", "-o", merged_path, *vcf_paths, catch_stdout=False
+        )
+        pysam.bcftools.view("-G", "-O", "z", "-o", sites_path, merged_path, catch_stdout=False)
+        MityUtil.tabix(sites_path)
+        os.remove(merged_path)
+
+    def fill_missing_genotypes(self, input_path: str, output_path: str):
+        """
+        Fill in samples without values at a site, e.g. when freebayes did not
+        report a site in one batch. Numeric FORMAT fields are set to 0 so that
+        mity normalise and mity report see a complete sample by site matrix.
+        """
+        num_filled = 0
+
+        with pysam.VariantFile(input_path) as merged_vcf:
+            header = merged_vcf.header
+            numeric_formats = [
+                key for key, value in header.formats.items() if value.type in ("Integer", "Float")
+            ]
+
+            with pysam.VariantFile(output_path, "wz", header=header) as filled_vcf:
+                for variant in merged_vcf:
+                    num_alts = len(variant.alts)
+                    for sample in variant.samples.values():
+                        if sample.get("DP") is not None:
+                            continue
+
+                        num_filled += 1
+                        for key in numeric_formats:
+                            number = header.formats[key].number
+                            if number == "A":
+                                sample[key] = (0,) * num_alts
+                            elif number == "R":
+                                sample[key] = (0,) * (num_alts + 1)
+                            elif number == 1:
+                                sample[key] = 0
+
+                    filled_vcf.write(variant)
+
+        logger.debug("Filled in %s missing sample genotypes", num_filled)
+
+    def parse_region(self, region: str) -> Tuple[str, int, int]:
+        """
+        Split a region string, e.g. 'MT:1-16569' into ('MT', 1, 16569). If the
+        region is only a contig name, the whole contig is used.
+        """
+        if ":" not in region:
+            contig, length = self.bam_get_mt_contig(self.files[0])
+            if contig != region:
+                raise ValueError(f"Region {region} is not the mitochondrial contig")
+            return contig, 1, length
+
+        contig, coordinates = region.rsplit(":", 1)
+        start, end = coordinates.replace(",", "").split("-")
+        return contig, int(start), int(end)
+
+    def make_tiles(self) -> List[Tuple[int, int, str]]:
+        """
+        Split the region into one tile per thread.
+
+        Returns:
+            list: (core_start, core_end, tile_region) for each tile. Variants
+            are kept from a tile only if their position is inside the core of
+            the tile. The tile region extends TILE_OVERLAP bases past each side
+            of the core so that variants near the core edges are called with
+            the same context as a single freebayes run.
+        """
+        contig, start, end = self.parse_region(self.region)
+        tile_size = -(-(end - start + 1) // self.threads)
+
+        tiles = []
+        for core_start in range(start, end + 1, tile_size):
+            core_end = min(core_start + tile_size - 1, end)
+            tile_start = max(start, core_start - self.TILE_OVERLAP)
+            tile_end = min(end, core_end + self.TILE_OVERLAP)
+            tiles.append((core_start, core_end, f"{contig}:{tile_start}-{tile_end}"))
+
+        return tiles
+
+    def stitch_tiles(self, tiles: List[Tuple[int, int, str]], tile_paths: List[str]):
+        """
+        Concatenate the tile vcfs into the call vcf, keeping only variants in
+        the core of each tile so that variants in the overlaps are not
+        duplicated.
+        """
+        with pysam.VariantFile(tile_paths[0]) as first_tile:
+            header = first_tile.header.copy()
+
+        with pysam.VariantFile(self.call_vcf_path, "wz", header=header) as call_vcf:
+            for (core_start, core_end, _), tile_path in zip(tiles, tile_paths):
+                with pysam.VariantFile(tile_path) as tile_vcf:
+                    for variant in tile_vcf:
+                        if core_start <= variant.pos <= core_end:
+                            call_vcf.write(variant)
+
     def set_mity_cmd(self):
         """
         Creates the mity command for embedding into the vcf.
@@ -167,8 +613,27 @@ class Call:
         if self.normalise:
             mity_cmd += f" --normalise --p {self.p}"
 
-        mity_cmd += " " + " ".join(self.files)
+        if self.threads > 1:
+            mity_cmd += f" --threads {self.threads}"
+
+        if self.batch_size is not None:
+            mity_cmd += f" --batch-size {self.batch_size}"
+
+        if self.engine != "freebayes":
+            mity_cmd += f" --engine {self.engine}"
+
+        if self.stream:
+            mity_cmd += " --stream"
+
+        if self.blacklist is not None:
+            mity_cmd += f" --blacklist {self.blacklist}"
+
+        if self.output_type != "vcf":
+            mity_cmd += f" --output-type {self.output_type}"
+
+        mity_cmd += " " + " ".join(self.input_files)
         mity_cmd += '"'
+        self.mity_cmd_line = mity_cmd
         mity_cmd = mity_cmd.replace("/", "\\/")
 
         logger.debug(mity_cmd)
@@ -198,15 +663,22 @@ class Call:
         if self.prefix is None:
             self.prefix = self.make_prefix(self.files[0], self.prefix)
 
-        self.file_string = " ".join(["-b " + _file for _file in reversed(self.files)])
+        self.file_string = self.make_file_string(self.files)
 
         self.normalised_vcf_path = os.path.join(
-            self.output_dir, self.prefix + ".mity.normalise.vcf.gz"
+            self.output_dir,
+            self.prefix + ".mity.normalise" + MityUtil.OUTPUT_TYPES[self.output_type],
         )
         self.call_vcf_path = os.path.join(
             self.output_dir, self.prefix + ".mity.call.vcf.gz"
         )
 
+    def make_file_string(self, files: List[str]) -> str:
+        """
+        Make the freebayes BAM / CRAM arguments for a list of files.
+        """
+        return " ".join(["-b " + _file for _file in reversed(files)])
+
     def run_checks(self):
         """
         Check for valid input.
@@ -228,6 +700,49 @@ class Call:
             logger.error("A genome file should be supplied if mity call normalize=True")
             sys.exit(1)
 
+        if self.stream and not self.normalise:
+            raise ValueError("--stream can only be used with --normalise")
+
+        if self.stream and (
+            self.engine != "freebayes" or self.threads > 1 or self.batch_size is not None
+        ):
+            raise ValueError(
+                "--stream can not be used with --engine pileup, --threads or --batch-size"
+            )
+
+    def extract_files(self):
+        """
+        Replace the input files with their cached mitochondrial reads, see
+        mity extract.
+        """
+        self.check_missing_file(self.files, die=True)
+        if len(self.files) == 1:
+            self.prefix = self.make_prefix(self.files[0], self.prefix)
+
+        extract = Extract(
+            debug=self.debug,
+            files=[self.files],
+            cache_dir=self.cache_dir,
+            reference=self.reference,
+            threads=self.threads,
+        )
+        self.files = extract.extracted_files
+        self.bam_summaries = extract.summaries
+
+    def load_pileup_summaries(self):
+        """
+        Read the sample and contig of each histogram from mity pileup, which are
+        used in place of the BAM / CRAM header.
+        """
+        if self.engine != "pileup" or self.stream:
+            raise ValueError("Files from mity pileup can only be called with --engine pileup")
+
+        self.check_missing_file(self.files, die=True)
+        for file_name in filter(lambda f: f.endswith(PILEUP_SUFFIX), self.files):
+            summary = PileupCaller.read_histogram_summary(file_name)
+            summary["has_rg"] = True
+            self.bam_summaries[file_name] = summary
+
     def bam_has_rg(self, bam):
         """
         Check whether a BAM or CRAM file contains a valid @RG header,
@@ -239,6 +754,9 @@ class Call:
         Returns:
             - bool: True if the file has a valid @RG header, False otherwise.
         """
+        if bam in self.bam_summaries:
+            return self.bam_summaries[bam]["has_rg"]
+
         r = pysam.AlignmentFile(bam, "rb")
         return len(r.header["RG"]) > 0
 
@@ -260,18 +778,21 @@ class Call:
             - If with_coordinates is False, a tuple (contig_name, contig_length).
             - If with_coordinates is True, a string with coordinates.
         """
-        r = pysam.AlignmentFile(bam, "rb")
-        chroms = [str(record.get("SN")) for record in r.header["SQ"]]
-        mito_contig_intersection = {"MT", "chrM"}.intersection(chroms)
+        res = None
 
-        assert len(mito_contig_intersection) == 1
-        mito_contig = "".join(mito_contig_intersection)
+        if bam in self.bam_summaries:
+            res = tuple(self.bam_summaries[bam]["mt_contig"])
+        else:
+            r = pysam.AlignmentFile(bam, "rb")
+            chroms = [str(record.get("SN")) for record in r.header["SQ"]]
+            mito_contig_intersection = {"MT", "chrM"}.intersection(chroms)
 
-        res = None
+            assert len(mito_contig_intersection) == 1
+            mito_contig = "".join(mito_contig_intersection)
 
-        for record in r.header["SQ"]:
-            if mito_contig == record["SN"]:
-                res = record["SN"], record["LN"]
+            for record in r.header["SQ"]:
+                if mito_contig == record["SN"]:
+                    res = record["SN"], record["LN"]
 
         if res is not None and as_string:
             res = res[0] + ":1-" + str(res[1])
@@ -293,6 +814,11 @@ class Call:
         """
         supported_extensions = {".vcf": ".vcf", ".bam": ".bam", ".cram": ".cram"}
 
+        if file_name.endswith(PILEUP_SUFFIX):
+            return (
+                prefix if prefix is not None else os.path.basename(file_name)[: -len(PILEUP_SUFFIX)]
+            )
+
         ext = os.path.splitext(file_name)[1]
         if ext in supported_extensions:
             return (
@@ -12,7 +12,18 @@ import argparse
 import logging
 import os
 
-from mitylib import call, normalise, report, merge, util
+from mitylib import (
+    annotate,
+    call,
+    extract,
+    normalise,
+    pileup,
+    refilter,
+    report,
+    merge,
+    sweep,
+    util,
+)
 from ._version import __version__
 
 
@@ -55,6 +66,13 @@ def _cmd_call(args):
         region=args.region,
         bam_list=args.bam_file_list,
         keep=args.keep,
+        threads=args.threads,
+        batch_size=args.batch_size,
+        cache_dir=args.cache_dir,
+        engine=args.engine,
+        stream=args.stream,
+        blacklist=args.blacklist,
+        output_type=args.output_type,
     )
 
 
@@ -90,6 +108,14 @@ P_call.add_argument(
 P_call.add_argument(
     "--prefix", action="store", help="Output files will be named with PREFIX"
 )
+P_call.add_argument(
+    "--output-type",
+    choices=list(util.MityUtil.OUTPUT_TYPES),
+    default="vcf",
+    help="Write a bgzipped VCF with a TBI index, or a BCF with a CSI index. BCF is "
+    "faster for the next mity step to read. Default: vcf",
+    dest="output_type",
+)
 P_call.add_argument(
     "--min-mapping-quality",
     action="store",
@@ -141,9 +167,21 @@ P_call.add_argument(
     "Default: 0.002, range = [0,1]",
     dest="p",
 )
+P_call.add_argument(
+    "--blacklist",
+    action="store",
+    help="BED file of blacklisted mitochondrial regions. Variants overlapping a "
+    "region fail POS_filter. Default: MT:302-318 and MT:3105-3108",
+)
 P_call.add_argument(
     "--normalise", action="store_true", help="Run mity normalise the resulting VCF"
 )
+P_call.add_argument(
+    "--stream",
+    action="store_true",
+    help="Normalise variants as FreeBayes calls them, without writing intermediate "
+    "files. Requires --normalise",
+)
 P_call.add_argument(
     "--output-dir",
     action="store",
@@ -162,6 +200,45 @@ P_call.add_argument(
     "Default: Entire MT genome. ",
     dest="region",
 )
+P_call.add_argument(
+    "--engine",
+    choices=["freebayes", "pileup"],
+    default="freebayes",
+    help="Variant calling engine. 'pileup' counts alleles per position with NumPy, "
+    "which is much faster at high depth but only calls SNVs. The pileup engine also "
+    "accepts the FILE.pileup.npz files of mity pileup in place of BAM / CRAM files. "
+    "Default: freebayes",
+    dest="engine",
+)
+P_call.add_argument(
+    "--threads",
+    action="store",
+    type=int,
+    default=1,
+    help="Number of FreeBayes processes to run in parallel. If greater than 1, the "
+    "region is split into overlapping tiles which are called in parallel and stitched "
+    "back together. Also the number of mity normalise processes. Default: 1",
+    dest="threads",
+)
+P_call.add_argument(
+    "--batch-size",
+    action="store",
+    type=int,
+    default=None,
+    help="Call the samples in batches of BATCH_SIZE and combine the batches into one "
+    "multi-sample VCF. Batches are called in parallel using --threads processes. "
+    "Recommended for large --bam-file-list cohorts. Default: call all samples together",
+    dest="batch_size",
+)
+P_call.add_argument(
+    "--cache-dir",
+    action="store",
+    type=str,
+    default=None,
+    help="Extract the MT reads of each BAM / CRAM file into CACHE_DIR (see mity extract) "
+    "and call variants from the cached reads. Default: call from the input files",
+    dest="cache_dir",
+)
 P_call.add_argument(
     "--bam-file-list",
     action="store_true",
@@ -179,6 +256,180 @@ P_call.add_argument(
 )
 P_call.set_defaults(func=_cmd_call)
 
+# extract ----------------------------------------------------------------------
+
+
+def _cmd_extract(args):
+    """Extract mitochondrial reads into a local cache"""
+    logging.info("mity %s", __version__)
+    logging.info("Extracting mitochondrial reads")
+
+    reference = util.MityUtil.select_reference_fasta(args.reference, args.custom_reference_fasta)
+
+    extract.Extract(
+        debug=args.debug,
+        files=args.files,
+        cache_dir=args.cache_dir,
+        reference=reference,
+        bam_list=args.bam_file_list,
+        threads=args.threads,
+    )
+
+
+P_extract = AP_subparsers.add_parser("extract", help=_cmd_extract.__doc__)
+P_extract.add_argument(
+    "-d", "--debug", action="store_true", help="Enter debug mode", required=False
+)
+P_extract.add_argument(
+    "files",
+    action="append",
+    nargs="+",
+    help="BAM / CRAM files to extract MT reads from. If --bam-file-list is included, this argument is the file containing the list of bam/cram files.",
+)
+P_extract.add_argument(
+    "--cache-dir",
+    action="store",
+    type=str,
+    default=None,
+    help="Extracted reads will be saved in CACHE_DIR. Default: $XDG_CACHE_HOME/mity or ~/.cache/mity",
+    dest="cache_dir",
+)
+P_extract.add_argument(
+    "--reference",
+    choices=["hs37d5", "hg19", "hg38", "mm10"],
+    default="hs37d5",
+    required=False,
+    help="Reference genome version to use for CRAM files. Default: hs37d5",
+)
+P_extract.add_argument(
+    "--custom-reference-fasta",
+    action="store",
+    help="Specify custom reference fasta file",
+    dest="custom_reference_fasta",
+)
+P_extract.add_argument(
+    "--threads",
+    action="store",
+    type=int,
+    default=1,
+    help="Number of files to extract in parallel. Default: 1",
+    dest="threads",
+)
+P_extract.add_argument(
+    "--bam-file-list",
+    action="store_true",
+    default=False,
+    help="Treat the file as a text file of BAM files to be processed."
+    " The path to each file should be on one row per bam file.",
+    dest="bam_file_list",
+)
+P_extract.set_defaults(func=_cmd_extract)
+
+# pileup -----------------------------------------------------------------------
+
+
+def _cmd_pileup(args):
+    """Count mitochondrial alleles by base and mapping quality for mity call"""
+    logging.info("mity %s", __version__)
+    logging.info("Counting mitochondrial alleles")
+
+    reference = util.MityUtil.select_reference_fasta(args.reference, args.custom_reference_fasta)
+
+    pileup.Pileup(
+        debug=args.debug,
+        files=args.files,
+        reference=reference,
+        output_dir=args.output_dir,
+        region=args.region,
+        bam_list=args.bam_file_list,
+        threads=args.threads,
+        bq_bins=args.bq_bins,
+        mq_bins=args.mq_bins,
+    )
+
+
+def _parse_bins(value):
+    return [int(edge) for edge in value.split(",")]
+
+
+P_pileup = AP_subparsers.add_parser("pileup", help=_cmd_pileup.__doc__)
+P_pileup.add_argument("-d", "--debug", action="store_true", help="Enter debug mode", required=False)
+P_pileup.add_argument(
+    "files",
+    action="append",
+    nargs="+",
+    help="BAM / CRAM files to count. A FILE.pileup.npz is written for each file, which "
+    "mity call --engine pileup accepts in place of the BAM / CRAM file. If "
+    "--bam-file-list is included, this argument is the file containing the list of "
+    "bam/cram files.",
+)
+P_pileup.add_argument(
+    "--reference",
+    choices=["hs37d5", "hg19", "hg38", "mm10"],
+    default="hs37d5",
+    required=False,
+    help="Reference genome version to use for CRAM files. Default: hs37d5",
+)
+P_pileup.add_argument(
+    "--custom-reference-fasta",
+    action="store",
+    help="Specify custom reference fasta file",
+    dest="custom_reference_fasta",
+)
+P_pileup.add_argument(
+    "--output-dir",
+    action="store",
+    type=str,
+    default=".",
+    help="Output files will be saved in OUTPUT_DIR. Default: '.' ",
+    dest="output_dir",
+)
+P_pileup.add_argument(
+    "--region",
+    action="store",
+    type=str,
+    default=None,
+    help="Region of the MT genome to count, e.g. MT:1-1000. Default: the whole MT / chrM contig",
+    dest="region",
+)
+P_pileup.add_argument(
+    "--base-quality-bins",
+    action="store",
+    type=_parse_bins,
+    default=None,
+    help="Comma separated lower edges of the base quality bins. mity call can use "
+    "any of these as --min-base-quality. Default: "
+    + ",".join(str(edge) for edge in pileup.Pileup.BQ_BINS),
+    dest="bq_bins",
+)
+P_pileup.add_argument(
+    "--mapping-quality-bins",
+    action="store",
+    type=_parse_bins,
+    default=None,
+    help="Comma separated lower edges of the mapping quality bins. mity call can use "
+    "any of these as --min-mapping-quality. Default: "
+    + ",".join(str(edge) for edge in pileup.Pileup.MQ_BINS),
+    dest="mq_bins",
+)
+P_pileup.add_argument(
+    "--threads",
+    action="store",
+    type=int,
+    default=1,
+    help="Number of files to count in parallel. Default: 1",
+    dest="threads",
+)
+P_pileup.add_argument(
+    "--bam-file-list",
+    action="store_true",
+    default=False,
+    help="Treat the file as a text file of BAM files to be processed."
+    " The path to each file should be on one row per bam file.",
+    dest="bam_file_list",
+)
+P_pileup.set_defaults(func=_cmd_pileup)
+
 # normalise --------------------------------------------------------------------
 
 
@@ -200,6 +451,12 @@ def _cmd_normalise(args):
         allsamples=args.allsamples,
         keep=args.keep,
         p=args.p,
+        engine=args.engine,
+        threads=args.threads,
+        native_norm=args.native_norm,
+        blacklist=args.blacklist,
+        raw_format=args.raw_format,
+        output_type=args.output_type,
     )
 
 
@@ -219,6 +476,14 @@ P_normalise.add_argument(
 P_normalise.add_argument(
     "--prefix", action="store", help="Output files will be named with PREFIX"
 )
+P_normalise.add_argument(
+    "--output-type",
+    choices=list(util.MityUtil.OUTPUT_TYPES),
+    default="vcf",
+    help="Write a bgzipped VCF with a TBI index, or a BCF with a CSI index. BCF is "
+    "faster for the next mity step to read. Default: vcf",
+    dest="output_type",
+)
 P_normalise.add_argument(
     "--allsamples",
     action="store_true",
@@ -241,6 +506,43 @@ P_normalise.add_argument(
     "Default: 0.002, range = [0,1]",
     dest="p",
 )
+P_normalise.add_argument(
+    "--blacklist",
+    action="store",
+    help="BED file of blacklisted mitochondrial regions. Variants overlapping a "
+    "region fail POS_filter. Default: MT:302-318 and MT:3105-3108",
+)
+P_normalise.add_argument(
+    "--engine",
+    choices=normalise.Normalise.ENGINES,
+    default="record",
+    help="Filtering engine. 'columnar' processes blocks of variants as samples x "
+    "variants arrays, which is much faster for VCFs with many samples. Both engines "
+    "give the same output. Default: record",
+)
+P_normalise.add_argument(
+    "--threads",
+    action="store",
+    type=int,
+    default=1,
+    help="Number of processes to filter with. If greater than 1, the samples are "
+    "split into one chunk per process and filtered with the columnar engine. Default: 1",
+)
+P_normalise.add_argument(
+    "--raw-format",
+    action="store_true",
+    help="With the record engine, write the new FORMAT values of each variant as text "
+    "instead of setting them through pysam, which is much faster for VCFs with many "
+    "samples. Gives the same output",
+    dest="raw_format",
+)
+P_normalise.add_argument(
+    "--native-norm",
+    action="store_true",
+    help="Split multiallelic variants and left align indels in mity, while filtering, "
+    "instead of running bcftools norm first",
+    dest="native_norm",
+)
 P_normalise.add_argument(
     "--reference",
     choices=["hs37d5", "hg19", "hg38", "mm10"],
@@ -263,6 +565,262 @@ P_normalise.add_argument(
 P_normalise.set_defaults(func=_cmd_normalise)
 
 
+# refilter ---------------------------------------------------------------------
+
+
+def _cmd_refilter(args):
+    """Re-apply the FILTERs of mity normalise with new thresholds"""
+    logging.info("mity %s", __version__)
+    logging.info("Refiltering mity normalise VCFs")
+
+    refilter.Refilter(
+        debug=args.debug,
+        vcfs=args.vcf,
+        output_dir=args.output_dir,
+        allsamples=args.allsamples,
+        p=args.p,
+        min_dp=args.min_dp,
+        sb_range_lo=args.sb_range_lo,
+        sb_range_hi=args.sb_range_hi,
+        min_mqmr=args.min_mqmr,
+        min_aqr=args.min_aqr,
+        blacklist=args.blacklist,
+        threads=args.threads,
+        output_type=args.output_type,
+    )
+
+
+P_refilter = AP_subparsers.add_parser("refilter", help=_cmd_refilter.__doc__)
+P_refilter.add_argument(
+    "-d", "--debug", action="store_true", help="Enter debug mode", required=False
+)
+P_refilter.add_argument(
+    "vcf", action="store", nargs="+", help="vcf.gz or bcf files from mity normalise"
+)
+P_refilter.add_argument(
+    "--output-dir",
+    action="store",
+    type=str,
+    default=".",
+    help="Output files will be saved in OUTPUT_DIR. Default: '.'",
+    dest="output_dir",
+)
+P_refilter.add_argument(
+    "--output-type",
+    choices=list(util.MityUtil.OUTPUT_TYPES),
+    default="vcf",
+    help="Write a bgzipped VCF with a TBI index, or a BCF with a CSI index. Default: vcf",
+    dest="output_type",
+)
+P_refilter.add_argument(
+    "--allsamples",
+    action="store_true",
+    required=False,
+    help="PASS in the filter requires all samples to pass instead of just one",
+)
+P_refilter.add_argument(
+    "--p",
+    action="store",
+    type=float,
+    default=normalise.Normalise.P_VAL,
+    help="Minimum noise level. This is used to calculate q. Default: 0.002, range = [0,1]",
+    dest="p",
+)
+P_refilter.add_argument(
+    "--min-dp",
+    action="store",
+    type=int,
+    default=normalise.Normalise.MIN_DP,
+    help="Samples with more than MIN_DP reference (or alternate) reads are tested "
+    "by the strand bias, MQMR and AQR filters. Default: 15",
+    dest="min_dp",
+)
+P_refilter.add_argument(
+    "--sb-range-lo",
+    action="store",
+    type=float,
+    default=normalise.Normalise.SB_RANGE_LO,
+    help="Lowest strand bias (SBR and SBA) that passes. Default: 0.1",
+    dest="sb_range_lo",
+)
+P_refilter.add_argument(
+    "--sb-range-hi",
+    action="store",
+    type=float,
+    default=normalise.Normalise.SB_RANGE_HI,
+    help="Highest strand bias (SBR and SBA) that passes. Default: 0.9",
+    dest="sb_range_hi",
+)
+P_refilter.add_argument(
+    "--min-mqmr",
+    action="store",
+    type=float,
+    default=normalise.Normalise.MIN_MQMR,
+    help="Lowest mean mapping quality of the reference reads that passes. Default: 30",
+    dest="min_mqmr",
+)
+P_refilter.add_argument(
+    "--min-aqr",
+    action="store",
+    type=float,
+    default=normalise.Normalise.MIN_AQR,
+    help="Lowest average base quality of the reference reads that passes. Default: 20",
+    dest="min_aqr",
+)
+P_refilter.add_argument(
+    "--blacklist",
+    action="store",
+    help="BED file of blacklisted mitochondrial regions. Variants overlapping a "
+    "region fail POS_filter. Default: MT:302-318 and MT:3105-3108",
+)
+P_refilter.add_argument(
+    "--threads",
+    action="store",
+    type=int,
+    default=1,
+    help="Number of VCFs to refilter in parallel processes. Default: 1",
+)
+P_refilter.set_defaults(func=_cmd_refilter)
+
+
+# sweep ------------------------------------------------------------------------
+
+
+def _cmd_sweep(args):
+    """Evaluate a grid of call and normalise thresholds from one mity call"""
+    logging.info("mity %s", __version__)
+    logging.info("Sweeping mity thresholds")
+
+    if not args.files and args.vcf is None:
+        raise ValueError("Either BAM / CRAM files or --vcf must be given")
+
+    genome = util.MityUtil.select_reference_genome(args.reference, args.custom_reference_genome)
+    args.reference = util.MityUtil.select_reference_fasta(
+        args.reference, args.custom_reference_fasta
+    )
+
+    sweep.Sweep(
+        debug=args.debug,
+        grid=args.grid,
+        files=args.files,
+        vcf=args.vcf,
+        reference=args.reference,
+        genome=genome,
+        prefix=args.prefix,
+        output_dir=args.output_dir,
+        region=args.region,
+        bam_list=args.bam_file_list,
+        allsamples=args.allsamples,
+        blacklist=args.blacklist,
+        threads=args.threads,
+        keep=args.keep,
+        write_vcfs=args.write_vcfs,
+    )
+
+
+P_sweep = AP_subparsers.add_parser("sweep", help=_cmd_sweep.__doc__)
+P_sweep.add_argument("-d", "--debug", action="store_true", help="Enter debug mode", required=False)
+P_sweep.add_argument(
+    "files",
+    action="store",
+    nargs="*",
+    help="BAM / CRAM files to call variants in. If --bam-file-list is included, this "
+    "argument is the file containing the list of bam/cram files.",
+)
+P_sweep.add_argument(
+    "--grid",
+    action="store",
+    required=True,
+    help="YAML file with a list of values for any of min_alternate_fraction, "
+    "min_alternate_count, p, min_dp, sb_range_lo, sb_range_hi, min_mqmr, min_aqr and "
+    "min_vaf. Every combination of the values is evaluated",
+)
+P_sweep.add_argument(
+    "--vcf",
+    action="store",
+    help="Evaluate the grid on a VCF from mity normalise instead of calling variants. "
+    "It must have been called with the smallest min_alternate_fraction and "
+    "min_alternate_count of the grid",
+)
+P_sweep.add_argument(
+    "--write-vcfs",
+    action="store_true",
+    help="Write the variants of each grid point to PREFIX.sweep.N.vcf.gz",
+    dest="write_vcfs",
+)
+P_sweep.add_argument(
+    "--reference",
+    choices=["hs37d5", "hg19", "hg38", "mm10"],
+    default="hs37d5",
+    required=False,
+    help="Reference genome version to use. Default: hs37d5",
+)
+P_sweep.add_argument(
+    "--custom-reference-fasta",
+    action="store",
+    help="Specify custom reference fasta file",
+    dest="custom_reference_fasta",
+)
+P_sweep.add_argument(
+    "--custom-reference-genome",
+    action="store",
+    help="Specify custom reference genome file",
+    dest="custom_reference_genome",
+)
+P_sweep.add_argument("--prefix", action="store", help="Output files will be named with PREFIX")
+P_sweep.add_argument(
+    "--output-dir",
+    action="store",
+    type=str,
+    default=".",
+    help="Output files will be saved in OUTPUT_DIR. Default: '.'",
+    dest="output_dir",
+)
+P_sweep.add_argument(
+    "--region",
+    action="store",
+    type=str,
+    default=None,
+    help="Region of MT genome to call variants in. Default: Entire MT genome.",
+    dest="region",
+)
+P_sweep.add_argument(
+    "--allsamples",
+    action="store_true",
+    required=False,
+    help="PASS in the filter requires all samples to pass instead of just one",
+)
+P_sweep.add_argument(
+    "--blacklist",
+    action="store",
+    help="BED file of blacklisted mitochondrial regions. Variants overlapping a "
+    "region fail POS_filter. Default: MT:302-318 and MT:3105-3108",
+)
+P_sweep.add_argument(
+    "--threads",
+    action="store",
+    type=int,
+    default=1,
+    help="Number of FreeBayes and mity normalise processes. Default: 1",
+)
+P_sweep.add_argument(
+    "--bam-file-list",
+    action="store_true",
+    default=False,
+    help="Treat the file as a text file of BAM files to be processed."
+    " The path to each file should be on one row per bam file.",
+    dest="bam_file_list",
+)
+P_sweep.add_argument(
+    "-k",
+    "--keep",
+    action="store_true",
+    required=False,
+    help="Keep all intermediate files",
+)
+P_sweep.set_defaults(func=_cmd_sweep)
+
+
 # report -----------------------------------------------------------------------
 
 
@@ -282,6 +840,11 @@ def _cmd_report(args):
         vcfanno_config=args.vcfanno_config,
         report_config=args.report_config,
         output_annotated_vcf=args.output_annotated_vcf,
+        annotator=args.annotator,
+        annotation_bundle=args.annotation_bundle,
+        annotation_cache=args.annotation_cache,
+        annotation_cache_size=args.annotation_cache_size,
+        threads=args.threads,
     )
 
 
@@ -331,6 +894,40 @@ P_report.add_argument(
     help="Path to the custom annotations used for vcfanno. Only required if using custom annotations.",
     dest="vcfanno_base_path",
 )
+P_report.add_argument(
+    "--annotator",
+    choices=["native", "vcfanno"],
+    default="native",
+    help="Annotation engine. 'native' annotates the variants in memory from an annotation "
+    "bundle of the sources of the vcfanno config, and supports the 'self' op. 'vcfanno' "
+    "runs the vcfanno binary. Default: native",
+    dest="annotator",
+)
+P_report.add_argument(
+    "--annotation-bundle",
+    action="store",
+    help="Annotation bundle of the native annotator, see mity annotations compile. It is "
+    "compiled again if the vcfanno config or any annotation source has changed. "
+    "Default: a bundle in $XDG_CACHE_HOME/mity or ~/.cache/mity",
+    dest="annotation_bundle",
+)
+P_report.add_argument(
+    "--annotation-cache",
+    action="store",
+    help="SQLite cache of the annotations of the variants of earlier reports, which are "
+    "not annotated again. Default: $XDG_CACHE_HOME/mity/annotations.sqlite or "
+    "~/.cache/mity/annotations.sqlite",
+    dest="annotation_cache",
+)
+P_report.add_argument(
+    "--annotation-cache-size",
+    action="store",
+    type=int,
+    default=1000000,
+    help="The number of variants to keep in the annotation cache. The least recently "
+    "used variants are evicted. 0 disables the cache. Default: 1000000",
+    dest="annotation_cache_size",
+)
 P_report.add_argument(
     "--custom-vcfanno-config",
     action="store",
@@ -349,10 +946,75 @@ P_report.add_argument(
     help="Output annotated vcf file",
     dest="output_annotated_vcf",
 )
+P_report.add_argument(
+    "--threads",
+    action="store",
+    type=int,
+    default=1,
+    help="Number of processes to make the sheets of the VCFs in. The sheets are written "
+    "in input order. Default: 1",
+    dest="threads",
+)
 
 P_report.set_defaults(func=_cmd_report)
 
 
+# annotations -----------------------------------------------------------------
+
+
+def _cmd_annotations_compile(args):
+    """Compile the annotation sources into an annotation bundle"""
+    logging.info("mity %s", __version__)
+    logging.info("Compiling the annotation bundle")
+    annotate.CompileAnnotations(
+        debug=args.debug,
+        contig=args.contig,
+        vcfanno_config=args.vcfanno_config,
+        vcfanno_base_path=args.vcfanno_base_path,
+        bundle=args.bundle,
+    )
+
+
+P_annotations = AP_subparsers.add_parser("annotations", help="Manage the annotation sources")
+P_annotations_subparsers = P_annotations.add_subparsers(
+    help="mity annotations sub-commands (use with -h for more info)"
+)
+
+P_annotations_compile = P_annotations_subparsers.add_parser(
+    "compile", help=_cmd_annotations_compile.__doc__
+)
+P_annotations_compile.add_argument(
+    "-d", "--debug", action="store_true", help="Enter debug mode", required=False
+)
+P_annotations_compile.add_argument(
+    "--contig",
+    choices=["MT", "chrM"],
+    default="MT",
+    required=False,
+    help="Contig used for annotation purposes",
+)
+P_annotations_compile.add_argument(
+    "--vcfanno-base-path",
+    action="store",
+    help="Path to the custom annotations used for vcfanno. Only required if using custom annotations.",
+    dest="vcfanno_base_path",
+)
+P_annotations_compile.add_argument(
+    "--custom-vcfanno-config",
+    action="store",
+    help="Provide a custom vcfanno-config.toml for custom annotations.",
+    dest="vcfanno_config",
+)
+P_annotations_compile.add_argument(
+    "--bundle",
+    action="store",
+    help="Write the annotation bundle to BUNDLE. Default: the bundle mity report uses, in "
+    "$XDG_CACHE_HOME/mity or ~/.cache/mity",
+    dest="bundle",
+)
+P_annotations_compile.set_defaults(func=_cmd_annotations_compile)
+
+
 # merge -----------------------------------------------------------------------
 
 
@@ -371,6 +1033,7 @@ def _cmd_merge(args):
         output_dir=args.output_dir,
         prefix=args.prefix,
         keep=args.keep,
+        output_type=args.output_type,
     )
 
 
@@ -393,6 +1056,14 @@ P_merge.add_argument(
     help="Output files will be named with PREFIX. "
     "The default is to use the nuclear vcf name",
 )
+P_merge.add_argument(
+    "--output-type",
+    choices=list(util.MityUtil.OUTPUT_TYPES),
+    default="vcf",
+    help="Write a bgzipped VCF with a TBI index, or a BCF with a CSI index. BCF is "
+    "faster for the next mity step to read. Default: vcf",
+    dest="output_type",
+)
 P_merge.add_argument(
     "--reference",
     choices=["hs37d5", "hg19", "hg38", "mm10"],
@@ -441,13 +1112,21 @@ def _cmd_runall(args):
         region=args.region,
         bam_list=args.bam_file_list,
         keep=args.keep,
+        threads=args.threads,
+        batch_size=args.batch_size,
+        cache_dir=args.cache_dir,
+        engine=args.engine,
+        stream=args.stream,
+        blacklist=args.blacklist,
+        output_type=args.output_type,
     )
 
     logging.debug("mity call and normalise completed")
 
     # This makes use of the uniform naming scheme of mity command outputs.
     normalised_vcf_path = os.path.join(
-        args.output_dir, args.prefix + ".normalise.vcf.gz"
+        args.output_dir,
+        args.prefix + ".normalise" + util.MityUtil.OUTPUT_TYPES[args.output_type],
     )
 
     logging.debug("assumed mity normalise vcf output path is: %s", normalised_vcf_path)
@@ -467,6 +1146,10 @@ def _cmd_runall(args):
         vcfanno_config=args.vcfanno_config,
         report_config=args.report_config,
         output_annotated_vcf=args.output_annotated_vcf,
+        annotator=args.annotator,
+        annotation_bundle=args.annotation_bundle,
+        annotation_cache=args.annotation_cache,
+        annotation_cache_size=args.annotation_cache_size,
     )
 
 
@@ -495,6 +1178,14 @@ P_runall.add_argument(
     required=True,
     help="Output files will be named with PREFIX",
 )
+P_runall.add_argument(
+    "--output-type",
+    choices=list(util.MityUtil.OUTPUT_TYPES),
+    default="vcf",
+    help="Write a bgzipped VCF with a TBI index, or a BCF with a CSI index. BCF is "
+    "faster for the next mity step to read. Default: vcf",
+    dest="output_type",
+)
 P_runall.add_argument(
     "--min-mapping-quality",
     action="store",
@@ -546,6 +1237,17 @@ P_runall.add_argument(
     "Default: 0.002, range = [0,1]",
     dest="p",
 )
+P_runall.add_argument(
+    "--blacklist",
+    action="store",
+    help="BED file of blacklisted mitochondrial regions. Variants overlapping a "
+    "region fail POS_filter. Default: MT:302-318 and MT:3105-3108",
+)
+P_runall.add_argument(
+    "--stream",
+    action="store_true",
+    help="Normalise variants as FreeBayes calls them, without writing intermediate files",
+)
 P_runall.add_argument(
     "--output-dir",
     action="store",
@@ -564,6 +1266,43 @@ P_runall.add_argument(
     "Default: Entire MT genome. ",
     dest="region",
 )
+P_runall.add_argument(
+    "--engine",
+    choices=["freebayes", "pileup"],
+    default="freebayes",
+    help="Variant calling engine. 'pileup' counts alleles per position with NumPy, "
+    "which is much faster at high depth but only calls SNVs. Default: freebayes",
+    dest="engine",
+)
+P_runall.add_argument(
+    "--threads",
+    action="store",
+    type=int,
+    default=1,
+    help="Number of FreeBayes processes to run in parallel. If greater than 1, the "
+    "region is split into overlapping tiles which are called in parallel and stitched "
+    "back together. Also the number of mity normalise processes. Default: 1",
+    dest="threads",
+)
+P_runall.add_argument(
+    "--batch-size",
+    action="store",
+    type=int,
+    default=None,
+    help="Call the samples in batches of BATCH_SIZE and combine the batches into one "
+    "multi-sample VCF. Batches are called in parallel using --threads processes. "
+    "Recommended for large --bam-file-list cohorts. Default: call all samples together",
+    dest="batch_size",
+)
+P_runall.add_argument(
+    "--cache-dir",
+    action="store",
+    type=str,
+    default=None,
+    help="Extract the MT reads of each BAM / CRAM file into CACHE_DIR (see mity extract) "
+    "and call variants from the cached reads. Default: call from the input files",
+    dest="cache_dir",
+)
 P_runall.add_argument(
     "--bam-file-list",
     action="store_true",
@@ -600,6 +1339,40 @@ P_runall.add_argument(
     help="Path to the custom annotations used for vcfanno. Only required if using custom annotations.",
     dest="vcfanno_base_path",
 )
+P_runall.add_argument(
+    "--annotator",
+    choices=["native", "vcfanno"],
+    default="native",
+    help="Annotation engine. 'native' annotates the variants in memory from an annotation "
+    "bundle of the sources of the vcfanno config, and supports the 'self' op. 'vcfanno' "
+    "runs the vcfanno binary. Default: native",
+    dest="annotator",
+)
+P_runall.add_argument(
+    "--annotation-bundle",
+    action="store",
+    help="Annotation bundle of the native annotator, see mity annotations compile. It is "
+    "compiled again if the vcfanno config or any annotation source has changed. "
+    "Default: a bundle in $XDG_CACHE_HOME/mity or ~/.cache/mity",
+    dest="annotation_bundle",
+)
+P_runall.add_argument(
+    "--annotation-cache",
+    action="store",
+    help="SQLite cache of the annotations of the variants of earlier reports, which are "
+    "not annotated again. Default: $XDG_CACHE_HOME/mity/annotations.sqlite or "
+    "~/.cache/mity/annotations.sqlite",
+    dest="annotation_cache",
+)
+P_runall.add_argument(
+    "--annotation-cache-size",
+    action="store",
+    type=int,
+    default=1000000,
+    help="The number of variants to keep in the annotation cache. The least recently "
+    "used variants are evicted. 0 disables the cache. Default: 1000000",
+    dest="annotation_cache_size",
+)
 P_runall.add_argument(
     "--custom-vcfanno-config",
     action="store",
@@ -0,0 +1,166 @@
+"""Extract mitochondrial reads from BAM / CRAM files into a local cache."""
+
+import hashlib
+import json
+import logging
+import os.path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+import pysam
+
+from mitylib.util import MityUtil
+
+logger = logging.getLogger(__name__)
+
+
+class Extract:
+    """
+    Mity extract.
+
+    Copies the MT / chrM reads of each input BAM / CRAM into a small sorted and
+    indexed BAM in a cache directory, together with a summary of the input
+    header. Cache entries are keyed by the input path, size and modification
+    time, so re-runs on unchanged inputs read the cached BAM instead of the
+    original file. Remote (http / https) inputs are not cached, since their
+    URL does not change with their contents; they are read in place.
+    """
+
+    def __init__(
+        self,
+        debug,
+        files,
+        cache_dir=None,
+        reference=None,
+        bam_list=False,
+        threads=1,
+    ):
+        self.debug = debug
+        self.files = files[0]
+        self.cache_dir = cache_dir
+        self.reference = reference
+        self.bam_list = bam_list
+        self.threads = threads
+
+        self.extracted_files: List[str] = []
+        self.summaries: Dict[str, Dict[str, Any]] = {}
+
+        self.run()
+
+    def run(self):
+        """
+        Run mity extract.
+        """
+        if self.debug:
+            logger.setLevel(logging.DEBUG)
+            logger.debug("Entered debug mode.")
+        else:
+            logger.setLevel(logging.INFO)
+
+        if self.bam_list:
+            with open(self.files[0], "r") as f:
+                self.files = f.read().splitlines()
+
+        if self.cache_dir is None:
+            self.cache_dir = MityUtil.get_cache_dir()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        with ThreadPoolExecutor(max_workers=max(self.threads, 1)) as executor:
+            summaries = list(executor.map(self.extract, self.files))
+
+        for summary in summaries:
+            self.extracted_files.append(summary["bam"])
+            self.summaries[summary["bam"]] = summary
+
+    @staticmethod
+    def is_remote(file_name: str) -> bool:
+        """
+        Whether a file is read over http / https.
+        """
+        return file_name.lower().startswith(("http://", "https://"))
+
+    def get_cache_key(self, file_name: str) -> str:
+        """
+        Make a cache key from the path, size and modification time of a local
+        file.
+        """
+        stat = os.stat(file_name)
+        key = f"{os.path.abspath(file_name)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def make_summary(file_name: str, bam_path: str, header: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Summarise the mitochondrial contig and read groups of a BAM / CRAM
+        header.
+
+        Parameters:
+            file_name (str): The input file.
+            bam_path (str): The file to call variants from.
+            header (dict): The header of the input file, as a dict.
+
+        Returns:
+            dict: The header summary.
+        """
+        contig_lengths = {str(record["SN"]): record["LN"] for record in header["SQ"]}
+        mito_contig_intersection = {"MT", "chrM"}.intersection(contig_lengths)
+
+        assert len(mito_contig_intersection) == 1
+        mito_contig = "".join(mito_contig_intersection)
+
+        return {
+            "input": file_name,
+            "bam": bam_path,
+            "mt_contig": [mito_contig, contig_lengths[mito_contig]],
+            "has_rg": len(header.get("RG", [])) > 0,
+            "samples": [record.get("SM") for record in header.get("RG", [])],
+        }
+
+    def extract(self, file_name: str) -> Dict[str, Any]:
+        """
+        Extract the mitochondrial reads of one BAM / CRAM file, unless they are
+        already in the cache.
+
+        Returns:
+            dict: The header summary of the file, which includes the path to
+            the cached BAM.
+        """
+        if self.is_remote(file_name):
+            logger.info("Not caching remote file %s", file_name)
+            with pysam.AlignmentFile(file_name, reference_filename=self.reference) as alignments:
+                return self.make_summary(file_name, file_name, alignments.header.to_dict())
+
+        key = self.get_cache_key(file_name)
+        bam_path = os.path.join(self.cache_dir, key + ".mt.bam")
+        summary_path = os.path.join(self.cache_dir, key + ".json")
+
+        if all(map(os.path.exists, [bam_path, bam_path + ".bai", summary_path])):
+            logger.debug("Using cached mitochondrial reads for %s", file_name)
+            with open(summary_path, "r", encoding="utf-8") as summary_file:
+                return json.load(summary_file)
+
+        logger.info("Extracting mitochondrial reads from %s", file_name)
+
+        # other processes may share the cache dir, so write to files of our own
+        # and move them into place once they are complete
+        tmp_bam_path = f"{bam_path}.{os.getpid()}.tmp"
+        with pysam.AlignmentFile(file_name, reference_filename=self.reference) as alignments:
+            summary = self.make_summary(file_name, bam_path, alignments.header.to_dict())
+            mito_contig = summary["mt_contig"][0]
+
+            with pysam.AlignmentFile(tmp_bam_path, "wb", header=alignments.header) as mt_bam:
+                for read in alignments.fetch(mito_contig):
+                    mt_bam.write(read)
+
+        # the reads are fetched in coordinate order, so the BAM only needs indexing
+        pysam.index(tmp_bam_path, tmp_bam_path + ".bai")
+        os.replace(tmp_bam_path + ".bai", bam_path + ".bai")
+        os.replace(tmp_bam_path, bam_path)
+
+        tmp_summary_path = f"{summary_path}.{os.getpid()}.tmp"
+        with open(tmp_summary_path, "w", encoding="utf-8") as summary_file:
+            json.dump(summary, summary_file)
+        os.replace(tmp_summary_path, summary_path)
+
+        return summary
@@ -7,10 +7,8 @@ Combines a nuclear VCF with MITY by adding MITY MT variants.
 import logging
 import os.path
 import sys
-import gzip
 import pysam
-import pysam.bcftools
-from mitylib.util import MityUtil
+from mitylib.util import MityUtil, SortedVcfWriter
 
 
 logger = logging.getLogger(__name__)
@@ -19,6 +17,12 @@ logger = logging.getLogger(__name__)
 class Merge:
     """
     Combines a nuclear VCF with a MITY VCF
+
+    The nuclear VCF is streamed once. Its MT / chrM variants are dropped, and
+    the mity variants are spliced in where the mitochondrial contig comes in
+    the contig order of the nuclear header, so the merged VCF is written
+    sorted, bgzipped and indexed without bcftools isec, bcftools concat or a
+    sort of the whole genome.
     """
 
     def __init__(
@@ -30,20 +34,20 @@ class Merge:
         output_dir=".",
         prefix=None,
         keep=False,
+        output_type="vcf",
     ):
         self.debug = debug
         self.nuclear_vcf_path = nuclear_vcf_path
         self.mity_vcf_path = mity_vcf_path
         self.genome = genome
 
-        self.bcftools_isec_path = ""
-        self.bcftools_concat_path = ""
         self.merged_sorted_vcf_path = ""
-        self.merged_unsorted_vcf_path = ""
+        self.num_dropped = 0
 
         self.output_dir = output_dir
         self.prefix = prefix
         self.keep = keep
+        self.output_type = output_type
 
         self.run()
 
@@ -60,13 +64,7 @@ class Merge:
 
         self.run_checks()
         self.set_strings()
-        self.run_bcftools_isec()
-        self.run_bcftools_concat()
         self.write_merged()
-        MityUtil.gsort(
-            self.merged_unsorted_vcf_path, self.merged_sorted_vcf_path, self.genome
-        )
-        self.remove_intermediate_files()
 
     def run_checks(self):
         """
@@ -81,139 +79,66 @@ class Merge:
             logger.error("The VCF files use mitochondrial contigs.")
             sys.exit()
 
+        with pysam.VariantFile(self.nuclear_vcf_path) as vcf:
+            nuclear_samples = list(vcf.header.samples)
+        with pysam.VariantFile(self.mity_vcf_path) as vcf:
+            mity_samples = list(vcf.header.samples)
+
+        if nuclear_samples != mity_samples:
+            raise ValueError(
+                "The nuclear and mity VCFs must have the same samples, in the same order"
+            )
+
     def set_strings(self):
         """
         Sets:
-            - bcftools_isec_path
-            - bcftools_concat_path
-            - merged_unsorted_vcf_path
             - merged_sorted_vcf_path
         """
         if self.prefix is None:
             self.prefix = MityUtil.make_prefix(self.mity_vcf_path)
 
-        self.bcftools_isec_path = os.path.join(self.output_dir, "0000.vcf")
-        self.bcftools_concat_path = os.path.join(
-            self.output_dir, self.prefix + ".bcftools.concat.vcf"
-        )
-
-        self.merged_unsorted_vcf_path = os.path.join(
-            self.output_dir, self.prefix + ".mity.merge.unsorted.vcf"
-        )
         self.merged_sorted_vcf_path = os.path.join(
-            self.output_dir, self.prefix + ".mity.merge.vcf.gz"
+            self.output_dir,
+            self.prefix + ".mity.merge" + MityUtil.OUTPUT_TYPES[self.output_type],
         )
 
-    def run_bcftools_isec(self):
-        """
-        Run bcftools isec
-        """
-
-        with open(self.bcftools_isec_path, "w", encoding="utf-8") as file:
-            print(
-                pysam.bcftools.isec(
-                    "-p",
-                    self.output_dir,
-                    "-C",
-                    self.nuclear_vcf_path,
-                    self.mity_vcf_path,
-                ),
-                end="",
-                file=file,
-            )
-
-    def run_bcftools_concat(self):
-        """
-        Run bcftools concat
-        """
-
-        with open(self.bcftools_concat_path, "w", encoding="utf-8") as file:
-            print(
-                pysam.bcftools.concat(self.bcftools_isec_path, self.mity_vcf_path),
-                end="",
-                file=file,
-            )
-
     def merge_description(self, nuclear_description: str, mity_description: str):
         """
         Merge nuclear and mity header description.
         """
         return f"If CHR=MT OR CHR=chrM: {mity_description}, otherwise: {nuclear_description}"
 
-    def get_header_line_nums(self):
+    def get_mity_header_lines(self):
         """
-        Returns a dictionary with key value pairs of ID : current position.
+        Returns a dictionary of the INFO and FORMAT header lines of the mity
+        vcf, by section and ID.
 
         E.g.
         ##FORMAT=<ID=AD,Number=.,Type=Integer,Description="Allelic depths ...">
-        ##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Approximate rea...">
-        ##FORMAT=<ID=GQ,Number=1,Type=Integer,Description="Genotype Quality">
-        ##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
-
         ##INFO=<ID=AC,Number=A,Type=Integer,Description="Allele count in g...">
-        ##INFO=<ID=AF,Number=A,Type=Float,Description="Allele Frequency, f...">
-        ##INFO=<ID=AN,Number=1,Type=Integer,Description="Total number of a...">
-        ##INFO=<ID=BaseQRankSum,Number=1,Type=Float,Description="Z-score f...">
-
 
         Gives the dictionary:
         dict = {
             FORMAT: {
-                AD: 0,      # this represents the line starting from 0 bytes
-                DP: 80,     # this line starts from 80 bytes
-                GQ: 160,
-                GT: ...
+                AD: '##FORMAT=<ID=AD,Number=.,Type=Integer,Description="Allelic depths ...">',
             },
             INFO: {
-                AC: ...,
-                AF: ...,
-                AN: ...,
-                BaseQRankSum: ...
+                AC: '##INFO=<ID=AC,Number=A,Type=Integer,Description="Allele count in g...">',
             }
         }
 
-        This is then used to file.seek later. Note that this is a workaround to
-        reduce memory footprint (it only stores position), but also give
-        O(n + m) performance instead of O(nm) if we simply loop over each file
-        from the beginning each time.
+        The header is read once with pysam, so the mity vcf can be a vcf or a
+        bcf.
         """
 
-        line_nums = {"FORMAT": {}, "INFO": {}}
-
-        with gzip.open(self.mity_vcf_path, "rt") as file:
-            position = 0
-            file.seek(0)
-
-            while True:
-                position = file.tell()
-
-                line = file.readline()
-
-                if not line:
-                    break
-
-                if not line.startswith("##"):
-                    break
-
-                if line.startswith("##FORMAT") or line.startswith("##INFO"):
-                    section, field_id = self.get_header_line_info(line)
-                    line_nums[section][field_id] = position
-
-        return line_nums
-
-    def get_header_line_info(self, line: str):
-        """
-        Get section (INFO/FORMAT) and ID of a header line.
-        """
-        if line.startswith("##FORMAT"):
-            section = "FORMAT"
-        else:
-            section = "INFO"
+        header_lines = {"FORMAT": {}, "INFO": {}}
 
-        line = line.split(",")[0]
-        field_id = line.split("=")[-1]
+        with pysam.VariantFile(self.mity_vcf_path) as vcf:
+            for record in vcf.header.records:
+                if record.type in header_lines:
+                    header_lines[record.type][record["ID"]] = str(record).rstrip("\n")
 
-        return section, field_id
+        return header_lines
 
     def get_header_description(self, line: str):
         """
@@ -224,14 +149,10 @@ class Merge:
 
         return line.split("Description=")[1].strip('>" ')
 
-    def make_new_line(self, nuclear_line, mity_file_line_num):
+    def make_new_line(self, nuclear_line, mity_line):
         """
         Makes an updated line with merged description.
         """
-        with gzip.open(self.mity_vcf_path, "rt") as file:
-            file.seek(mity_file_line_num)
-            mity_line = file.readline()
-
         mity_line = mity_line.strip("\n")
         nuclear_line = nuclear_line.strip("\n")
 
@@ -245,42 +166,237 @@ class Merge:
 
         return new_line
 
+    def get_header_record_key(self, record: pysam.VariantHeaderRecord):
+        """
+        Get the key that identifies a header record when merging headers: the
+        type and ID of records with an ID, e.g. ('INFO', 'DP'), or else the
+        whole line. There is only one ##fileformat line.
+        """
+        if "ID" in record:
+            return record.type, record["ID"]
+        # pysam writes its own ##fileformat line
+        if record.key == "fileformat":
+            return record.type, record.key
+        return record.type, str(record)
+
+    def get_merged_header(self) -> pysam.VariantHeader:
+        """
+        Returns the header of the nuclear vcf, with updated descriptions for the
+        INFO and FORMAT fields in both vcfs, followed by the records of the mity
+        header that are not in the nuclear header, as bcftools concat merges
+        headers. The merged descriptions are made from a single map of the
+        mity INFO and FORMAT lines, see get_mity_header_lines.
+        """
+        header_dict = self.get_mity_header_lines()
+
+        header = pysam.VariantHeader()
+        keys = {self.get_header_record_key(record) for record in header.records}
+
+        with (
+            pysam.VariantFile(self.nuclear_vcf_path) as nuclear_vcf,
+            pysam.VariantFile(self.mity_vcf_path) as mity_vcf,
+        ):
+            for record in nuclear_vcf.header.records:
+                key = self.get_header_record_key(record)
+                if key in keys:
+                    continue
+                keys.add(key)
+
+                line = str(record).rstrip("\n")
+                if record.type in header_dict and record["ID"] in header_dict[record.type]:
+                    line = self.make_new_line(line, header_dict[record.type][record["ID"]])
+                header.add_line(line.rstrip("\n"))
+
+            for record in mity_vcf.header.records:
+                key = self.get_header_record_key(record)
+                if key not in keys:
+                    keys.add(key)
+                    header.add_record(record)
+
+            for sample in nuclear_vcf.header.samples:
+                header.add_sample(sample)
+
+        return header
+
+    def get_contig_order(self):
+        """
+        Returns the contigs in the order of the nuclear header, followed by any
+        other contigs of the genome file.
+        """
+        with pysam.VariantFile(self.nuclear_vcf_path) as vcf:
+            contigs = list(vcf.header.contigs)
+        return contigs + [
+            contig for contig in MityUtil.get_genome_contigs(self.genome) if contig not in contigs
+        ]
+
     def write_merged(self):
         """
         Make a new file with updated headers and add variants.
+
+        If the nuclear vcf is bgzipped and indexed, and the merged vcf is a vcf,
+        the BGZF blocks of the nuclear variants are copied, see copy_merged.
+        Otherwise each variant is parsed, see stream_merged.
+        """
+        offsets = self.get_nuclear_offsets()
+        if offsets is None:
+            self.stream_merged()
+        else:
+            self.copy_merged(*offsets)
+
+    def get_nuclear_offsets(self):
+        """
+        Find the BGZF virtual offsets of the nuclear variants from the TBI or CSI
+        index of the nuclear vcf.
+
+        Returns:
+            - tuple: The virtual offsets of the first variant, the first
+              mitochondrial variant, the first variant after the mitochondrial
+              contig and the end of the variants. None if the blocks can not be
+              copied, e.g. the nuclear vcf is not indexed, or its contigs are not
+              in the order of the nuclear header.
+        """
+        if self.output_type != "vcf" or not self.nuclear_vcf_path.endswith(".gz"):
+            return None
+
+        index_paths = [
+            self.nuclear_vcf_path + ext
+            for ext in (".tbi", ".csi")
+            if os.path.exists(self.nuclear_vcf_path + ext)
+            and os.path.getmtime(self.nuclear_vcf_path + ext)
+            >= os.path.getmtime(self.nuclear_vcf_path)
+        ]
+        if not index_paths:
+            return None
+        offsets = MityUtil.read_index_offsets(index_paths[0])
+        if not offsets:
+            return None
+
+        contig_index = {contig: i for i, contig in enumerate(self.get_contig_order())}
+        mt_contig, _ = MityUtil.vcf_get_mt_contig(self.nuclear_vcf_path)
+        mt_index = contig_index[mt_contig]
+
+        # -1 for the contigs before the mitochondrial contig, 1 for those after
+        file_order = sorted(offsets, key=lambda contig: offsets[contig][0])
+        sides = []
+        for contig in file_order:
+            index = contig_index.get(contig, len(contig_index))
+            sides.append((index > mt_index) - (index < mt_index))
+        if sides != sorted(sides):
+            return None
+
+        records_begin = offsets[file_order[0]][0]
+        records_end = max(end for _, end in offsets.values())
+        after = [contig for contig, side in zip(file_order, sides) if side > 0]
+        if mt_contig in offsets:
+            mt_begin, mt_end = offsets[mt_contig]
+        else:
+            mt_begin = mt_end = offsets[after[0]][0] if after else records_end
+
+        return records_begin, mt_begin, mt_end, records_end
+
+    def copy_merged(self, records_begin, mt_begin, mt_end, records_end):
+        """
+        Make a new file with updated headers and add variants, copying the
+        compressed BGZF blocks of the nuclear variants byte for byte. Only the
+        header, the mity variants and the blocks at either side of the
+        mitochondrial contig are compressed again.
+
+        Parameters:
+            - The virtual offsets returned by get_nuclear_offsets.
         """
+        # copying the header formats it in the same way as pysam writes it
+        header = str(self.get_merged_header().copy()).encode()
+        mity_variants = "".join(MityUtil.read_vcf_lines(self.mity_vcf_path)).encode()
+
+        with (
+            open(self.nuclear_vcf_path, "rb") as nuclear_file,
+            open(self.merged_sorted_vcf_path, "wb") as merged_file,
+        ):
+            pending = self.copy_blocks(nuclear_file, merged_file, records_begin, mt_begin, header)
+            self.num_dropped = MityUtil.read_bgzf_range(nuclear_file, mt_begin, mt_end).count(b"\n")
+            pending = self.copy_blocks(
+                nuclear_file, merged_file, mt_end, records_end, pending + mity_variants
+            )
+            merged_file.write(MityUtil.bgzf_compress(pending))
+            merged_file.write(MityUtil.BGZF_EOF)
 
-        header_dict = self.get_header_line_nums()
-
-        with open(self.merged_unsorted_vcf_path, "w", encoding="utf-8") as merged_file:
-            with open(self.bcftools_concat_path, "r") as concat_file:
-                for line in concat_file:
-                    if line.startswith("##FORMAT") or line.startswith("##INFO"):
-                        section, field_id = self.get_header_line_info(line)
-                        if field_id in header_dict[section]:
-                            new_line = self.make_new_line(
-                                line, header_dict[section][field_id]
-                            )
-                            merged_file.write(new_line)
-                        else:
-                            merged_file.write(line)
-                    else:
-                        merged_file.write(line)
-
-    def remove_intermediate_files(self):
-        """
-        Removes extra files from bcftools isec:
-            README.txt
-            sites.txt
-
-        Optionally removes:
-            bcftools.isec file
-            bcftools.concat file
-        """
-        os.remove(os.path.join(self.output_dir, "README.txt"))
-        os.remove(os.path.join(self.output_dir, "sites.txt"))
-
-        if not self.keep:
-            os.remove(self.merged_unsorted_vcf_path)
-            os.remove(self.bcftools_isec_path)
-            os.remove(self.bcftools_concat_path)
+        MityUtil.index_vcf(self.merged_sorted_vcf_path)
+        logger.debug("Dropped %s nuclear variants, copying the other blocks", self.num_dropped)
+
+    def copy_blocks(self, nuclear_file, merged_file, begin, end, pending):
+        """
+        Copy the nuclear variants between two virtual offsets. The BGZF blocks
+        that are wholly between the offsets are copied byte for byte.
+
+        Parameters:
+            - nuclear_file (file): The nuclear vcf, opened in binary mode.
+            - merged_file (file): The merged vcf, opened in binary mode.
+            - begin (int): The virtual offset of the first variant to copy.
+            - end (int): The virtual offset after the last variant to copy.
+            - pending (bytes): Uncompressed data to write before the variants.
+
+        Returns:
+            - bytes: The uncompressed data after the last whole block, which is
+              still to be written.
+        """
+        first_block = begin >> 16
+        last_block = end >> 16
+        if begin >= end or first_block == last_block:
+            return pending + MityUtil.read_bgzf_range(nuclear_file, begin, end)
+
+        block, block_size = MityUtil.read_bgzf_block(nuclear_file, first_block)
+        merged_file.write(MityUtil.bgzf_compress(pending + block[begin & 0xFFFF :]))
+
+        nuclear_file.seek(first_block + block_size)
+        remaining = last_block - first_block - block_size
+        while remaining > 0:
+            data = nuclear_file.read(min(remaining, 1 << 20))
+            if not data:
+                raise ValueError(f"{self.nuclear_vcf_path} is shorter than its index")
+            merged_file.write(data)
+            remaining -= len(data)
+
+        return MityUtil.read_bgzf_range(nuclear_file, last_block << 16, end)
+
+    def stream_merged(self):
+        """
+        Make a new file with updated headers and add variants, parsing every
+        nuclear variant.
+
+        The nuclear variants are copied in a single pass, apart from those on
+        the mitochondrial contig. The mity variants are written before the
+        first nuclear variant on a contig after the mitochondrial contig, or at
+        the end.
+        """
+        writer = SortedVcfWriter(
+            self.merged_sorted_vcf_path,
+            self.get_merged_header(),
+            window=0,
+            contig_order=self.get_contig_order(),
+        )
+        mt_contig, _ = MityUtil.vcf_get_mt_contig(self.nuclear_vcf_path)
+        mt_index = writer.contig_index[mt_contig]
+
+        spliced = False
+        for line in MityUtil.read_vcf_lines(self.nuclear_vcf_path):
+            contig_index, _ = writer.get_key(line)
+            if contig_index == mt_index:
+                self.num_dropped += 1
+                continue
+            if contig_index > mt_index and not spliced:
+                self.write_mity_variants(writer)
+                spliced = True
+            writer.write_line(line)
+
+        if not spliced:
+            self.write_mity_variants(writer)
+        writer.close()
+
+        logger.debug("Dropped %s nuclear %s variants", self.num_dropped, mt_contig)
+
+    def write_mity_variants(self, writer: SortedVcfWriter):
+        """
+        Write the variants of the mity vcf.
+        """
+        for line in MityUtil.read_vcf_lines(self.mity_vcf_path):
+            writer.write_line(line)
@@ -1,13 +1,15 @@
 """Normalise mity VCF."""
 
+import gzip
 import logging
 import os.path
+from concurrent.futures import ProcessPoolExecutor
 from math import isinf
 from scipy.stats import binom
 import numpy as np
 import pysam
 import pysam.bcftools
-from mitylib.util import MityUtil
+from mitylib.util import MityUtil, SortedVcfWriter
 
 
 # LOGGING
@@ -25,7 +27,25 @@ class Normalise:
     MIN_MQMR = 30
     MIN_AQR = 20
     MIN_DP = 15
-    BLACKLIST = list(range(302, 319)) + list(range(3105, 3109))
+    # the filter thresholds, which mity refilter can change
+    THRESHOLDS = ["MIN_DP", "SB_RANGE_LO", "SB_RANGE_HI", "MIN_MQMR", "MIN_AQR"]
+    # default blacklist regions, in the reference directory
+    BLACKLIST_BED = "mt_blacklist.bed"
+    ENGINES = ["record", "columnar"]
+    # number of samples x variants values in each block of the columnar engine
+    COLUMNAR_BLOCK_SIZE = 2**18
+    NEW_FORMAT_KEYS = [
+        "AQR",
+        "VAF",
+        "q",
+        "AQA",
+        "tier",
+        "POS_filter",
+        "SBR_filter",
+        "SBA_filter",
+        "MQMR_filter",
+        "AQR_filter",
+    ]
 
     def __init__(
         self,
@@ -38,6 +58,13 @@ class Normalise:
         allsamples=False,
         keep=False,
         p=P_VAL,
+        stream=None,
+        engine="record",
+        threads=1,
+        native_norm=False,
+        blacklist=None,
+        raw_format=False,
+        output_type="vcf",
     ):
         self.debug = debug
         self.vcf = vcf
@@ -48,12 +75,23 @@ class Normalise:
         self.allsamples = allsamples
         self.keep = keep
         self.p = p
+        self.stream = stream
+        self.engine = engine
+        self.threads = threads
+        self.native_norm = native_norm
+        self.blacklist = blacklist
+        self.raw_format = raw_format
+        self.output_type = output_type
 
         self.bcftools_norm_obj = None
-        self.filtered_vcf_obj = None
+        self.reference_fasta_obj = None
+        self.reference_sequences = {}
+
+        self.mt_contig = None
+        self.blacklist_regions = []
+        self.blacklist_counts = None
 
         self.bcftools_norm_path = ""
-        self.filtered_vcf_path = ""
         self.normalised_vcf_path = ""
 
         self.run()
@@ -69,62 +107,718 @@ class Normalise:
             logger.setLevel(logging.INFO)
 
         self.set_strings()
-        self.run_bcftools_norm()
-        self.run_filtering()
+        self.load_blacklist()
+
+        if self.stream is not None or self.native_norm:
+            self.reference_fasta_obj = pysam.FastaFile(self.reference_fasta)
 
-        MityUtil.gsort(self.filtered_vcf_path, self.normalised_vcf_path, self.genome)
+        if self.stream is not None:
+            self.run_streaming()
+            return
+
+        if self.engine == "columnar" or self.threads > 1:
+            if self.native_norm:
+                self.run_native_norm()
+            else:
+                self.run_bcftools_norm()
+            self.run_filtering_columnar()
+        else:
+            if not self.native_norm:
+                self.run_bcftools_norm()
+            self.run_filtering()
+        logger.debug("Filtering finished, peak memory: %.1f MB", MityUtil.get_peak_memory())
 
         self.remove_intermediate_files()
 
+    def run_streaming(self):
+        """
+        Normalises and filters the variants of self.stream as they are read,
+        and writes them straight to the normalised vcf.
+
+        self.stream is an open pysam VariantFile, e.g. reading from the output
+        of freebayes. Multiallelic variants are split and trimmed in python
+        and left aligned in python instead of with bcftools norm, so no
+        intermediate files are written.
+        """
+        self.bcftools_norm_obj = self.stream
+        writer = self.make_writer(self.add_headers())
+
+        variants = (
+            split_variant
+            for variant in self.stream
+            for split_variant in self.split_multiallelic(variant)
+        )
+        self.write_variants(writer, variants)
+
+        writer.close()
+        logger.debug("Filtering finished, peak memory: %.1f MB", MityUtil.get_peak_memory())
+
+    def make_writer(self, header):
+        """
+        Makes a SortedVcfWriter for the normalised vcf, which sorts the contigs
+        in the order of the genome file.
+        """
+        contig_order = None
+        if self.genome is not None:
+            contig_order = MityUtil.get_genome_contigs(self.genome)
+        return SortedVcfWriter(self.normalised_vcf_path, header, contig_order=contig_order)
+
     def run_filtering(self):
         """
         Makes pysam VariantFile objects and runs filtering for each variant.
+        The filtered variants are written straight to the sorted, indexed
+        normalised vcf.
+
+        With native_norm, the input vcf is read directly, and each variant is
+        split and left aligned before it is filtered.
+        """
+        if self.native_norm:
+            self.bcftools_norm_obj = pysam.VariantFile(self.vcf)
+        else:
+            self.bcftools_norm_obj = pysam.VariantFile(self.bcftools_norm_path)
+        writer = self.make_writer(self.add_headers())
+
+        if self.native_norm:
+            variants = (
+                split_variant
+                for variant in self.bcftools_norm_obj
+                for split_variant in self.split_multiallelic(variant)
+            )
+        else:
+            variants = self.bcftools_norm_obj
+        self.write_variants(writer, variants)
+
+        self.bcftools_norm_obj.close()
+        writer.close()
+
+    def write_variants(self, writer, variants):
+        """
+        Filters variants and writes them to the normalised vcf.
+
+        Without raw_format, the new INFO and FORMAT values are set on each
+        variant through pysam. With raw_format, blocks of variants are written
+        out as text and the new values are added to the text as strings by the
+        columnar engine functions, which avoids pysam's header lookups and type
+        conversion for every value of every sample. Both give the same output.
+
+        Parameters:
+            - writer (SortedVcfWriter): The writer of the normalised vcf.
+            - variants (iterable): The normalised pysam VariantRecords.
+        """
+        if not self.raw_format:
+            for variant in variants:
+                variant = self.add_info_values(variant)
+                variant = self.add_filter(variant)
+                writer.write(variant)
+            return
+
+        num_samples = len(self.bcftools_norm_obj.header.samples)
+        block_size = max(1, self.COLUMNAR_BLOCK_SIZE // max(1, num_samples))
+        lines = (str(variant) for variant in variants)
+        for block in self.read_blocks(lines, block_size):
+            pos_flag = self.get_blacklist_flags(block)
+            sample_columns, failed = self.filter_samples(
+                block, self.p, pos_flag, self.get_thresholds()
+            )
+            for line in self.make_lines(block, [sample_columns], [failed], num_samples, pos_flag):
+                writer.write_line(line)
+
+    def run_filtering_columnar(self):
+        """
+        Runs filtering on blocks of about COLUMNAR_BLOCK_SIZE samples x
+        variants at a time.
+
+        The FORMAT values of each block are read into samples x variants numpy
+        arrays, the new FORMAT values and filters are calculated as array
+        expressions, and the block is written back out as text. This gives the
+        same output as run_filtering, but scales with the size of the arrays
+        instead of the number of samples, so is much faster for wide cohorts.
+
+        With more than one thread, the samples are split into one chunk per
+        thread and each chunk of each block is filtered in a worker process.
+        The workers return the number of samples failing each filter, which are
+        added up to decide PASS / FAIL for the variant.
         """
         self.bcftools_norm_obj = pysam.VariantFile(self.bcftools_norm_path)
-        self.filtered_vcf_obj = pysam.VariantFile(
-            self.filtered_vcf_path, "w", header=self.add_headers()
+        writer = self.make_writer(self.add_headers())
+        num_samples = len(self.bcftools_norm_obj.header.samples)
+        self.bcftools_norm_obj.close()
+
+        threads = max(1, min(self.threads, num_samples))
+        chunk_size = max(1, -(-num_samples // threads))
+        sample_chunks = [
+            (start, min(start + chunk_size, num_samples))
+            for start in range(0, num_samples, chunk_size)
+        ]
+        block_size = max(1, self.COLUMNAR_BLOCK_SIZE // chunk_size)
+
+        logger.debug(
+            "Filtering blocks of %s variants in %s sample chunks",
+            block_size,
+            len(sample_chunks),
         )
 
-        for variant in self.bcftools_norm_obj.fetch():
-            variant = self.add_info_values(variant)
-            variant = self.add_filter(variant)
+        with self.open_text(self.bcftools_norm_path) as vcf:
+            if threads == 1:
+                for block in self.read_blocks(vcf, block_size):
+                    pos_flag = self.get_blacklist_flags(block)
+                    sample_columns, failed = self.filter_samples(
+                        block, self.p, pos_flag, self.get_thresholds()
+                    )
+                    lines = self.make_lines(
+                        block, [sample_columns], [failed], num_samples, pos_flag
+                    )
+                    for line in lines:
+                        writer.write_line(line)
+                writer.close()
+                return
 
-            self.filtered_vcf_obj.write(variant)
+            with ProcessPoolExecutor(max_workers=threads) as executor:
+                # the next block is read while the workers filter the previous one
+                pending = None
+                for block in self.read_blocks(vcf, block_size):
+                    pos_flag = self.get_blacklist_flags(block)
+                    futures = [
+                        executor.submit(
+                            self.filter_samples,
+                            [fields[:9] + fields[9 + start : 9 + end] for fields in block],
+                            self.p,
+                            pos_flag,
+                            self.get_thresholds(),
+                        )
+                        for start, end in sample_chunks
+                    ]
+                    if pending is not None:
+                        for line in self.collect_block(*pending, num_samples):
+                            writer.write_line(line)
+                    pending = (block, pos_flag, futures)
+                if pending is not None:
+                    for line in self.collect_block(*pending, num_samples):
+                        writer.write_line(line)
+        writer.close()
 
-        self.bcftools_norm_obj.close()
-        self.filtered_vcf_obj.close()
+    def collect_block(self, block, pos_flag, futures, num_samples):
+        """
+        Waits for the sample chunks of a block to be filtered, and returns the
+        filtered vcf lines.
+        """
+        results = [future.result() for future in futures]
+        return self.make_lines(
+            block,
+            [sample_columns for sample_columns, _ in results],
+            [failed for _, failed in results],
+            num_samples,
+            pos_flag,
+        )
+
+    def get_thresholds(self):
+        """
+        Returns the filter thresholds as a dictionary, which is passed to
+        filter_samples in the worker processes.
+        """
+        return {name: getattr(self, name) for name in self.THRESHOLDS}
+
+    @staticmethod
+    def read_blocks(vcf, block_size):
+        """
+        Yields blocks of block_size variants from a vcf text file, as the tab
+        separated columns of each line.
+        """
+        block = []
+        for line in vcf:
+            if line.startswith("#"):
+                continue
+            block.append(line.rstrip("\n").split("\t"))
+            if len(block) == block_size:
+                yield block
+                block = []
+        if block:
+            yield block
+
+    @staticmethod
+    def open_text(path):
+        """
+        Opens a vcf as text, whether it is compressed or not.
+        """
+        with open(path, "rb") as f:
+            compressed = f.read(2) == b"\x1f\x8b"
+        if compressed:
+            return gzip.open(path, "rt")
+        return open(path, "r")
+
+    @staticmethod
+    def parse_sample_columns(fields):
+        """
+        Splits the sample columns of a vcf line into their FORMAT values.
+
+        Parameters:
+            - fields (list): The tab separated columns of the vcf line.
+
+        Returns:
+            - tuple: (samples, values), where samples are the sample columns,
+              padded with missing values to have every FORMAT key, and values is
+              a dictionary of the list of values of each FORMAT key.
+        """
+        keys = fields[8].split(":")
+        samples = fields[9:]
+        tokens = ":".join(samples).split(":")
+
+        if len(tokens) != len(samples) * len(keys):
+            # some samples have dropped trailing missing values
+            tokens = []
+            for i, sample in enumerate(samples):
+                sample_tokens = sample.split(":")
+                missing = len(keys) - len(sample_tokens)
+                if missing:
+                    sample_tokens += ["."] * missing
+                    samples[i] = ":".join(sample_tokens)
+                tokens += sample_tokens
+
+        values = {key: tokens[i :: len(keys)] for i, key in enumerate(keys)}
+        return samples, values
+
+    @staticmethod
+    def parse_integers(values):
+        """
+        Converts a list of integer strings to a numpy array, with missing
+        values as 0.
+        """
+        try:
+            return np.fromiter(map(int, values), dtype=np.int64, count=len(values))
+        except ValueError:
+            return np.array([0 if value == "." else int(value) for value in values])
+
+    @staticmethod
+    def format_floats(values):
+        """
+        Formats an array of floats as vcf strings, in the same way as pysam.
+        Each distinct value is only formatted once.
+        """
+        unique, inverse = np.unique(values.astype(np.float32), return_inverse=True)
+        strings = np.array(["%g" % value for value in unique], dtype=object)
+        return strings[inverse.reshape(values.shape)]
+
+    @staticmethod
+    def get_info_values(fields):
+        """
+        Returns the SBR, SBA and MQMR of a variant from the columns of its vcf line.
+        """
+        info = dict(
+            item.split("=", 1) if "=" in item else (item, None) for item in fields[7].split(";")
+        )
+        SBR, SBA = Normalise.calculate_strand_bias(
+            int(info["SRF"]),
+            int(info["SRR"]),
+            int(info["SAF"].split(",")[0]),
+            int(info["SAR"].split(",")[0]),
+        )
+        return SBR, SBA, float(info["MQMR"])
+
+    @classmethod
+    def filter_samples(cls, block, p, pos_flag, thresholds):
+        """
+        Adds the FORMAT values and filters to the samples of a block of
+        variants. The block can have all of the samples or a chunk of them.
+
+        Parameters:
+            - block (list): The tab separated columns of each vcf line.
+            - p (float): Minimum noise level, used to calculate q.
+            - pos_flag (array): False for the variants that overlap the blacklist.
+            - thresholds (dict): The filter thresholds, from get_thresholds.
+
+        Returns:
+            - tuple: (sample_columns, failed), where sample_columns are the tab
+              separated sample columns of each variant, and failed is a
+              dictionary of the number of samples that fail each filter for
+              each variant.
+        """
+        samples = []
+        columns = {key: [] for key in ["RO", "QR", "AO", "QA", "DP"]}
+        for fields in block:
+            record_samples, values = cls.parse_sample_columns(fields)
+            samples.append(record_samples)
+            for key, column in columns.items():
+                column.append(values[key])
+
+        # samples x variants arrays, missing values are counted as 0
+        arrays = {
+            key: np.array([cls.parse_integers(values) for values in column]).T
+            for key, column in columns.items()
+        }
+
+        values = cls.sample_values(p=p, **arrays)
+
+        SBR, SBA, MQMR = np.array([cls.get_info_values(fields) for fields in block]).T
+
+        # filters that fail for each sample, as in add_filter
+        sb_range_lo = thresholds["SB_RANGE_LO"]
+        sb_range_hi = thresholds["SB_RANGE_HI"]
+        RO_tested = arrays["RO"] > thresholds["MIN_DP"]
+        failed = {
+            "SBR": RO_tested & ~((sb_range_lo <= SBR) & (SBR <= sb_range_hi)),
+            "MQMR": RO_tested & (MQMR < thresholds["MIN_MQMR"]),
+            "AQR": RO_tested & (values["AQR"] < thresholds["MIN_AQR"]),
+            "SBA": (arrays["AO"] > thresholds["MIN_DP"])
+            & ~((sb_range_lo <= SBA) & (SBA <= sb_range_hi)),
+        }
+
+        flag_strings = np.array(["0", "1"], dtype=object)
+        tier_strings = np.array(["0", "1", "2", "3"], dtype=object)
+        new_format = [
+            cls.format_floats(values["AQR"]),
+            cls.format_floats(values["VAF"]),
+            cls.format_floats(values["q"]),
+            cls.format_floats(values["AQA"]),
+            tier_strings[values["tier"]],
+            np.broadcast_to(flag_strings[pos_flag.astype(int)], values["tier"].shape),
+            flag_strings[(~failed["SBR"]).astype(int)],
+            flag_strings[(~failed["SBA"]).astype(int)],
+            flag_strings[(~failed["MQMR"]).astype(int)],
+            flag_strings[(~failed["AQR"]).astype(int)],
+        ]
+
+        sample_columns = []
+        for i in range(len(block)):
+            new_samples = map(
+                ":".join, zip(samples[i], *(column[:, i].tolist() for column in new_format))
+            )
+            sample_columns.append("\t".join(new_samples))
+
+        failed_counts = {key: value.sum(axis=0) for key, value in failed.items()}
+        return sample_columns, failed_counts
+
+    def make_lines(self, block, sample_columns, failed, num_samples, pos_flag):
+        """
+        Makes the filtered vcf lines of a block of variants.
+
+        Parameters:
+            - block (list): The tab separated columns of each vcf line.
+            - sample_columns (list): The sample columns from filter_samples for
+              each chunk of samples.
+            - failed (list): The failed counts from filter_samples for each chunk
+              of samples.
+            - num_samples (int): The total number of samples.
+            - pos_flag (array): False for the variants that overlap the blacklist.
+
+        Returns:
+            - list: The filtered vcf lines.
+        """
+        pass_flag = pos_flag.copy()
+        for key in failed[0]:
+            num_failed = sum(chunk_failed[key] for chunk_failed in failed)
+            if self.allsamples:
+                # all samples must pass each test
+                pass_flag &= num_failed == 0
+            else:
+                # only one sample has to pass each test
+                pass_flag &= num_failed < num_samples
+
+        lines = []
+        for i, fields in enumerate(block):
+            filter_value = "PASS" if pass_flag[i] else "FAIL"
+            if fields[6] not in (".", filter_value):
+                filter_value = fields[6] + ";" + filter_value
+
+            SBR, SBA, _ = self.get_info_values(fields)
+            info = "SBR=%g;SBA=%g" % (SBR, SBA)
+            if fields[7] != ".":
+                info = fields[7] + ";" + info
+
+            fixed = fields[:6] + [
+                filter_value,
+                info,
+                fields[8] + ":" + ":".join(self.NEW_FORMAT_KEYS),
+            ]
+            columns = [chunk_columns[i] for chunk_columns in sample_columns]
+            lines.append("\t".join(fixed + [column for column in columns if column]) + "\n")
+
+        return lines
+
+    def run_native_norm(self):
+        """
+        Splits and left aligns the variants in python, and writes them to
+        bcftools_norm_path, in place of run_bcftools_norm.
+        """
+        with pysam.VariantFile(self.vcf) as vcf:
+            writer = SortedVcfWriter(self.bcftools_norm_path, vcf.header)
+            for variant in vcf:
+                for split_variant in self.split_multiallelic(variant):
+                    writer.write(split_variant)
+            writer.close()
 
     def run_bcftools_norm(self):
         """
         Run bcftools norm.
         """
-        # The "-o" option doesn't get passed to pysam's bcftools wrapper (as of 31-08-2023)
-        # so we write to a separate file manually.
-        with open(self.bcftools_norm_path, "w") as f:
-            print(
-                pysam.bcftools.norm("-f", self.reference_fasta, "-m-both", self.vcf),
-                end="",
-                file=f,
-            )
+        # bcftools writes the bgzipped output itself, so the normalised vcf is
+        # never held in python. pysam only passes "-o" on with catch_stdout=False.
+        pysam.bcftools.norm(
+            "-f",
+            self.reference_fasta,
+            "-m-both",
+            "--threads",
+            str(self.threads),
+            "-Ob" if MityUtil.is_bcf(self.bcftools_norm_path) else "-Oz",
+            "--write-index",
+            "-o",
+            self.bcftools_norm_path,
+            self.vcf,
+            catch_stdout=False,
+        )
+        logger.debug("bcftools norm finished, peak memory: %.1f MB", MityUtil.get_peak_memory())
 
     def set_strings(self):
         """
         Sets:
             prefix
             normalised_vcf
-            filtered_vcf
         """
         if self.prefix is None:
             self.prefix = MityUtil.make_prefix(self.vcf)
 
+        # the columnar engine reads the bcftools norm output as text, the
+        # record engine reads it with pysam, which is faster from a bcf
+        norm_type = "vcf"
+        if self.engine == "record" and self.threads == 1:
+            norm_type = self.output_type
         self.bcftools_norm_path = os.path.join(
-            self.output_dir, self.prefix + ".bcftools.norm.vcf.gz"
+            self.output_dir,
+            self.prefix + ".bcftools.norm" + MityUtil.OUTPUT_TYPES[norm_type],
         )
-        self.filtered_vcf_path = self.vcf.replace(".vcf.gz", ".filtered.vcf")
         self.normalised_vcf_path = os.path.join(
-            self.output_dir, self.prefix + ".normalise.vcf.gz"
+            self.output_dir,
+            self.prefix + ".normalise" + MityUtil.OUTPUT_TYPES[self.output_type],
         )
 
+        if self.blacklist is None:
+            self.blacklist = os.path.join(
+                MityUtil.get_mity_dir(), MityUtil.REF_DIR, self.BLACKLIST_BED
+            )
+
+    def load_blacklist(self):
+        """
+        Loads the blacklist bed file into a bitmap of the positions of the
+        mitochondrial contig, sized to the contig length in the vcf header.
+
+        The cumulative sum of the bitmap is kept, so whether any position of a
+        variant is blacklisted is a constant time lookup, e.g. for an indel
+        that starts before a blacklisted region and overlaps it.
+
+        Sets:
+            - mt_contig
+            - blacklist_regions: 1-based, inclusive (start, end) regions
+            - blacklist_counts: the number of blacklisted positions before
+              each position
+        """
+        vcf = self.stream if self.stream is not None else self.vcf
+        self.mt_contig, mt_length = MityUtil.vcf_get_mt_contig(vcf)
+
+        self.blacklist_regions = []
+        with open(self.blacklist, "r", encoding="utf-8") as bed:
+            for line in bed:
+                if not line.strip() or line.startswith(("#", "track", "browser")):
+                    continue
+                contig, start, end = line.split("\t")[:3]
+                if contig not in ("MT", "chrM"):
+                    logger.debug("Ignoring blacklist region on %s", contig)
+                    continue
+                # bed regions are 0-based and half open
+                self.blacklist_regions.append((int(start) + 1, int(end)))
+
+        size = max([mt_length or 0] + [end for _, end in self.blacklist_regions])
+        bitmap = np.zeros(size + 1, dtype=bool)
+        for start, end in self.blacklist_regions:
+            bitmap[start : end + 1] = True
+        self.blacklist_counts = np.concatenate([[0], np.cumsum(bitmap)])
+
+    def in_blacklist(self, contigs, starts, ends):
+        """
+        Checks whether variants overlap the blacklist.
+
+        Parameters:
+            - contigs (array): The contig of each variant.
+            - starts (array): The position of each variant.
+            - ends (array): The last reference position of each variant.
+
+        Returns:
+            - array: True for the variants that overlap a blacklisted region.
+        """
+        last = len(self.blacklist_counts) - 1
+        starts = np.minimum(np.asarray(starts), last)
+        ends = np.minimum(np.asarray(ends) + 1, last)
+        overlaps = self.blacklist_counts[ends] > self.blacklist_counts[starts]
+        return overlaps & (np.asarray(contigs) == self.mt_contig)
+
+    def get_blacklist_flags(self, block):
+        """
+        Returns True for the variants of a block of vcf lines that do not
+        overlap the blacklist.
+        """
+        contigs = [fields[0] for fields in block]
+        starts = np.array([int(fields[1]) for fields in block], dtype=np.int64)
+        ends = starts + np.array([len(fields[3]) for fields in block], dtype=np.int64) - 1
+        return ~self.in_blacklist(contigs, starts, ends)
+
+    @staticmethod
+    def trim_alleles(pos, ref, alt):
+        """
+        Removes bases shared by the end, then the start, of ref and alt, keeping
+        at least one base in each, in the same way as bcftools norm.
+
+        Returns:
+            - tuple: (pos, ref, alt) after trimming.
+        """
+        while len(ref) > 1 and len(alt) > 1 and ref[-1] == alt[-1]:
+            ref = ref[:-1]
+            alt = alt[:-1]
+        while len(ref) > 1 and len(alt) > 1 and ref[0] == alt[0]:
+            ref = ref[1:]
+            alt = alt[1:]
+            pos += 1
+        return pos, ref, alt
+
+    def get_reference_sequence(self, contig):
+        """
+        Returns the reference sequence of a contig, which is read from the
+        reference fasta once.
+        """
+        if contig not in self.reference_sequences:
+            self.reference_sequences[contig] = self.reference_fasta_obj.fetch(contig).upper()
+        return self.reference_sequences[contig]
+
+    def normalise_alleles(self, contig, pos, ref, alt):
+        """
+        Trims the alleles, and if a reference fasta is open, left aligns indels,
+        in the same way as bcftools norm -f.
+
+        Indels are left aligned by removing the last base while it is shared by
+        both alleles, moving one base left whenever an allele becomes empty,
+        then trimming shared bases from the start.
+
+        Returns:
+            - tuple: (pos, ref, alt) after normalising.
+        """
+        if self.reference_fasta_obj is None or alt == "*" or alt.startswith("<"):
+            return self.trim_alleles(pos, ref, alt)
+
+        sequence = self.get_reference_sequence(contig)
+        expected = sequence[pos - 1 : pos - 1 + len(ref)]
+        if ref.upper() != expected:
+            raise ValueError(
+                f"Reference allele mismatch at {contig}:{pos}: REF={ref}, reference={expected}"
+            )
+
+        if len(ref) == len(alt):
+            return self.trim_alleles(pos, ref, alt)
+
+        while True:
+            if ref and alt and ref[-1] == alt[-1]:
+                ref = ref[:-1]
+                alt = alt[:-1]
+            elif not ref or not alt:
+                if pos == 1:
+                    # nothing to the left, so add the next base instead
+                    base = sequence[len(ref)]
+                    ref += base
+                    alt += base
+                    break
+                pos -= 1
+                base = sequence[pos - 1]
+                ref = base + ref
+                alt = base + alt
+            else:
+                break
+
+        return self.trim_alleles(pos, ref, alt)
+
+    @staticmethod
+    def subset_allele_values(value, number, alt_index):
+        """
+        Select the values of a Number=A/R/G field for one alternate allele.
+
+        Parameters:
+            - value: The value of the field in the multiallelic variant.
+            - number: The Number of the field in the vcf header.
+            - alt_index (int): The index of the allele in variant.alts.
+
+        Returns:
+            - The value of the field in the biallelic variant.
+        """
+        if not isinstance(value, tuple):
+            return value
+        if number == "A":
+            return (value[alt_index],)
+        if number == "R":
+            return (value[0], value[alt_index + 1])
+        if number == "G":
+            # diploid genotype order: 0/0, 0/1, 1/1, 0/2, 1/2, 2/2, ...
+            allele = alt_index + 1
+            het = allele * (allele + 1) // 2
+            return (value[0], value[het], value[het + allele])
+        return value
+
+    def split_multiallelic(self, variant):
+        """
+        Splits a variant into one variant per alternate allele, and trims and
+        left aligns the alleles, like bcftools norm -m-both. In the split
+        variants, genotypes of the other alternate alleles are set to the
+        reference allele.
+
+        Parameters:
+            - variant (VariantRecord): Variant to split
+
+        Returns:
+            - list: The split variants
+        """
+        header = variant.header
+
+        if len(variant.alts) == 1:
+            pos, ref, alt = self.normalise_alleles(
+                variant.chrom, variant.pos, variant.ref, variant.alts[0]
+            )
+            if pos == variant.pos:
+                if ref != variant.ref:
+                    variant.alleles = (ref, alt)
+                return [variant]
+
+        split_variants = []
+        for alt_index, alt in enumerate(variant.alts):
+            pos, ref, alt = self.normalise_alleles(variant.chrom, variant.pos, variant.ref, alt)
+            split_variant = variant.copy()
+            split_variant.pos = pos
+            split_variant.alleles = (ref, alt)
+
+            if len(variant.alts) == 1:
+                split_variants.append(split_variant)
+                continue
+
+            # only the values for each allele need to be changed
+            for key, value in variant.info.items():
+                number = header.info[key].number
+                if number in ("A", "R", "G"):
+                    split_variant.info[key] = self.subset_allele_values(value, number, alt_index)
+
+            for name, sample in variant.samples.items():
+                split_sample = split_variant.samples[name]
+                for key, value in sample.items():
+                    if isinstance(value, tuple) and all(v is None for v in value):
+                        # missing values stay missing
+                        continue
+                    if key == "GT":
+                        split_sample[key] = tuple(
+                            None if allele is None else int(allele == alt_index + 1)
+                            for allele in value
+                        )
+                        split_sample.phased = sample.phased
+                    elif header.formats[key].number in ("A", "R", "G"):
+                        split_sample[key] = self.subset_allele_values(
+                            value, header.formats[key].number, alt_index
+                        )
+
+            split_variants.append(split_variant)
+
+        return split_variants
+
     def add_headers(self):
         """
         Return new headers for mity normalise vcf output.
@@ -190,7 +884,8 @@ class Normalise:
             "POS_filter",
             number="A",
             type="Integer",
-            description="Variant falls in the blacklist of positions: MT:302-319, MT:3105-3108",
+            description="Variant overlaps the blacklist of positions: "
+            + ", ".join(f"{self.mt_contig}:{start}-{end}" for start, end in self.blacklist_regions),
         )
         new_header.formats.add(
             "SBR_filter",
@@ -247,6 +942,89 @@ class Normalise:
             q = float(3220)
         return q
 
+    @staticmethod
+    def mity_qual_array(AO, DP, p):
+        """
+        Calculate the Phred-scaled quality score for many samples or variants at
+        once. Gives the same values as mity_qual.
+
+        Parameters:
+            - AO (array_like): Number of alternative reads.
+            - DP (array_like): Total read depth, the same shape as AO.
+
+        Returns:
+            - numpy.ndarray: Phred-scaled quality scores.
+        """
+        AO = np.asarray(AO, dtype=np.int64)
+        DP = np.asarray(DP, dtype=np.int64)
+        q = np.zeros(AO.shape)
+        called = (AO > 0) & (DP > 0)
+        # penalise homoplasmic variants with low numbers of reads
+        DP = np.where(DP == AO, DP + 1, DP)
+        with np.errstate(divide="ignore"):
+            q[called] = np.round(-4.342945 * binom.logsf(AO[called], DP[called], p), 2)
+        # the maximum q that we observed looking at homoplastic variants around ~129x depth
+        q[np.isinf(q)] = 3220.0
+        return q
+
+    @classmethod
+    def sample_values(cls, RO, QR, AO, QA, DP, p):
+        """
+        Calculate the AQR, VAF, q, AQA and tier FORMAT values for many samples
+        or variants at once.
+
+        Parameters:
+            - RO, QR, AO, QA, DP (array_like): The FreeBayes FORMAT values, all
+              the same shape. AO and QA are for the first alternate allele.
+            - p (float): Minimum noise level, used to calculate q.
+
+        Returns:
+            - dict: numpy arrays of each value, the same shape as the inputs.
+        """
+        RO = np.asarray(RO, dtype=np.float64)
+        QR = np.asarray(QR, dtype=np.float64)
+        AO = np.asarray(AO, dtype=np.float64)
+        QA = np.asarray(QA, dtype=np.float64)
+        DP = np.asarray(DP, dtype=np.float64)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            AQR = np.where(RO > 0, QR / RO, 0.0)
+            VAF = np.where(DP != 0, AO / DP, 0.0)
+            AQA = np.where(AO > 0, QA / AO, 0.0)
+
+        # python's round is correctly rounded, which numpy's round is not, so
+        # these are rounded per value to match the scalar calculation
+        VAF = cls.round_array(VAF, 4)
+        AQA = cls.round_array(AQA, 3)
+
+        tier = np.full(VAF.shape, 3, dtype=np.int64)
+        tier[AO > 10] = 2
+        tier[VAF >= 0.01] = 1
+
+        return {
+            "AQR": AQR,
+            "VAF": VAF,
+            "q": cls.mity_qual_array(AO, DP, p),
+            "AQA": AQA,
+            "tier": tier,
+        }
+
+    @staticmethod
+    def round_array(values, ndigits):
+        """
+        Round a numpy array to the same values as python's round.
+
+        numpy's round scales each value by 10**ndigits and rounds to an integer,
+        which can round the wrong way when the scaled value is within rounding
+        error of a half. Only those values are rounded with python's round.
+        """
+        scaled = values * 10.0**ndigits
+        rounded = np.round(scaled) / 10.0**ndigits
+        near_half = np.abs(np.abs(scaled - np.floor(scaled)) - 0.5) < 1e-6
+        for index in zip(*np.nonzero(near_half)):
+            rounded[index] = round(float(values[index]), ndigits)
+        return rounded
+
     def add_filter(self, variant):
         """
         Adds filter to variant, and filters for samples.
@@ -271,50 +1049,30 @@ class Normalise:
         # filtering
         pass_flag = True
         pos_flag = True
-        if variant.pos in self.BLACKLIST:
+        if self.in_blacklist(variant.chrom, variant.pos, variant.stop):
             pos_flag = False
             pass_flag = False
 
-        # filtering samples
-        for sample in variant.samples.values():
-            # adding to format
-            # AQR
-            if int(sample["RO"]) > 0:
-                AQR = float(sample["QR"]) / float(sample["RO"])
-            else:
-                AQR = 0
+        # adding to format
+        # the values for all samples are calculated together as numpy arrays
+        samples = list(variant.samples.values())
+        values = self.sample_values(
+            RO=[sample["RO"] for sample in samples],
+            QR=[sample["QR"] for sample in samples],
+            AO=[sample["AO"][0] for sample in samples],
+            QA=[sample["QA"][0] for sample in samples],
+            DP=[sample["DP"] for sample in samples],
+            p=self.p,
+        )
 
+        # filtering samples
+        for i, sample in enumerate(samples):
+            AQR = float(values["AQR"][i])
             sample["AQR"] = AQR
-
-            # VAF
-            if sample["DP"] != 0:
-                VAF = round(float(sample["AO"][0]) / float(sample["DP"]), 4)
-            else:
-                VAF = 0
-
-            sample["VAF"] = VAF
-
-            # mity quality
-            q = self.mity_qual(sample["AO"][0], sample["DP"], self.p)
-            sample["q"] = q
-
-            # AQA
-            if sample["AO"][0] > 0:
-                AQA = float(round(sample["QA"][0] / sample["AO"][0], 3))
-            else:
-                AQA = float(0)
-
-            sample["AQA"] = AQA
-
-            # tier (originally from mity report)
-            if float(VAF) >= 0.01:
-                tier = 1
-            elif float(VAF) < 0.01 and float(sample["AO"][0]) > 10:
-                tier = 2
-            else:
-                tier = 3
-
-            sample["tier"] = tier
+            sample["VAF"] = float(values["VAF"][i])
+            sample["q"] = float(values["q"][i])
+            sample["AQA"] = float(values["AQA"][i])
+            sample["tier"] = int(values["tier"][i])
 
             # set tests to "PASS", i.e. 1 first
             # sidenote: it would be nice to use TRUE/FALSE but the format field does
@@ -369,11 +1127,32 @@ class Normalise:
         """
         # adding to INFO field
 
-        # we want to caclulate SBR and add to INFO
-        # SBR = strand bias of reference
-        # SBR = SRF/(SRF+SRR)
+        # we want to caclulate SBR and SBA and add to INFO
         SRF = variant.info["SRF"]
         SRR = variant.info["SRR"]
+
+        # >>> variant.info["SAF"]
+        # >>> (8505,)
+        # so we use [0] to get the first value, and we can assume that there is only one value
+        SAF = variant.info["SAF"][0]
+        SAR = variant.info["SAR"][0]
+
+        SBR, SBA = self.calculate_strand_bias(SRF, SRR, SAF, SAR)
+
+        variant.info.update({"SBR": SBR, "SBA": SBA})
+
+        return variant
+
+    @staticmethod
+    def calculate_strand_bias(SRF, SRR, SAF, SAR):
+        """
+        Calculate the strand bias of the reference and alternate reads.
+
+        Returns:
+            - tuple: (SBR, SBA)
+        """
+        # SBR = strand bias of reference
+        # SBR = SRF/(SRF+SRR)
         # to avoid dividing by zero:
         if SRF > 0 or SRR > 0:
             SBR = round(SRF / (SRF + SRR), 3)
@@ -383,23 +1162,20 @@ class Normalise:
         # we want to calculate SBA and add to INFO
         # SBA = strand bias of alternate
         # i.e. SBA = SAF/(SAF+SAR)
-
-        # >>> variant.info["SAF"]
-        # >>> (8505,)
-        # so we use [0] to get the first value, and we can assume that there is only one value
-        SAF = variant.info["SAF"][0]
-        SAR = variant.info["SAR"][0]
-
         SBA = round(SAF / (SAF + SAR), 3)
 
-        variant.info.update({"SBR": float(SBR), "SBA": float(SBA)})
-
-        return variant
+        return float(SBR), float(SBA)
 
     def remove_intermediate_files(self):
         """
         Remove intermediate files.
         """
         if not self.keep:
-            os.remove(self.filtered_vcf_path)
-            os.remove(self.bcftools_norm_path)
+            # there is no bcftools norm output when the variants are normalised natively
+            for path in [
+                self.bcftools_norm_path,
+                self.bcftools_norm_path + ".csi",
+                self.bcftools_norm_path + ".tbi",
+            ]:
+                if os.path.exists(path):
+                    os.remove(path)
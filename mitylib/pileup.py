@@ -0,0 +1,678 @@
+"""
+Mitochondrial SNV calling from per-position allele counts.
+
+An alternative to FreeBayes for mity call. Reads are counted into dense
+per-position NumPy arrays and the FreeBayes INFO / FORMAT fields used by
+mity normalise are derived from those arrays. mity pileup saves the counts of
+each file, stratified by base quality, mapping quality and strand, so that the
+pileup engine can call again at other quality cutoffs without the alignments.
+"""
+
+import logging
+import os
+import os.path
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+import pysam
+from scipy.stats import binom
+
+logger = logging.getLogger(__name__)
+
+# the file suffix of the allele histograms written by mity pileup
+PILEUP_SUFFIX = ".pileup.npz"
+
+
+class PileupCaller:
+    """
+    Calls SNVs in the mitochondrial contig from allele counts.
+
+    For each sample the following arrays are built over the region, indexed
+    by [position, allele] where allele is one of ALLELES:
+        - counts_fwd / counts_rev: number of reads on each strand
+        - qual_sums: sum of base qualities
+        - mq_sums: sum of mapping qualities
+
+    Only SNVs are called. Indels and complex variants are not reported, use
+    the FreeBayes engine for those.
+    """
+
+    ALLELES = "ACGT"
+    # maps an ASCII base to its index in ALLELES, other bases map to 4
+    BASE_INDEX = np.full(256, 4, dtype=np.int64)
+    BASE_INDEX[np.frombuffer(b"ACGTacgt", dtype=np.uint8)] = [0, 1, 2, 3, 0, 1, 2, 3]
+    # the maximum QUAL, matching the maximum mity q score
+    MAX_QUAL = 3220.0
+    # number of aligned bases collected before they are added to the arrays
+    CHUNK_SIZE = 1 << 22
+    # number of called sites whose per-sample values are read back at a time
+    SITE_BLOCK_SIZE = 1024
+
+    def __init__(
+        self,
+        files: List[str],
+        reference: str,
+        contig: str,
+        contig_length: int,
+        start: int,
+        end: int,
+        min_mq: int,
+        min_bq: int,
+        min_af: float,
+        min_ac: int,
+        header_lines: Optional[List[str]] = None,
+    ):
+        self.files = files
+        self.reference = reference
+        self.contig = contig
+        self.contig_length = contig_length
+        self.start = start
+        self.end = end
+        self.min_mq = min_mq
+        self.min_bq = min_bq
+        self.min_af = min_af
+        self.min_ac = min_ac
+        self.header_lines = header_lines or []
+
+        self.length = end - start + 1
+
+    def get_sample_name(self, alignments: pysam.AlignmentFile, file_name: str) -> str:
+        """
+        Return the sample name from the @RG header, like FreeBayes, falling back
+        to the file name.
+        """
+        read_groups = alignments.header.to_dict().get("RG", [])
+        if read_groups and "SM" in read_groups[0]:
+            return read_groups[0]["SM"]
+        return os.path.basename(file_name).split(".")[0]
+
+    def read_bases(self, file_name: str, min_mq: int, min_bq: int):
+        """
+        Read the aligned bases of one BAM / CRAM file that pass min_mq and
+        min_bq.
+
+        Returns:
+            tuple: The sample name, and a generator of chunks of at least
+            CHUNK_SIZE bases. Each chunk is a dict of arrays with the
+            position * 4 + allele bin, base quality, mapping quality and strand
+            of each base.
+        """
+        alignments = pysam.AlignmentFile(file_name, reference_filename=self.reference)
+        sample_name = self.get_sample_name(alignments, file_name)
+
+        def chunks():
+            chunk_bins: List[np.ndarray] = []
+            chunk_quals: List[np.ndarray] = []
+            chunk_mqs: List[np.ndarray] = []
+            chunk_reverse: List[np.ndarray] = []
+            chunk_size = 0
+
+            def make_chunk():
+                chunk = {
+                    "bins": np.concatenate(chunk_bins),
+                    "quals": np.concatenate(chunk_quals),
+                    "mqs": np.concatenate(chunk_mqs),
+                    "reverse": np.concatenate(chunk_reverse),
+                }
+                for values in (chunk_bins, chunk_quals, chunk_mqs, chunk_reverse):
+                    values.clear()
+                return chunk
+
+            with alignments:
+                for read in alignments.fetch(self.contig, self.start - 1, self.end):
+                    if (
+                        read.is_unmapped
+                        or read.is_secondary
+                        or read.is_supplementary
+                        or read.is_duplicate
+                        or read.is_qcfail
+                        or read.mapping_quality < min_mq
+                        or read.query_sequence is None
+                    ):
+                        continue
+
+                    pairs = np.array(read.get_aligned_pairs(matches_only=True), dtype=np.int64)
+                    if len(pairs) == 0:
+                        continue
+
+                    query_positions = pairs[:, 0]
+                    offsets = pairs[:, 1] - (self.start - 1)
+
+                    sequence = np.frombuffer(read.query_sequence.encode("ascii"), dtype=np.uint8)
+                    alleles = self.BASE_INDEX[sequence[query_positions]]
+                    # reads stored without base qualities (*) have base quality 0
+                    if read.query_qualities is None:
+                        quals = np.zeros(len(query_positions), dtype=np.int64)
+                    else:
+                        quals = np.asarray(read.query_qualities, dtype=np.int64)[query_positions]
+
+                    keep = (
+                        (alleles < 4) & (quals >= min_bq) & (offsets >= 0) & (offsets < self.length)
+                    )
+                    num_kept = int(keep.sum())
+                    if num_kept == 0:
+                        continue
+
+                    chunk_bins.append(offsets[keep] * len(self.ALLELES) + alleles[keep])
+                    chunk_quals.append(quals[keep])
+                    chunk_mqs.append(np.full(num_kept, read.mapping_quality, dtype=np.int64))
+                    chunk_reverse.append(np.full(num_kept, read.is_reverse))
+                    chunk_size += num_kept
+
+                    if chunk_size >= self.CHUNK_SIZE:
+                        yield make_chunk()
+                        chunk_size = 0
+
+                if chunk_bins:
+                    yield make_chunk()
+
+        return sample_name, chunks()
+
+    def count_sample(self, file_name: str) -> Dict[str, np.ndarray]:
+        """
+        Count the alleles of one BAM / CRAM file, or collapse a histogram
+        written by mity pileup at min_mq and min_bq.
+
+        Returns:
+            dict: counts_fwd, counts_rev, qual_sums and mq_sums arrays with
+            shape (length, 4), and the sample name.
+        """
+        if file_name.endswith(PILEUP_SUFFIX):
+            return self.collapse_histogram(file_name)
+
+        num_bins = self.length * len(self.ALLELES)
+        counts_fwd = np.zeros(num_bins, dtype=np.int64)
+        counts_rev = np.zeros(num_bins, dtype=np.int64)
+        qual_sums = np.zeros(num_bins, dtype=np.float64)
+        mq_sums = np.zeros(num_bins, dtype=np.float64)
+
+        sample_name, chunks = self.read_bases(file_name, self.min_mq, self.min_bq)
+        for chunk in chunks:
+            bins = chunk["bins"]
+            reverse = chunk["reverse"]
+            counts_fwd += np.bincount(bins[~reverse], minlength=num_bins)
+            counts_rev += np.bincount(bins[reverse], minlength=num_bins)
+            qual_sums += np.bincount(bins, weights=chunk["quals"], minlength=num_bins)
+            mq_sums += np.bincount(bins, weights=chunk["mqs"], minlength=num_bins)
+
+        shape = (self.length, len(self.ALLELES))
+        return {
+            "sample": sample_name,
+            "counts_fwd": counts_fwd.reshape(shape),
+            "counts_rev": counts_rev.reshape(shape),
+            "qual_sums": qual_sums.reshape(shape),
+            "mq_sums": mq_sums.reshape(shape),
+        }
+
+    def count_histogram(
+        self, file_name: str, bq_bins: Sequence[int], mq_bins: Sequence[int]
+    ) -> Dict[str, np.ndarray]:
+        """
+        Count the alleles of one BAM / CRAM file without quality cutoffs,
+        stratified by base quality bin, mapping quality bin and strand.
+
+        Parameters:
+            - file_name (str): A BAM / CRAM file.
+            - bq_bins (list): The increasing lower edges of the base quality
+              bins, starting at 0. The last bin has no upper edge.
+            - mq_bins (list): The lower edges of the mapping quality bins.
+
+        Returns:
+            - dict: The arrays saved by save_histogram. counts has shape
+              (length, 4, 2, len(bq_bins), len(mq_bins)) with the forward and
+              reverse strand on the third axis. qual_sums and mq_sums have shape
+              (length, 4, len(bq_bins), len(mq_bins)).
+        """
+        num_bq = len(bq_bins)
+        num_mq = len(mq_bins)
+        num_bins = self.length * len(self.ALLELES) * num_bq * num_mq
+        counts = np.zeros(2 * num_bins, dtype=np.int64)
+        qual_sums = np.zeros(num_bins, dtype=np.int64)
+        mq_sums = np.zeros(num_bins, dtype=np.int64)
+
+        sample_name, chunks = self.read_bases(file_name, 0, 0)
+        for chunk in chunks:
+            # the bin of each base is found by its right-most lower edge
+            bq_index = np.searchsorted(bq_bins, chunk["quals"], side="right") - 1
+            mq_index = np.searchsorted(mq_bins, chunk["mqs"], side="right") - 1
+            quality_bins = bq_index * num_mq + mq_index
+            strand = chunk["reverse"].astype(np.int64)
+            bins = chunk["bins"] * num_bq * num_mq + quality_bins
+            counts_bins = (chunk["bins"] * 2 + strand) * num_bq * num_mq + quality_bins
+
+            counts += np.bincount(counts_bins, minlength=2 * num_bins)
+            qual_sums += np.bincount(bins, weights=chunk["quals"], minlength=num_bins).astype(
+                np.int64
+            )
+            mq_sums += np.bincount(bins, weights=chunk["mqs"], minlength=num_bins).astype(np.int64)
+
+        shape = (self.length, len(self.ALLELES), num_bq, num_mq)
+        return {
+            "sample": np.array(sample_name),
+            "contig": np.array(self.contig),
+            "contig_length": np.array(self.contig_length),
+            "start": np.array(self.start),
+            "end": np.array(self.end),
+            "bq_bins": np.array(bq_bins, dtype=np.int64),
+            "mq_bins": np.array(mq_bins, dtype=np.int64),
+            "counts": counts.reshape(self.length, len(self.ALLELES), 2, num_bq, num_mq).astype(
+                np.uint32
+            ),
+            "qual_sums": qual_sums.reshape(shape).astype(np.uint32),
+            "mq_sums": mq_sums.reshape(shape).astype(np.uint32),
+        }
+
+    @staticmethod
+    def read_histogram_summary(path: str) -> Dict[str, Any]:
+        """
+        Read the sample, contig and region of a histogram written by mity
+        pileup, without loading the count arrays.
+        """
+        with np.load(path) as histogram:
+            return {
+                "sample": str(histogram["sample"]),
+                "mt_contig": [str(histogram["contig"]), int(histogram["contig_length"])],
+                "start": int(histogram["start"]),
+                "end": int(histogram["end"]),
+            }
+
+    def collapse_histogram(self, path: str) -> Dict[str, np.ndarray]:
+        """
+        Sum the bins of a histogram written by mity pileup that pass min_bq and
+        min_mq, giving the same arrays as count_sample gives for the BAM / CRAM
+        file. min_bq and min_mq must be lower edges of the stored bins.
+        """
+        with np.load(path) as histogram:
+            bq_bins = list(histogram["bq_bins"])
+            mq_bins = list(histogram["mq_bins"])
+            for name, cutoff, edges in (
+                ("base quality", self.min_bq, bq_bins),
+                ("mapping quality", self.min_mq, mq_bins),
+            ):
+                if cutoff not in edges:
+                    raise ValueError(
+                        f"The minimum {name} {cutoff} is not one of the {name} bins of "
+                        f"{path}: {', '.join(str(edge) for edge in edges)}"
+                    )
+
+            start = int(histogram["start"])
+            end = int(histogram["end"])
+            if str(histogram["contig"]) != self.contig or self.start < start or self.end > end:
+                raise ValueError(f"{path} does not cover {self.contig}:{self.start}-{self.end}")
+
+            positions = slice(self.start - start, self.end - start + 1)
+            bq_index = bq_bins.index(self.min_bq)
+            mq_index = mq_bins.index(self.min_mq)
+            counts = histogram["counts"][positions, :, :, bq_index:, mq_index:]
+            counts = counts.sum(axis=(3, 4), dtype=np.int64)
+            qual_sums = histogram["qual_sums"][positions, :, bq_index:, mq_index:]
+            mq_sums = histogram["mq_sums"][positions, :, bq_index:, mq_index:]
+
+            return {
+                "sample": str(histogram["sample"]),
+                "counts_fwd": counts[:, :, 0],
+                "counts_rev": counts[:, :, 1],
+                "qual_sums": qual_sums.sum(axis=(2, 3), dtype=np.float64),
+                "mq_sums": mq_sums.sum(axis=(2, 3), dtype=np.float64),
+            }
+
+    def get_reference_alleles(self) -> np.ndarray:
+        """
+        Return the index in ALLELES of the reference base at each position of
+        the region, or 4 for ambiguous bases.
+        """
+        with pysam.FastaFile(self.reference) as fasta:
+            sequence = fasta.fetch(self.contig, self.start - 1, self.end).upper()
+        return self.BASE_INDEX[np.frombuffer(sequence.encode("ascii"), dtype=np.uint8)]
+
+    def make_header(self, sample_names: List[str]) -> pysam.VariantHeader:
+        """
+        Make a vcf header with the FreeBayes INFO / FORMAT fields used by mity.
+        """
+        header = pysam.VariantHeader()
+        header.add_line("##source=mityPileupCaller")
+        for line in self.header_lines:
+            header.add_line(line)
+        header.contigs.add(self.contig, length=self.contig_length)
+
+        info = [
+            ("NS", 1, "Integer", "Number of samples with data"),
+            ("DP", 1, "Integer", "Total read depth at the locus"),
+            ("RO", 1, "Integer", "Count of full observations of the reference haplotype."),
+            ("AO", "A", "Integer", "Count of full observations of this alternate haplotype."),
+            ("QR", 1, "Integer", "Reference allele quality sum in phred"),
+            ("QA", "A", "Integer", "Alternate allele quality sum in phred"),
+            ("SRF", 1, "Integer", "Number of reference observations on the forward strand"),
+            ("SRR", 1, "Integer", "Number of reference observations on the reverse strand"),
+            ("SAF", "A", "Integer", "Number of alternate observations on the forward strand"),
+            ("SAR", "A", "Integer", "Number of alternate observations on the reverse strand"),
+            ("MQM", "A", "Float", "Mean mapping quality of observed alternate alleles"),
+            ("MQMR", 1, "Float", "Mean mapping quality of observed reference alleles"),
+            ("TYPE", "A", "String", "The type of allele, either snp, mnp, ins, del, or complex."),
+        ]
+        for field_id, number, field_type, description in info:
+            header.info.add(field_id, number, field_type, description)
+
+        formats = [
+            ("GT", 1, "String", "Genotype"),
+            ("DP", 1, "Integer", "Read Depth"),
+            ("AD", "R", "Integer", "Number of observation for each allele"),
+            ("RO", 1, "Integer", "Reference allele observation count"),
+            ("QR", 1, "Integer", "Sum of quality of the reference observations"),
+            ("AO", "A", "Integer", "Alternate allele observation count"),
+            ("QA", "A", "Integer", "Sum of quality of the alternate observations"),
+        ]
+        for field_id, number, field_type, description in formats:
+            header.formats.add(field_id, number, field_type, description)
+
+        for sample_name in sample_names:
+            header.add_sample(sample_name)
+
+        return header
+
+    def get_qual(self, alt_count: int, depth: int, qual_sum: float) -> float:
+        """
+        Phred scaled probability that alt_count or more alternate reads are
+        sequencing errors, using the mean base quality of the alternate reads
+        as the error rate.
+        """
+        if alt_count == 0:
+            return 0.0
+        error_rate = 10 ** (-(qual_sum / alt_count) / 10)
+        with np.errstate(divide="ignore"):
+            qual = float(-4.342945 * binom.logsf(alt_count - 1, depth, error_rate))
+        return round(min(qual, self.MAX_QUAL), 2)
+
+    def call(self, output_path: str):
+        """
+        Count alleles for all files and write the called SNVs to a bgzipped vcf.
+
+        The samples are counted one at a time. Only the totals over all samples
+        are kept in memory. The counts and quality sums of each sample, which
+        the FORMAT fields need, are written to temporary arrays on disk. They
+        are read back a block of sites at a time once the sites are known.
+        """
+        shape = (self.length, len(self.ALLELES))
+        total_fwd = np.zeros(shape, dtype=np.int64)
+        total_rev = np.zeros(shape, dtype=np.int64)
+        total_quals = np.zeros(shape, dtype=np.float64)
+        total_mqs = np.zeros(shape, dtype=np.float64)
+        passing = np.zeros(shape, dtype=bool)
+        sample_names = []
+
+        output_dir = os.path.dirname(os.path.abspath(output_path))
+        with (
+            tempfile.TemporaryFile(dir=output_dir) as counts_file,
+            tempfile.TemporaryFile(dir=output_dir) as quals_file,
+        ):
+            # shape (samples, length, 4)
+            sample_shape = (len(self.files),) + shape
+            sample_counts = np.memmap(counts_file, dtype=np.uint32, mode="w+", shape=sample_shape)
+            sample_quals = np.memmap(quals_file, dtype=np.uint32, mode="w+", shape=sample_shape)
+
+            for i, file_name in enumerate(self.files):
+                logger.debug("Counting alleles in %s", file_name)
+                sample = self.count_sample(file_name)
+                sample_names.append(sample["sample"])
+
+                counts = sample["counts_fwd"] + sample["counts_rev"]
+                depths = counts.sum(axis=1)
+                # an allele is called if it passes both thresholds in at least one sample
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    fractions = np.where(depths[:, None] > 0, counts / depths[:, None], 0)
+                passing |= (counts >= self.min_ac) & (fractions >= self.min_af)
+
+                total_fwd += sample["counts_fwd"]
+                total_rev += sample["counts_rev"]
+                total_quals += sample["qual_sums"]
+                total_mqs += sample["mq_sums"]
+                sample_counts[i] = counts
+                sample_quals[i] = sample["qual_sums"]
+
+            ref_alleles = self.get_reference_alleles()
+            passing[np.arange(self.length), np.minimum(ref_alleles, 3)] = False
+            passing[ref_alleles == 4] = False
+            sites = np.flatnonzero(passing.any(axis=1))
+
+            header = self.make_header(sample_names)
+            with pysam.VariantFile(output_path, "wz", header=header) as vcf:
+                for block_start in range(0, len(sites), self.SITE_BLOCK_SIZE):
+                    block = sites[block_start : block_start + self.SITE_BLOCK_SIZE]
+                    # shape (samples, sites, 4)
+                    block_counts = sample_counts[:, block, :].astype(np.int64)
+                    block_quals = sample_quals[:, block, :].astype(np.int64)
+
+                    for j, offset in enumerate(block):
+                        ref = ref_alleles[offset]
+                        total_counts = total_fwd[offset] + total_rev[offset]
+                        # alternate alleles are ordered by decreasing total count
+                        alts = sorted(
+                            np.flatnonzero(passing[offset]), key=lambda a: -total_counts[a]
+                        )
+
+                        vcf.write(
+                            self.make_record(
+                                vcf,
+                                offset,
+                                ref,
+                                alts,
+                                total_fwd[offset],
+                                total_rev[offset],
+                                total_quals[offset],
+                                total_mqs[offset],
+                                block_counts[:, j, :],
+                                block_quals[:, j, :],
+                            )
+                        )
+
+            del sample_counts, sample_quals
+
+        logger.debug("Pileup caller called %s sites", len(sites))
+
+    def make_record(
+        self,
+        vcf,
+        offset,
+        ref,
+        alts,
+        counts_fwd,
+        counts_rev,
+        qual_sums,
+        mq_sums,
+        sample_counts,
+        sample_quals,
+    ):
+        """
+        Make a vcf record at one position. counts_fwd, counts_rev, qual_sums
+        and mq_sums are the totals over all samples, with shape (4,), and
+        sample_counts and sample_quals have shape (samples, 4).
+        """
+        counts = counts_fwd + counts_rev
+        depths = sample_counts.sum(axis=1)
+
+        alt_counts = counts[alts]
+        alt_quals = qual_sums[alts]
+        ref_count = int(counts[ref])
+        total_depth = int(counts.sum())
+
+        record = vcf.new_record(
+            contig=self.contig,
+            start=self.start - 1 + int(offset),
+            alleles=[self.ALLELES[ref]] + [self.ALLELES[alt] for alt in alts],
+            qual=self.get_qual(int(alt_counts[0]), total_depth, float(alt_quals[0])),
+        )
+
+        record.info["NS"] = int((depths > 0).sum())
+        record.info["DP"] = total_depth
+        record.info["RO"] = ref_count
+        record.info["AO"] = tuple(int(count) for count in alt_counts)
+        record.info["QR"] = int(qual_sums[ref])
+        record.info["QA"] = tuple(int(qual) for qual in alt_quals)
+        record.info["SRF"] = int(counts_fwd[ref])
+        record.info["SRR"] = int(counts_rev[ref])
+        record.info["SAF"] = tuple(int(counts_fwd[alt]) for alt in alts)
+        record.info["SAR"] = tuple(int(counts_rev[alt]) for alt in alts)
+        record.info["MQM"] = tuple(
+            float(round(mq_sums[alt] / count, 4)) if count > 0 else 0.0
+            for alt, count in zip(alts, alt_counts)
+        )
+        record.info["MQMR"] = float(round(mq_sums[ref] / ref_count, 4)) if ref_count > 0 else 0.0
+        record.info["TYPE"] = ("snp",) * len(alts)
+
+        for i, sample in enumerate(record.samples.values()):
+            sample_alt_counts = [int(sample_counts[i, alt]) for alt in alts]
+            sample["GT"] = self.get_genotype(int(depths[i]), sample_alt_counts)
+            sample["DP"] = int(depths[i])
+            sample["AD"] = tuple([int(sample_counts[i, ref])] + sample_alt_counts)
+            sample["RO"] = int(sample_counts[i, ref])
+            sample["QR"] = int(sample_quals[i, ref])
+            sample["AO"] = tuple(sample_alt_counts)
+            sample["QA"] = tuple(int(sample_quals[i, alt]) for alt in alts)
+
+        return record
+
+    def get_genotype(self, depth: int, alt_counts: List[int]):
+        """
+        Diploid genotype from the most frequent alternate allele of a sample,
+        to match FreeBayes' --ploidy 2.
+        """
+        if depth == 0:
+            return (None, None)
+
+        best_alt = int(np.argmax(alt_counts))
+        fraction = alt_counts[best_alt] / depth
+        if fraction >= 1 - self.min_af:
+            return (best_alt + 1, best_alt + 1)
+        if fraction >= self.min_af and alt_counts[best_alt] >= self.min_ac:
+            return (0, best_alt + 1)
+        return (0, 0)
+
+
+class Pileup:
+    """
+    Mity pileup.
+
+    Counts the alleles of each BAM / CRAM file at every position of the
+    mitochondrial contig, stratified by base quality bin, mapping quality bin
+    and strand, and saves the counts to a PREFIX.pileup.npz file per file.
+    mity call --engine pileup accepts these files in place of the BAM / CRAM
+    files, and calls from the counts at any --min-base-quality and
+    --min-mapping-quality that are bin edges, without reading the alignments.
+    """
+
+    BQ_BINS = [0, 10, 13, 20, 24, 30, 35, 40]
+    MQ_BINS = [0, 10, 20, 30, 40, 50, 60]
+
+    def __init__(
+        self,
+        debug,
+        files,
+        reference,
+        output_dir=".",
+        region=None,
+        bam_list=False,
+        threads=1,
+        bq_bins=None,
+        mq_bins=None,
+    ):
+        self.debug = debug
+        self.files = files[0]
+        self.reference = reference
+        self.output_dir = output_dir
+        self.region = region
+        self.bam_list = bam_list
+        self.threads = threads
+        self.bq_bins = bq_bins or self.BQ_BINS
+        self.mq_bins = mq_bins or self.MQ_BINS
+
+        self.pileup_paths: List[str] = []
+
+        self.run()
+
+    def run(self):
+        """
+        Run mity pileup.
+        """
+        if self.debug:
+            logger.setLevel(logging.DEBUG)
+            logger.debug("Entered debug mode.")
+        else:
+            logger.setLevel(logging.INFO)
+
+        if self.bam_list:
+            with open(self.files[0], "r") as f:
+                self.files = f.read().splitlines()
+
+        for name, edges in (("base quality", self.bq_bins), ("mapping quality", self.mq_bins)):
+            if edges[0] != 0 or any(b <= a for a, b in zip(edges, edges[1:])):
+                raise ValueError(f"The {name} bins must be increasing and start at 0")
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        output_paths = [self.get_output_path(file_name) for file_name in self.files]
+        if len(set(output_paths)) < len(output_paths):
+            raise ValueError("Two of the files would be counted to the same output file")
+
+        with ThreadPoolExecutor(max_workers=max(self.threads, 1)) as executor:
+            self.pileup_paths = list(executor.map(self.pileup, self.files, output_paths))
+
+    def get_output_path(self, file_name: str) -> str:
+        """
+        Returns the path of the histogram of a BAM / CRAM file, e.g.
+        sample.pileup.npz for sample.bam.
+        """
+        prefix = os.path.splitext(os.path.basename(file_name))[0]
+        return os.path.join(self.output_dir, prefix + PILEUP_SUFFIX)
+
+    def get_region(self, file_name: str):
+        """
+        Returns the contig, contig length, start and end to count, from
+        --region or the MT / chrM contig of the file.
+        """
+        with pysam.AlignmentFile(file_name, reference_filename=self.reference) as alignments:
+            lengths = dict(zip(alignments.references, alignments.lengths))
+
+        mito_contig_intersection = {"MT", "chrM"}.intersection(lengths)
+        assert len(mito_contig_intersection) == 1
+        contig = "".join(mito_contig_intersection)
+        start, end = 1, lengths[contig]
+
+        if self.region is not None and ":" in self.region:
+            region_contig, coordinates = self.region.rsplit(":", 1)
+            if region_contig != contig:
+                raise ValueError(f"Region {self.region} is not the mitochondrial contig")
+            start, end = (int(x) for x in coordinates.replace(",", "").split("-"))
+
+        return contig, lengths[contig], start, end
+
+    def pileup(self, file_name: str, output_path: str) -> str:
+        """
+        Counts the alleles of one BAM / CRAM file and saves the histogram.
+
+        Returns:
+            - str: The path to the histogram.
+        """
+        logger.info("Counting alleles in %s", file_name)
+        contig, contig_length, start, end = self.get_region(file_name)
+        caller = PileupCaller(
+            files=[file_name],
+            reference=self.reference,
+            contig=contig,
+            contig_length=contig_length,
+            start=start,
+            end=end,
+            min_mq=0,
+            min_bq=0,
+            min_af=0.0,
+            min_ac=0,
+        )
+        histogram = caller.count_histogram(file_name, self.bq_bins, self.mq_bins)
+
+        # np.savez_compressed adds .npz to paths without it, so write to a
+        # temporary .npz and rename, as mity extract does
+        tmp_path = output_path[: -len(".npz")] + ".tmp.npz"
+        np.savez_compressed(tmp_path, **histogram)
+        os.replace(tmp_path, output_path)
+        logger.debug("Saved the allele histogram of %s to %s", file_name, output_path)
+        return output_path
@@ -0,0 +1,205 @@
+"""Re-apply the mity normalise filters to normalised VCFs with new thresholds."""
+
+import logging
+import os.path
+from concurrent.futures import ProcessPoolExecutor
+
+import pysam
+
+from mitylib.normalise import Normalise
+from mitylib.util import MityUtil, SortedVcfWriter
+
+logger = logging.getLogger(__name__)
+
+
+class Refilter(Normalise):
+    """
+    Mity refilter.
+
+    Recalculates q, tier and the FORMAT filter flags of each sample, and the
+    FILTER of each variant, of VCFs written by mity normalise. Only the
+    FreeBayes values already stored in the VCF are used, so the variants are
+    not normalised again. Each VCF is streamed in blocks with the columnar
+    engine functions of mity normalise, and many VCFs can be refiltered in
+    parallel processes.
+    """
+
+    def __init__(
+        self,
+        debug,
+        vcfs,
+        output_dir=".",
+        allsamples=False,
+        p=Normalise.P_VAL,
+        min_dp=Normalise.MIN_DP,
+        sb_range_lo=Normalise.SB_RANGE_LO,
+        sb_range_hi=Normalise.SB_RANGE_HI,
+        min_mqmr=Normalise.MIN_MQMR,
+        min_aqr=Normalise.MIN_AQR,
+        blacklist=None,
+        threads=1,
+        output_type="vcf",
+    ):
+        # Normalise.__init__ is not called, as it runs mity normalise
+        self.debug = debug
+        self.vcfs = vcfs
+        self.output_dir = output_dir
+        self.allsamples = allsamples
+        self.p = p
+        self.MIN_DP = min_dp
+        self.SB_RANGE_LO = sb_range_lo
+        self.SB_RANGE_HI = sb_range_hi
+        self.MIN_MQMR = min_mqmr
+        self.MIN_AQR = min_aqr
+        self.blacklist = blacklist
+        self.threads = threads
+        self.output_type = output_type
+
+        self.vcf = None
+        self.stream = None
+        self.mt_contig = None
+        self.blacklist_regions = []
+        self.blacklist_counts = None
+
+        self.refiltered_vcf_paths = []
+
+        self.run()
+
+    def run(self):
+        """
+        Run mity refilter.
+        """
+        if self.debug:
+            logger.setLevel(logging.DEBUG)
+            logger.debug("Entered debug mode.")
+        else:
+            logger.setLevel(logging.INFO)
+
+        if self.blacklist is None:
+            self.blacklist = os.path.join(
+                MityUtil.get_mity_dir(), MityUtil.REF_DIR, self.BLACKLIST_BED
+            )
+
+        output_paths = [self.get_output_path(vcf) for vcf in self.vcfs]
+        if len(set(output_paths)) < len(output_paths):
+            raise ValueError("Two of the VCFs would be refiltered to the same output file")
+
+        if self.threads > 1 and len(self.vcfs) > 1:
+            with ProcessPoolExecutor(max_workers=self.threads) as executor:
+                self.refiltered_vcf_paths = list(executor.map(self.refilter_vcf, self.vcfs))
+        else:
+            self.refiltered_vcf_paths = [self.refilter_vcf(vcf) for vcf in self.vcfs]
+
+    def get_output_path(self, vcf_path):
+        """
+        Returns the path of the refiltered vcf, e.g. sample.refilter.vcf.gz for
+        sample.mity.normalise.vcf.gz.
+        """
+        return os.path.join(
+            self.output_dir,
+            MityUtil.make_prefix(vcf_path) + ".refilter" + MityUtil.OUTPUT_TYPES[self.output_type],
+        )
+
+    def make_header(self, header):
+        """
+        Returns the header of the refiltered vcf as text, with the blacklist in
+        the POS_filter description and a record of the new thresholds.
+
+        Parameters:
+            - header (VariantHeader): The header of the normalised vcf.
+        """
+        if "POS_filter" not in header.formats:
+            raise ValueError(f"{self.vcf} does not have the FORMAT fields added by mity normalise")
+
+        thresholds = " ".join(
+            f"{name}={value}"
+            for name, value in [("p", self.p)] + list(self.get_thresholds().items())
+        )
+        header.add_line(f'##mityRefilterThresholds="{thresholds}"')
+
+        lines = []
+        for line in str(header).splitlines(keepends=True):
+            if line.startswith("##FORMAT=<ID=POS_filter,"):
+                line = line.split("Description=")[0]
+                line += 'Description="Variant overlaps the blacklist of positions: '
+                line += ", ".join(
+                    f"{self.mt_contig}:{start}-{end}" for start, end in self.blacklist_regions
+                )
+                line += '">\n'
+            lines.append(line)
+        return "".join(lines)
+
+    def strip_filters(self, fields):
+        """
+        Removes the values added by mity normalise from the columns of a vcf
+        line, so the line can be filtered again by filter_samples and
+        make_lines.
+
+        Parameters:
+            - fields (list): The tab separated columns of a normalised vcf line.
+
+        Returns:
+            - list: The columns without the normalise FORMAT values, the SBR and
+              SBA INFO values or the PASS / FAIL FILTER.
+        """
+        suffix = ":" + ":".join(self.NEW_FORMAT_KEYS)
+        if not fields[8].endswith(suffix):
+            raise ValueError(
+                f"{fields[0]}:{fields[1]} does not have the FORMAT fields added by mity normalise"
+            )
+        num_keys = len(self.NEW_FORMAT_KEYS)
+        fields[8] = fields[8][: -len(suffix)]
+        fields[9:] = [sample.rsplit(":", num_keys)[0] for sample in fields[9:]]
+
+        info = [item for item in fields[7].split(";") if not item.startswith(("SBR=", "SBA="))]
+        fields[7] = ";".join(info) or "."
+
+        # make_lines adds PASS or FAIL after any other filters
+        filters = fields[6].split(";")
+        if filters[-1] in ("PASS", "FAIL"):
+            filters.pop()
+        fields[6] = ";".join(filters) or "."
+
+        return fields
+
+    def load_vcf(self, vcf_path):
+        """
+        Sets the vcf to refilter, and loads the blacklist for its mitochondrial
+        contig.
+        """
+        self.vcf = vcf_path
+        self.load_blacklist()
+
+    def refilter_vcf(self, vcf_path):
+        """
+        Refilters one normalised vcf.
+
+        Parameters:
+            - vcf_path (str): The path to a vcf or bcf from mity normalise.
+
+        Returns:
+            - str: The path to the refiltered vcf.
+        """
+        logger.info("Refiltering %s", vcf_path)
+        self.load_vcf(vcf_path)
+
+        with pysam.VariantFile(vcf_path) as vcf:
+            header = vcf.header.copy()
+        num_samples = len(header.samples)
+        block_size = max(1, self.COLUMNAR_BLOCK_SIZE // max(1, num_samples))
+
+        output_path = self.get_output_path(vcf_path)
+        writer = SortedVcfWriter(output_path, self.make_header(header))
+
+        lines = MityUtil.read_vcf_lines(vcf_path)
+        for block in self.read_blocks(lines, block_size):
+            block = [self.strip_filters(fields) for fields in block]
+            pos_flag = self.get_blacklist_flags(block)
+            sample_columns, failed = self.filter_samples(
+                block, self.p, pos_flag, self.get_thresholds()
+            )
+            for line in self.make_lines(block, [sample_columns], [failed], num_samples, pos_flag):
+                writer.write_line(line)
+
+        writer.close()
+        return output_path
@@ -5,13 +5,16 @@ Adds annotations and generates mity excel report from VCF file.
 import logging
 import os.path
 import subprocess
-from typing import Dict, Optional
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 import pysam
+import pysam.bcftools
 import pandas
 import yaml
 
 from vcf2pandas import vcf2pandas
 
+from mitylib.annotate import AnnotationBundle, AnnotationCache, AnnotationLookup, Annotator
 from mitylib.util import MityUtil
 
 # LOGGING
@@ -181,6 +184,9 @@ class SingleReport:
         prefix: str,
         output_dir: str,
         output_annotated_vcf: bool = False,
+        annotator: Optional[
+            Union[Annotator, AnnotationBundle, AnnotationCache, AnnotationLookup]
+        ] = None,
     ) -> None:
         self.min_vaf = min_vaf
         self.keep = keep
@@ -194,6 +200,7 @@ class SingleReport:
         self.vcfanno_base_path = vcfanno_base_path
         self.vcfanno_config = vcfanno_config
         self.report_config = report_config
+        self.annotator = annotator
 
         self.prefix = prefix
         self.output_dir = output_dir
@@ -218,18 +225,23 @@ class SingleReport:
         Run SingleReport.
         """
 
-        self.vcfanno_call()
-        self.vep = Vep(self.annot_vcf_obj)
+        if self.annotator is None:
+            self.vcfanno_call()
+            self.vep = Vep(self.annot_vcf_obj)
+        else:
+            self.vep = Vep(self.vcf_obj)
         self.make_table()
 
         if self.output_annotated_vcf:
+            if self.annotator is not None:
+                self.write_annotated_vcf()
             annotated_vcf_df = vcf2pandas(self.annot_vcf_path)
             annotated_vcf_df.to_excel(
                 os.path.join(self.output_dir, self.prefix + ".mity.annotated.vcf.xlsx"),
                 index=False,
             )
 
-        if not self.keep:
+        if not self.keep and self.annot_vcf_path is not None:
             # remove vcfanno annotated vcf
             os.remove(self.annot_vcf_path)
 
@@ -280,15 +292,43 @@ class SingleReport:
         Calls vcfanno to annotate the output of mity normalise with the relevant
         annotations based on vcfanno-config.toml in mitylib/
         """
+        # annotated_file name
+        vcf_base = self.vcf_path.replace(".vcf.gz", "").replace(".bcf", "")
+        annotated_file = vcf_base + ".mity.annotated.vcf"
+        self.run_vcfanno(self.vcf_path, annotated_file, self.vcfanno_config, self.vcfanno_base_path)
+
+        self.annot_vcf_path = annotated_file
+        self.annot_vcf_obj = pysam.VariantFile(annotated_file)
+
+    @staticmethod
+    def run_vcfanno(
+        vcf_path: str,
+        annotated_file: str,
+        vcfanno_config: str,
+        vcfanno_base_path: Optional[str] = None,
+    ) -> None:
+        """
+        Runs vcfanno on a vcf or bcf.
+
+        Parameters:
+            - vcf_path (str): The vcf to annotate.
+            - annotated_file (str): The annotated vcf to write.
+            - vcfanno_config (str): The vcfanno config.
+            - vcfanno_base_path (str, optional): The base path of the annotations.
+        """
         logger.debug("Running vcfanno...")
 
-        # annotated_file name
-        annotated_file = self.vcf_path.replace(".vcf.gz", ".mity.annotated.vcf")
-        base_path_arg = f"-base-path {self.vcfanno_base_path}" if self.vcfanno_base_path else ""
+        base_path_arg = f"-base-path {vcfanno_base_path}" if vcfanno_base_path else ""
+
+        # vcfanno reads vcf text, so a bcf is converted first
+        input_vcf = vcf_path
+        if MityUtil.is_bcf(vcf_path):
+            input_vcf = vcf_path.replace(".bcf", "") + ".vcfanno.input.vcf"
+            pysam.bcftools.view("-Ov", "-o", input_vcf, vcf_path, catch_stdout=False)
 
         # vcfanno call
         vcfanno_cmd = (
-            f"vcfanno -p 4 {base_path_arg} {self.vcfanno_config} {self.vcf_path} > {annotated_file}"
+            f"vcfanno -p 4 {base_path_arg} {vcfanno_config} {input_vcf} > {annotated_file}"
         )
         res = subprocess.run(
             vcfanno_cmd,
@@ -303,18 +343,73 @@ class SingleReport:
         logger.debug("vcfanno output:")
         logger.debug(res.stdout)
 
-        self.annot_vcf_path = annotated_file
-        self.annot_vcf_obj = pysam.VariantFile(annotated_file)
+        if input_vcf != vcf_path:
+            os.remove(input_vcf)
 
-    def make_info_string(self, variant):
+    def get_annotated_variants(self):
         """
-        Takes the INFO fields from the variant and recreates the format as it
+        Yields each variant with its INFO fields and annotations. With the
+        native annotator the annotations are joined to the variants of the
+        input vcf in memory, otherwise they are read from the vcfanno output.
+        """
+        if self.annotator is None:
+            for variant in self.annot_vcf_obj.fetch():
+                yield variant, variant.info
+            return
+
+        for variant in self.vcf_obj:
+            info = dict(variant.info)
+            info.update(self.annotator.annotate(variant))
+            yield variant, info
+
+    def write_annotated_vcf(self):
+        """
+        Writes the variants of the input vcf with the annotations of the
+        annotator, for --output-annotated-vcf. Annotations with an INFO header
+        line in the annotator, e.g. from vcfanno, keep that line and its Number
+        and Type. Other annotations are written as strings.
+        """
+        vcf_base = self.vcf_path.replace(".vcf.gz", "").replace(".bcf", "")
+        self.annot_vcf_path = vcf_base + ".mity.annotated.vcf"
+
+        info_records: Dict[str, str] = {}
+        if isinstance(self.annotator, AnnotationLookup):
+            info_records = self.annotator.info_records
+
+        header = self.vcf_obj.header.copy()
+        for name in self.annotator.names:
+            if name in header.info:
+                continue
+            if name in info_records:
+                header.add_line(info_records[name].rstrip("\n"))
+            else:
+                header.info.add(name, ".", "String", f"{name} from mity annotation")
+
+        with (
+            pysam.VariantFile(self.vcf_path) as vcf,
+            pysam.VariantFile(self.annot_vcf_path, "w", header=header) as annotated_vcf,
+        ):
+            for variant in vcf:
+                variant.translate(header)
+                for name, value in self.annotator.annotate(variant).items():
+                    if name in self.vcf_obj.header.info:
+                        continue
+                    if name in info_records:
+                        variant.info[name] = value
+                        continue
+                    values = value if isinstance(value, tuple) else (value,)
+                    variant.info[name] = tuple(str(v) for v in values)
+                annotated_vcf.write(variant)
+
+    def make_info_string(self, info):
+        """
+        Takes the INFO fields of a variant and recreates the format as it
         appears in a vcf file. i.e.
 
         FIELD=X;FIELD=Y;etc
         """
         info_field_array = []
-        for key, value in variant.info.items():
+        for key, value in info.items():
             if isinstance(value, tuple):
                 value = value[0]
             info_field_array.append(f"{key}={value}")
@@ -355,7 +450,7 @@ class SingleReport:
 
     def make_table(self):
         """
-        Takes a vcfanno annotated vcf file and returns a formatted dictionary
+        Takes the annotated variants and returns a formatted dictionary
         with relevant information.
 
         The vcf and excel header names are hardcoded in report-config.yaml.
@@ -370,11 +465,11 @@ class SingleReport:
             for header in self.vep.vep_excel_headers:
                 self.excel_table[header] = []
 
-        num_samples = len(self.annot_vcf_obj.header.samples)
+        num_samples = len(self.vcf_obj.header.samples)
 
-        for variant in self.annot_vcf_obj.fetch():
+        for variant, info in self.get_annotated_variants():
             cohort_count = 0
-            info_string = self.make_info_string(variant)
+            info_string = self.make_info_string(info)
 
             # samples
             for sample in variant.samples.values():
@@ -403,19 +498,15 @@ class SingleReport:
 
                 # vcf_headers: info
                 for vcf_header, excel_header in self.vcf_headers["info"].items():
-                    if vcf_header in variant.info.keys():
-                        self.excel_table[excel_header].append(
-                            self.clean_string(variant.info[vcf_header])
-                        )
+                    if vcf_header in info.keys():
+                        self.excel_table[excel_header].append(self.clean_string(info[vcf_header]))
                     else:
                         self.excel_table[excel_header].append(".")
 
                 # vcf_headers: annotations
                 for vcf_header, excel_header in self.vcf_headers["annotations"].items():
-                    if vcf_header in variant.info.keys():
-                        self.excel_table[excel_header].append(
-                            self.clean_string(variant.info[vcf_header])
-                        )
+                    if vcf_header in info.keys():
+                        self.excel_table[excel_header].append(self.clean_string(info[vcf_header]))
                     else:
                         self.excel_table[excel_header].append(".")
 
@@ -467,6 +558,11 @@ class Report:
         vcfanno_config: Optional[str] = None,
         report_config: Optional[str] = None,
         output_annotated_vcf: bool = False,
+        annotator: str = "native",
+        annotation_bundle: Optional[str] = None,
+        annotation_cache: Optional[str] = None,
+        annotation_cache_size: int = AnnotationCache.DEFAULT_MAX_VARIANTS,
+        threads: int = 1,
     ) -> None:
         self.debug = debug
         self.vcfs = vcfs[0]
@@ -479,6 +575,13 @@ class Report:
         self.vcfanno_config = vcfanno_config
         self.report_config = report_config
         self.output_annotated_vcf = output_annotated_vcf
+        self.annotator = annotator
+        self.annotation_bundle = annotation_bundle
+        self.annotation_cache = annotation_cache
+        self.annotation_cache_size = annotation_cache_size
+        self.threads = threads
+
+        self.annotations: Optional[AnnotationLookup] = None
 
         self.run()
 
@@ -503,39 +606,43 @@ class Report:
         if self.prefix is None:
             self.prefix = MityUtil.make_prefix(self.vcfs[0])
 
-        config_path = os.path.join(MityUtil.get_mity_dir(), "config")
-        if self.vcfanno_config is None:
-            self.vcfanno_base_path = MityUtil.get_mity_dir()
-            match self.contig:
-                case "MT":
-                    self.vcfanno_config = os.path.join(config_path, "vcfanno-config-mt.toml")
-                case "chrM":
-                    self.vcfanno_config = os.path.join(config_path, "vcfanno-config-chrm.toml")
-                case _:
-                    raise ValueError(
-                        "Contig not recognised, please specify a valid contig (either MT or chrM)"
-                    )
+        self.vcfanno_config, self.vcfanno_base_path = MityUtil.select_vcfanno_config(
+            self.contig, self.vcfanno_config, self.vcfanno_base_path
+        )
 
         if self.report_config is None:
+            config_path = os.path.join(MityUtil.get_mity_dir(), "config")
             self.report_config = os.path.join(config_path, "report-config.yaml")
 
+        # the distinct variants of every vcf are annotated once
+        header, variants = self.get_distinct_variants()
+        logger.debug("Annotating %s distinct variants of %s vcfs", len(variants), len(self.vcfs))
+        if self.annotator == "native":
+            self.annotations = self.annotate_natively(variants)
+        else:
+            self.annotations = self.annotate_with_vcfanno(header, variants)
+
+        # every vcf writes the same annotated vcf xlsx, so those reports are
+        # not made in parallel
+        if self.threads > 1 and len(self.vcfs) > 1 and not self.output_annotated_vcf:
+            chunksize = max(1, len(self.vcfs) // (self.threads * 4))
+            with ProcessPoolExecutor(max_workers=self.threads) as executor:
+                self.write_sheets(executor.map(self.make_sheet, self.vcfs, chunksize=chunksize))
+        else:
+            self.write_sheets(map(self.make_sheet, self.vcfs))
+
+    def write_sheets(self, dfs: Iterator[pandas.DataFrame]) -> None:
+        """
+        Writes the sheet of each vcf to the report xlsx, in input order, as
+        the sheets are made.
+
+        Parameters:
+            - dfs (iterator): The sheet of each vcf.
+        """
         xlsx_name = os.path.join(self.output_dir, self.prefix + ".mity.report.xlsx")
         with pandas.ExcelWriter(xlsx_name, engine="xlsxwriter") as writer:
-            for vcf in self.vcfs:
-                single_report = SingleReport(
-                    vcf_path=vcf,
-                    min_vaf=self.min_vaf,
-                    keep=self.keep,
-                    vcfanno_base_path=self.vcfanno_base_path,
-                    vcfanno_config=self.vcfanno_config,
-                    report_config=self.report_config,
-                    prefix=self.prefix,
-                    output_dir=self.output_dir,
-                    output_annotated_vcf=self.output_annotated_vcf,
-                )
-                df = single_report.get_df()
-
-                sheet_name = vcf.replace(".vcf.gz", "").split("/")[-1]
+            for vcf, df in zip(self.vcfs, dfs):
+                sheet_name = vcf.replace(".vcf.gz", "").replace(".bcf", "").split("/")[-1]
                 if len(sheet_name) > 31:
                     logging.info(
                         "sheet_name: %s was too long and was automatically shortened",
@@ -543,3 +650,138 @@ class Report:
                     )
                 sheet_name = sheet_name[:31]
                 df.to_excel(writer, sheet_name=sheet_name, index=False)
+
+    def make_sheet(self, vcf: str) -> pandas.DataFrame:
+        """
+        Makes the report table of one vcf, from the annotations of the distinct
+        variants.
+
+        Parameters:
+            - vcf (str): The path to a mity vcf.
+
+        Returns:
+            - DataFrame: The sheet of the vcf.
+        """
+        single_report = SingleReport(
+            vcf_path=vcf,
+            min_vaf=self.min_vaf,
+            keep=self.keep,
+            vcfanno_base_path=self.vcfanno_base_path,
+            vcfanno_config=self.vcfanno_config,
+            report_config=self.report_config,
+            prefix=self.prefix,
+            output_dir=self.output_dir,
+            output_annotated_vcf=self.output_annotated_vcf,
+            annotator=self.annotations,
+        )
+        return single_report.get_df()
+
+    def get_distinct_variants(
+        self,
+    ) -> Tuple[pysam.VariantHeader, List[pysam.VariantRecord]]:
+        """
+        Reads the distinct (contig, pos, ref, alts) of every vcf.
+
+        Returns:
+            - VariantHeader: A header of the contigs of every vcf.
+            - list: A record of each distinct variant, without INFO or samples,
+              sorted by contig and position.
+        """
+        header = pysam.VariantHeader()
+        keys = set()
+        for vcf_path in self.vcfs:
+            with pysam.VariantFile(vcf_path) as vcf:
+                for contig in vcf.header.contigs.values():
+                    if contig.name not in header.contigs:
+                        header.contigs.add(contig.name, length=contig.length)
+                for variant in vcf:
+                    keys.add(AnnotationLookup.get_key(variant))
+
+        for contig, _, _, _ in keys:
+            if contig not in header.contigs:
+                header.contigs.add(contig)
+        contig_order = {contig: i for i, contig in enumerate(header.contigs)}
+
+        return header, [
+            header.new_record(contig=contig, start=pos - 1, alleles=(ref,) + alts)
+            for contig, pos, ref, alts in sorted(
+                keys, key=lambda key: (contig_order[key[0]],) + key[1:]
+            )
+        ]
+
+    def annotate_natively(self, variants: List[pysam.VariantRecord]) -> AnnotationLookup:
+        """
+        Annotates variants with the annotation bundle, through the annotation
+        cache unless --annotation-cache-size is 0.
+        """
+        annotator = AnnotationBundle.load(
+            self.vcfanno_config, self.vcfanno_base_path, self.annotation_bundle
+        )
+        if self.annotation_cache_size > 0:
+            if self.annotation_cache is None:
+                self.annotation_cache = AnnotationCache.get_default_path()
+            config_key = AnnotationCache.get_config_key(
+                [self.vcfanno_config] + annotator.sources + [self.report_config]
+            )
+            annotator = AnnotationCache(
+                annotator, self.annotation_cache, config_key, self.annotation_cache_size
+            )
+
+        try:
+            lookup = AnnotationLookup(
+                annotator.names,
+                {
+                    AnnotationLookup.get_key(variant): annotator.annotate(variant)
+                    for variant in variants
+                },
+            )
+        finally:
+            # the cache is closed even if annotating fails, which keeps the
+            # annotations of the variants annotated so far
+            if isinstance(annotator, AnnotationCache):
+                annotator.close()
+
+        if isinstance(annotator, AnnotationCache):
+            logger.debug(
+                "Annotation cache: %s hits, %s misses, %s variants evicted",
+                annotator.hits,
+                annotator.misses,
+                annotator.evicted,
+            )
+
+        return lookup
+
+    def annotate_with_vcfanno(
+        self, header: pysam.VariantHeader, variants: List[pysam.VariantRecord]
+    ) -> AnnotationLookup:
+        """
+        Annotates variants with one vcfanno run, on a vcf of the variants.
+        """
+        distinct_vcf_path = os.path.join(self.output_dir, self.prefix + ".mity.distinct.vcf")
+        annotated_vcf_path = os.path.join(
+            self.output_dir, self.prefix + ".mity.distinct.annotated.vcf"
+        )
+
+        with pysam.VariantFile(distinct_vcf_path, "w", header=header) as distinct_vcf:
+            for variant in variants:
+                distinct_vcf.write(variant)
+
+        SingleReport.run_vcfanno(
+            distinct_vcf_path, annotated_vcf_path, self.vcfanno_config, self.vcfanno_base_path
+        )
+
+        with pysam.VariantFile(annotated_vcf_path) as annotated_vcf:
+            names = [name for name in annotated_vcf.header.info if name not in header.info]
+            info_records = {name: str(annotated_vcf.header.info[name].record) for name in names}
+            annotations = {
+                AnnotationLookup.get_key(variant): {
+                    name: variant.info[name] for name in names if name in variant.info
+                }
+                for variant in annotated_vcf
+            }
+
+        if not self.keep:
+            os.remove(distinct_vcf_path)
+            os.remove(annotated_vcf_path)
+
+        return AnnotationLookup(names, annotations, info_records)
@@ -0,0 +1,297 @@
+"""Evaluate a grid of call and normalise thresholds from a single mity call."""
+
+import itertools
+import logging
+import os.path
+
+import numpy as np
+import pysam
+import yaml
+
+from mitylib.call import Call
+from mitylib.normalise import Normalise
+from mitylib.refilter import Refilter
+from mitylib.util import MityUtil, SortedVcfWriter
+
+logger = logging.getLogger(__name__)
+
+
+class Sweep:
+    """
+    Mity sweep.
+
+    Calls and normalises variants once, at the most permissive
+    --min-alternate-fraction and --min-alternate-count of the grid, and keeps
+    the normalised variants in memory. Each point of the grid is then
+    evaluated from those variants:
+        - a variant is called if at least one sample has at least
+          min_alternate_count alternate reads, making up at least
+          min_alternate_fraction of its reads, as in FreeBayes
+        - q, tier, the FORMAT filter flags and FILTER are recalculated with the
+          p and normalise thresholds of the point, as in mity refilter
+        - the report rows are the samples of the called variants with a VAF
+          above min_vaf, as in mity report
+
+    A summary of each grid point is written to a tsv, and optionally the
+    variants of each grid point to a vcf.
+
+    The filters are applied by a Refilter with the thresholds of each grid
+    point, which is made without any vcfs to refilter.
+    """
+
+    # grid parameters and their defaults
+    GRID_DEFAULTS = {
+        "min_alternate_fraction": Call.MIN_AF,
+        "min_alternate_count": Call.MIN_AC,
+        "p": Normalise.P_VAL,
+        "min_dp": Normalise.MIN_DP,
+        "sb_range_lo": Normalise.SB_RANGE_LO,
+        "sb_range_hi": Normalise.SB_RANGE_HI,
+        "min_mqmr": Normalise.MIN_MQMR,
+        "min_aqr": Normalise.MIN_AQR,
+        "min_vaf": 0.0,
+    }
+    SUMMARY_COLUMNS = ["variants", "pass", "fail", "report_rows", "pass_report_rows"]
+
+    def __init__(
+        self,
+        debug,
+        grid,
+        files=None,
+        vcf=None,
+        reference=None,
+        genome=None,
+        prefix=None,
+        output_dir=".",
+        region=None,
+        bam_list=False,
+        allsamples=False,
+        blacklist=None,
+        threads=1,
+        keep=False,
+        write_vcfs=False,
+    ):
+        self.debug = debug
+        self.grid = grid
+        self.files = files
+        self.vcf = vcf
+        self.reference = reference
+        self.genome = genome
+        self.prefix = prefix
+        self.output_dir = output_dir
+        self.region = region
+        self.bam_list = bam_list
+        self.allsamples = allsamples
+        self.blacklist = blacklist
+        self.threads = threads
+        self.keep = keep
+        self.write_vcfs = write_vcfs
+
+        self.grid_points = []
+        self.header = None
+        self.records = []
+        self.pos_flag = None
+        self.AO = None
+        self.DP = None
+        self.fraction = None
+        self.VAF = None
+        self.summary = []
+        self.summary_path = ""
+
+        self.run()
+
+    def run(self):
+        """
+        Run mity sweep.
+        """
+        if self.debug:
+            logger.setLevel(logging.DEBUG)
+            logger.debug("Entered debug mode.")
+        else:
+            logger.setLevel(logging.INFO)
+
+        self.grid_points = self.read_grid(self.grid)
+        logger.info("Sweeping %s grid points", len(self.grid_points))
+
+        if self.vcf is None:
+            self.run_call()
+        if self.prefix is None:
+            self.prefix = MityUtil.make_prefix(self.vcf)
+        self.summary_path = os.path.join(self.output_dir, self.prefix + ".sweep.tsv")
+
+        self.load_records()
+
+        for i, point in enumerate(self.grid_points):
+            self.summary.append(self.evaluate(i, point))
+        self.write_summary()
+
+    @classmethod
+    def read_grid(cls, grid_path):
+        """
+        Reads a yaml file of the values of each grid parameter, e.g.
+
+            min_alternate_fraction: [0.01, 0.02]
+            p: [0.002, 0.01]
+            min_dp: 15
+
+        Parameters that are not given keep their default value.
+
+        Returns:
+            - list: A dictionary of the value of every parameter, for each point
+              of the grid.
+        """
+        with open(grid_path, "r", encoding="utf-8") as grid_file:
+            grid = yaml.safe_load(grid_file) or {}
+
+        unknown = set(grid) - set(cls.GRID_DEFAULTS)
+        if unknown:
+            raise ValueError(
+                f"Unknown sweep parameters: {', '.join(sorted(unknown))}. "
+                f"The parameters are: {', '.join(cls.GRID_DEFAULTS)}"
+            )
+
+        values = []
+        for name, default in cls.GRID_DEFAULTS.items():
+            value = grid.get(name, default)
+            values.append(value if isinstance(value, list) else [value])
+
+        return [dict(zip(cls.GRID_DEFAULTS, point)) for point in itertools.product(*values)]
+
+    def run_call(self):
+        """
+        Runs mity call and normalise once, at the most permissive call thresholds
+        of the grid.
+        """
+        call = Call(
+            debug=self.debug,
+            files=[self.files],
+            reference=self.reference,
+            genome=self.genome,
+            prefix=self.prefix,
+            min_af=min(point["min_alternate_fraction"] for point in self.grid_points),
+            min_ac=min(point["min_alternate_count"] for point in self.grid_points),
+            normalise=True,
+            output_dir=self.output_dir,
+            region=self.region,
+            bam_list=self.bam_list,
+            keep=self.keep,
+            threads=self.threads,
+            blacklist=self.blacklist,
+        )
+        self.prefix = call.prefix
+        self.vcf = os.path.join(self.output_dir, self.prefix + ".normalise.vcf.gz")
+
+    def make_refilter(self, point):
+        """
+        Makes a Refilter with the thresholds of a grid point, for the
+        normalised vcf.
+
+        Parameters:
+            - point (dict): The value of each grid parameter.
+
+        Returns:
+            - Refilter: The refilter, which has no vcfs of its own to refilter.
+        """
+        refilter = Refilter(
+            debug=self.debug,
+            vcfs=[],
+            output_dir=self.output_dir,
+            allsamples=self.allsamples,
+            p=point["p"],
+            min_dp=point["min_dp"],
+            sb_range_lo=point["sb_range_lo"],
+            sb_range_hi=point["sb_range_hi"],
+            min_mqmr=point["min_mqmr"],
+            min_aqr=point["min_aqr"],
+            blacklist=self.blacklist,
+        )
+        refilter.load_vcf(self.vcf)
+        return refilter
+
+    def load_records(self):
+        """
+        Reads the normalised variants into memory, without the values added by
+        mity normalise, and calculates the values that are the same for every
+        grid point.
+        """
+        # the blacklist and the normalise values do not depend on the thresholds
+        refilter = self.make_refilter(self.grid_points[0])
+        with pysam.VariantFile(self.vcf) as vcf:
+            self.header = vcf.header.copy()
+        self.records = [
+            refilter.strip_filters(line.rstrip("\n").split("\t"))
+            for line in MityUtil.read_vcf_lines(self.vcf)
+        ]
+        self.pos_flag = refilter.get_blacklist_flags(self.records)
+
+        # samples x variants arrays of the read counts
+        AO = []
+        DP = []
+        for fields in self.records:
+            _, values = Normalise.parse_sample_columns(fields)
+            AO.append(Normalise.parse_integers(values["AO"]))
+            DP.append(Normalise.parse_integers(values["DP"]))
+        self.AO = np.array(AO, dtype=np.int64).reshape(len(self.records), -1).T
+        self.DP = np.array(DP, dtype=np.int64).reshape(len(self.records), -1).T
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.fraction = np.where(self.DP > 0, self.AO / self.DP, 0.0)
+        self.VAF = Normalise.round_array(self.fraction, 4)
+
+    def evaluate(self, i, point):
+        """
+        Evaluates one point of the grid.
+
+        Parameters:
+            - i (int): The number of the grid point.
+            - point (dict): The value of each grid parameter.
+
+        Returns:
+            - dict: The grid point values and the summary columns.
+        """
+        refilter = self.make_refilter(point)
+
+        called = (
+            (self.AO >= point["min_alternate_count"])
+            & (self.fraction >= point["min_alternate_fraction"])
+        ).any(axis=0)
+        records = [fields for fields, keep in zip(self.records, called) if keep]
+        pos_flag = self.pos_flag[called]
+        num_samples = self.AO.shape[0]
+
+        lines = []
+        if records:
+            sample_columns, failed = refilter.filter_samples(
+                records, refilter.p, pos_flag, refilter.get_thresholds()
+            )
+            lines = refilter.make_lines(records, [sample_columns], [failed], num_samples, pos_flag)
+        passed = np.array([line.split("\t", 7)[6].endswith("PASS") for line in lines], dtype=bool)
+
+        report_rows = (self.VAF[:, called] > point["min_vaf"]).sum(axis=0)
+        summary = dict(point)
+        summary["variants"] = len(lines)
+        summary["pass"] = int(passed.sum())
+        summary["fail"] = len(lines) - int(passed.sum())
+        summary["report_rows"] = int(report_rows.sum())
+        summary["pass_report_rows"] = int(report_rows[passed].sum())
+        logger.debug("Grid point %s: %s", i, summary)
+
+        if self.write_vcfs:
+            vcf_path = os.path.join(self.output_dir, f"{self.prefix}.sweep.{i}.vcf.gz")
+            writer = SortedVcfWriter(vcf_path, refilter.make_header(self.header.copy()))
+            for line in lines:
+                writer.write_line(line)
+            writer.close()
+
+        return summary
+
+    def write_summary(self):
+        """
+        Writes the summary of every grid point to a tsv, with one row per point.
+        """
+        columns = ["point"] + list(self.GRID_DEFAULTS) + self.SUMMARY_COLUMNS
+        with open(self.summary_path, "w", encoding="utf-8") as summary_file:
+            summary_file.write("\t".join(columns) + "\n")
+            for i, summary in enumerate(self.summary):
+                row = [i] + [summary[column] for column in columns[1:]]
+                summary_file.write("\t".join(str(value) for value in row) + "\n")
+        logger.info("Wrote the sweep summary to %s", self.summary_path)
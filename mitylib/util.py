@@ -2,13 +2,20 @@
 Contains utility functions for mity modules.
 """
 
+import gzip
+import hashlib
+import heapq
 import logging
 import os
+import resource
+import struct
 import subprocess
 import sys
+import zlib
 from glob import glob
-from typing import Optional, Tuple
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple, Union
 import pysam
+import pysam.bcftools
 
 
 class MityUtil:
@@ -19,6 +26,12 @@ class MityUtil:
     MITY_DIR = "mitylib"
     REF_DIR = "reference"
     ANNOT_DIR = "annot"
+    # file extension of each --output-type
+    OUTPUT_TYPES = {"vcf": ".vcf.gz", "bcf": ".bcf"}
+    # the empty block at the end of a BGZF file
+    BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+    # the uncompressed size of a BGZF block, as written by htslib
+    BGZF_BLOCK_SIZE = 0xFF00
 
     @staticmethod
     def get_mity_dir():
@@ -30,6 +43,34 @@ class MityUtil:
         """
         return os.path.dirname(sys.modules["mitylib"].__file__)
 
+    @staticmethod
+    def get_cache_dir():
+        """
+        Get the directory used for mity's caches. This is $XDG_CACHE_HOME/mity
+        if XDG_CACHE_HOME is set, otherwise ~/.cache/mity.
+
+        Returns:
+            str: The path to the cache directory.
+        """
+        cache_home = os.environ.get(
+            "XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")
+        )
+        return os.path.join(cache_home, "mity")
+
+    @staticmethod
+    def get_peak_memory() -> float:
+        """
+        Get the peak resident memory of this process so far.
+
+        Returns:
+            float: The peak resident set size in MB.
+        """
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and kilobytes on Linux
+        if sys.platform == "darwin":
+            return max_rss / 1024 / 1024
+        return max_rss / 1024
+
     @staticmethod
     def tabix(bgzipped_file: str) -> None:
         """
@@ -102,17 +143,69 @@ class MityUtil:
         return res[0]
 
     @staticmethod
-    def vcf_get_mt_contig(vcf: str) -> Tuple[str, Optional[int]]:
+    def select_vcfanno_config(
+        contig: str,
+        vcfanno_config: Optional[str] = None,
+        vcfanno_base_path: Optional[str] = None,
+    ) -> Tuple[str, Optional[str]]:
+        """
+        Select the vcfanno config of the annotation sources.
+
+        Parameters:
+            contig (str): The mitochondrial contig, MT or chrM.
+            vcfanno_config (str, optional): The path to a custom vcfanno config, or None.
+            vcfanno_base_path (str, optional): The base path of the custom annotations.
+
+        Returns:
+            tuple: The path to the vcfanno config and the base path of its sources.
+        """
+        if vcfanno_config is not None:
+            return vcfanno_config, vcfanno_base_path
+
+        config_path = os.path.join(MityUtil.get_mity_dir(), "config")
+        match contig:
+            case "MT":
+                vcfanno_config = os.path.join(config_path, "vcfanno-config-mt.toml")
+            case "chrM":
+                vcfanno_config = os.path.join(config_path, "vcfanno-config-chrm.toml")
+            case _:
+                raise ValueError(
+                    "Contig not recognised, please specify a valid contig (either MT or chrM)"
+                )
+        return vcfanno_config, MityUtil.get_mity_dir()
+
+    @staticmethod
+    def get_file_checksum(file_name: str) -> str:
+        """
+        Get the SHA-256 checksum of the contents of a file.
+
+        Parameters:
+            file_name (str): The path to the file.
+
+        Returns:
+            str: The hex digest of the file.
+        """
+        checksum = hashlib.sha256()
+        with open(file_name, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                checksum.update(chunk)
+        return checksum.hexdigest()
+
+    @staticmethod
+    def vcf_get_mt_contig(vcf: Union[str, pysam.VariantFile]) -> Tuple[str, Optional[int]]:
         """
         Get the mitochondrial contig name and length from a VCF file.
 
         Parameters:
-            vcf (str): Path to a VCF file.
+            vcf (str or VariantFile): Path to a VCF file, or an open VariantFile.
 
         Returns:
             tuple: A tuple of contig name as a str and length as an int.
         """
-        r = pysam.VariantFile(vcf, "r")
+        if isinstance(vcf, pysam.VariantFile):
+            r = vcf
+        else:
+            r = pysam.VariantFile(vcf, "r")
         chroms = r.header.contigs
         mito_contig_intersection = set(["MT", "chrM"]).intersection(chroms)
 
@@ -151,6 +244,7 @@ class MityUtil:
             prefix.mity.call.vcf.gz
             prefix.mity.normalise.vcf.gz
             prefix.mity.merge.vcf.gz
+            prefix.refilter.vcf.gz
             prefix.report.xlsx
         """
 
@@ -160,17 +254,325 @@ class MityUtil:
             .replace(".call", "")
             .replace(".normalise", "")
             .replace(".merge", "")
+            .replace(".refilter", "")
             .replace(".report", "")
             .replace(".vcf.gz", "")
+            .replace(".bcf", "")
         )
 
         return prefix
 
     @staticmethod
-    def gsort(input_path: str, output_path: str, genome: str):
+    def index_vcf(vcf_path: str, csi: bool = False) -> None:
+        """
+        Index a bgzipped vcf or a bcf in-process with pysam. BCFs always get a
+        CSI index.
+
+        Parameters:
+            vcf_path (str): The path to a bgzipped vcf or a bcf.
+            csi (bool): Make a CSI index instead of a TBI index.
+        """
+        logging.debug("Indexing %s", vcf_path)
+        if MityUtil.is_bcf(vcf_path):
+            pysam.bcftools.index("-f", vcf_path)
+        else:
+            pysam.tabix_index(vcf_path, preset="vcf", force=True, csi=csi)
+
+    @staticmethod
+    def is_bcf(vcf_path: str) -> bool:
+        """
+        Check whether a path is a BCF file, from its extension.
+        """
+        return vcf_path.endswith(".bcf")
+
+    @staticmethod
+    def convert_to_bcf(vcf_path: str, bcf_path: str) -> None:
+        """
+        Convert a vcf to a CSI indexed bcf.
+
+        Parameters:
+            vcf_path (str): The path to a vcf, which can be bgzipped.
+            bcf_path (str): The path to write the bcf to.
+        """
+        logging.debug("Converting %s to %s", vcf_path, bcf_path)
+        pysam.bcftools.view("-Ob", "--write-index", "-o", bcf_path, vcf_path, catch_stdout=False)
+
+    @staticmethod
+    def read_vcf_lines(vcf_path: str) -> Iterator[str]:
+        """
+        Yields the variant lines of a vcf or bcf as vcf text.
+
+        Parameters:
+            vcf_path (str): The path to a vcf, which can be bgzipped, or a bcf.
+        """
+        if MityUtil.is_bcf(vcf_path):
+            with pysam.VariantFile(vcf_path) as vcf:
+                for variant in vcf:
+                    yield str(variant)
+            return
+
+        with (
+            gzip.open(vcf_path, "rt")
+            if vcf_path.endswith(".gz")
+            else open(vcf_path, "r", encoding="utf-8") as vcf
+        ):
+            for line in vcf:
+                if not line.startswith("#"):
+                    yield line
+
+    @staticmethod
+    def read_index_offsets(index_path: str) -> Dict[str, Tuple[int, int]]:
+        """
+        Read the range of BGZF virtual offsets of the records of each contig
+        from a TBI or CSI index of a bgzipped vcf.
+
+        Parameters:
+            index_path (str): The path to a .tbi or .csi index.
+
+        Returns:
+            dict: (begin, end) virtual offsets by contig name, in the order of
+            the index. Empty if the index has no contig names, e.g. the CSI
+            index of a bcf.
+        """
+        with gzip.open(index_path, "rb") as index_file:
+            data = index_file.read()
+
+        def read(fmt, offset):
+            return struct.unpack_from(fmt, data, offset), offset + struct.calcsize(fmt)
+
+        (magic,), offset = read("4s", 0)
+        if magic == b"TBI\1":
+            (num_refs,), offset = read("<i", offset)
+            (names_length,), offset = read("<24xi", offset)
+            names_offset = offset
+            offset += names_length
+            pseudo_bin = 37450
+        elif magic == b"CSI\1":
+            (_, depth, aux_length), offset = read("<3i", offset)
+            names_offset = offset + 28
+            names_length = 0
+            if aux_length >= 28:
+                (names_length,), _ = read("<24xi", offset)
+            offset += aux_length
+            (num_refs,), offset = read("<i", offset)
+            pseudo_bin = ((1 << ((depth + 1) * 3)) - 1) // 7 + 1
+        else:
+            raise ValueError(f"{index_path} is not a TBI or CSI index")
+
+        names = data[names_offset : names_offset + names_length].split(b"\0")[:num_refs]
+        if len(names) < num_refs:
+            return {}
+
+        offsets = {}
+        for name in names:
+            (num_bins,), offset = read("<i", offset)
+            begin, end = None, None
+            for _ in range(num_bins):
+                if magic == b"TBI\1":
+                    (bin_id, num_chunks), offset = read("<Ii", offset)
+                else:
+                    (bin_id, _, num_chunks), offset = read("<IQi", offset)
+                chunks, offset = read(f"<{2 * num_chunks}Q", offset)
+                # the pseudo-bin holds index metadata instead of records
+                if bin_id == pseudo_bin or not chunks:
+                    continue
+                begin = min(chunks[0::2]) if begin is None else min(begin, *chunks[0::2])
+                end = max(chunks[1::2]) if end is None else max(end, *chunks[1::2])
+            if magic == b"TBI\1":
+                (num_intervals,), offset = read("<i", offset)
+                offset += 8 * num_intervals
+            if begin is not None:
+                offsets[name.decode()] = (begin, end)
+
+        return offsets
+
+    @staticmethod
+    def read_bgzf_block(bgzf_file: BinaryIO, block_offset: int) -> Tuple[bytes, int]:
+        """
+        Read and decompress the BGZF block at a file offset.
+
+        Returns:
+            tuple: The uncompressed data and the compressed size of the block.
+        """
+        bgzf_file.seek(block_offset)
+        header = bgzf_file.read(12)
+        if len(header) < 12 or header[:4] != b"\x1f\x8b\x08\x04":
+            raise ValueError(f"There is no BGZF block at offset {block_offset}")
+        (extra_length,) = struct.unpack("<H", header[10:12])
+        extra = bgzf_file.read(extra_length)
+
+        block_size = None
+        i = 0
+        while i + 4 <= extra_length:
+            (subfield_length,) = struct.unpack("<H", extra[i + 2 : i + 4])
+            if extra[i : i + 2] == b"BC":
+                (block_size,) = struct.unpack("<H", extra[i + 4 : i + 6])
+                block_size += 1
+            i += 4 + subfield_length
+        if block_size is None:
+            raise ValueError(f"There is no BGZF block at offset {block_offset}")
+
+        compressed = bgzf_file.read(block_size - 12 - extra_length)
+        return zlib.decompress(compressed[:-8], -15), block_size
+
+    @staticmethod
+    def read_bgzf_range(bgzf_file: BinaryIO, begin: int, end: int) -> bytes:
+        """
+        Read and decompress the data between two BGZF virtual offsets.
+        """
+        data = []
+        block_offset = begin >> 16
+        # an end at the start of a block does not need that block to be read
+        while block_offset < end >> 16 or (block_offset == end >> 16 and end & 0xFFFF):
+            block, block_size = MityUtil.read_bgzf_block(bgzf_file, block_offset)
+            start = begin & 0xFFFF if block_offset == begin >> 16 else 0
+            stop = end & 0xFFFF if block_offset == end >> 16 else len(block)
+            data.append(block[start:stop])
+            block_offset += block_size
+        return b"".join(data)
+
+    @staticmethod
+    def bgzf_compress(data: bytes) -> bytes:
+        """
+        Compress data into BGZF blocks, without the BGZF_EOF block. The blocks
+        can be written between BGZF blocks copied from another file.
+        """
+        blocks = []
+        for i in range(0, len(data), MityUtil.BGZF_BLOCK_SIZE):
+            chunk = data[i : i + MityUtil.BGZF_BLOCK_SIZE]
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+            compressed = compressor.compress(chunk) + compressor.flush()
+            blocks.append(
+                struct.pack(
+                    "<4BI2BH2BHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(compressed) + 25
+                )
+            )
+            blocks.append(compressed)
+            blocks.append(struct.pack("<II", zlib.crc32(chunk), len(chunk)))
+        return b"".join(blocks)
+
+    @staticmethod
+    def get_genome_contigs(genome: str) -> List[str]:
+        """
+        Get the contigs of a genome file, in order.
+
+        Parameters:
+            genome (str): The path to a genome file, with a contig name and length
+            on each line.
+
+        Returns:
+            list: The contig names.
+        """
+        with open(genome, "r", encoding="utf-8") as genome_file:
+            return [line.split("\t")[0].strip() for line in genome_file if line.strip()]
+
+
+class SortedVcfWriter:
+    """
+    Writes variants to a bgzipped and indexed vcf in sorted order, when the
+    variants are sorted apart from some that have been moved by a few bases,
+    e.g. by left aligning indels after splitting multiallelic variants.
+
+    Variants are held in a small buffer and only written once a variant more
+    than WINDOW bases further along the contig has been added. Contigs are
+    sorted by contig_order, e.g. from a genome file, and then by the order
+    they are first seen.
+
+    The vcf is written with pysam and indexed in-process when it is closed, so
+    no gsort, bgzip or tabix processes are needed. If vcf_path ends in .bcf,
+    the text is written to a temporary vcf, which is converted to a CSI
+    indexed bcf when the writer is closed.
+    """
+
+    WINDOW = 1000
+
+    def __init__(
+        self,
+        vcf_path: str,
+        header: Union[pysam.VariantHeader, str],
+        window: int = WINDOW,
+        contig_order: Optional[List[str]] = None,
+        csi: bool = False,
+    ):
+        self.vcf_path = vcf_path
+        self.window = window
+        self.csi = csi
+
+        if isinstance(header, pysam.VariantHeader):
+            if contig_order is None:
+                contig_order = list(header.contigs)
+            # copying the header formats it in the same way as pysam writes it
+            header = str(header.copy())
+        self.contig_index = {contig: i for i, contig in enumerate(contig_order or [])}
+
+        if MityUtil.is_bcf(vcf_path):
+            self.text_path = vcf_path[: -len(".bcf")] + ".tmp.vcf"
+            self.vcf_file = open(self.text_path, "wb")
+        else:
+            self.text_path = vcf_path
+            self.vcf_file = pysam.BGZFile(vcf_path, "wb")
+        self.vcf_file.write(header.encode())
+
+        self.buffer: list = []
+        self.num_added = 0
+        self.last_written: Tuple[int, int] = (-1, -1)
+
+    def write(self, variant: pysam.VariantRecord) -> None:
+        """
+        Add a variant, writing any buffered variants that can no longer be
+        preceded by a later variant.
+        """
+        self.add(variant.chrom, variant.pos, str(variant))
+
+    def write_line(self, line: str) -> None:
+        """
+        Add a variant as a line of vcf text, ending in a new line.
+        """
+        contig, pos, _ = line.split("\t", 2)
+        self.add(contig, int(pos), line)
+
+    def get_key(self, line: str) -> Tuple[int, int]:
+        """
+        Get the sort key of a line of vcf text.
+        """
+        contig, pos, _ = line.split("\t", 2)
+        return self.contig_index.setdefault(contig, len(self.contig_index)), int(pos)
+
+    def add(self, contig: str, pos: int, line: str) -> None:
+        """
+        Add a line of vcf text for a variant at contig:pos.
+        """
+        contig_index = self.contig_index.setdefault(contig, len(self.contig_index))
+        key = (contig_index, pos)
+        if key < self.last_written:
+            raise ValueError(f"{contig}:{pos} is out of order by more than {self.window} bases")
+
+        # num_added breaks ties so that variants at the same position keep their order
+        heapq.heappush(self.buffer, (key, self.num_added, line))
+        self.num_added += 1
+
+        while self.buffer and (
+            self.buffer[0][0][0] < contig_index or self.buffer[0][0][1] < pos - self.window
+        ):
+            self.write_next()
+
+    def write_next(self) -> None:
+        """
+        Write the first buffered variant.
+        """
+        key, _, line = heapq.heappop(self.buffer)
+        self.vcf_file.write(line.encode())
+        self.last_written = key
+
+    def close(self) -> None:
         """
-        Run gsort.
+        Write the remaining variants, close and index the vcf.
         """
-        gsort_cmd = f"gsort {input_path} {genome} | bgzip -cf > {output_path}"
-        subprocess.run(gsort_cmd, shell=True, check=False)
-        MityUtil.tabix(output_path)
+        while self.buffer:
+            self.write_next()
+        self.vcf_file.close()
+        if self.text_path != self.vcf_path:
+            MityUtil.convert_to_bcf(self.text_path, self.vcf_path)
+            os.remove(self.text_path)
+        else:
+            MityUtil.index_vcf(self.vcf_path, self.csi)
@@ -0,0 +1,189 @@
+import gzip
+import os
+import numpy as np
+import pysam
+import pytest
+import mitylib
+from mitylib.call import Call
+from mitylib.normalise import Normalise
+
+REFERENCE = os.path.join(mitylib.__path__[0], "reference", "hs37d5.MT.fa")
+
+
+def write_freebayes_vcf(path, num_samples, num_variants, seed=0):
+    """
+    Writes a vcf of SNVs on MT with random values for the FreeBayes fields used
+    by mity normalise. The REF alleles match the reference.
+    """
+    rng = np.random.default_rng(seed)
+    header = [
+        "##fileformat=VCFv4.2",
+        "##contig=<ID=MT,length=16569>",
+    ]
+    for key in ["SRF", "SRR", "SAF", "SAR"]:
+        number = "A" if key in ("SAF", "SAR") else "1"
+        header.append(f'##INFO=<ID={key},Number={number},Type=Integer,Description="{key}">')
+    header.append('##INFO=<ID=MQMR,Number=1,Type=Float,Description="MQMR">')
+    header.append('##FORMAT=<ID=GT,Number=1,Type=String,Description="GT">')
+    for key in ["DP", "RO", "QR", "AO", "QA"]:
+        number = "A" if key in ("AO", "QA") else "1"
+        header.append(f'##FORMAT=<ID={key},Number={number},Type=Integer,Description="{key}">')
+    samples = [f"S{i}" for i in range(num_samples)]
+    header.append(
+        "\t".join(
+            ["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT"] + samples
+        )
+    )
+
+    with pysam.FastaFile(REFERENCE) as fasta:
+        sequence = fasta.fetch("MT")
+
+    lines = []
+    positions = sorted(rng.choice(np.arange(1, 16570), num_variants, replace=False))
+    positions[:3] = [302, 310, 3106]
+    for pos in sorted(positions):
+        ref = sequence[pos - 1]
+        alt = "G" if ref != "G" else "T"
+        SRF, SRR, SAF, SAR = rng.integers(0, 100, 4)
+        SAF += 1
+        MQMR = rng.choice([20, 29.5, 30, 60])
+        AO = rng.integers(0, 200, num_samples)
+        RO = rng.integers(0, 200, num_samples)
+        RO[rng.random(num_samples) < 0.2] = 0
+        QA = AO * rng.integers(10, 40, num_samples)
+        QR = RO * rng.integers(10, 40, num_samples)
+        DP = AO + RO
+        info = f"SRF={SRF};SRR={SRR};SAF={SAF};SAR={SAR};MQMR={MQMR:g}"
+        sample_columns = [
+            f"0/1:{DP[i]}:{RO[i]}:{QR[i]}:{AO[i]}:{QA[i]}" for i in range(num_samples)
+        ]
+        lines.append(
+            "\t".join(
+                ["MT", str(pos), ".", ref, alt, "50", ".", info, "GT:DP:RO:QR:AO:QA"]
+                + sample_columns
+            )
+        )
+
+    with open(path, "w") as f:
+        f.write("\n".join(header + lines) + "\n")
+
+
+@pytest.fixture
+def make_freebayes_vcf():
+    """
+    Returns a function that writes a vcf of random FreeBayes values, see
+    write_freebayes_vcf.
+    """
+    return write_freebayes_vcf
+
+
+@pytest.fixture
+def run_normalise(monkeypatch):
+    """
+    Returns a function that runs mity normalise on a vcf, with native
+    normalisation so that no bcftools header lines are added, and returns the
+    Normalise object. The normalised vcf is written next to the input.
+
+    The columnar engine reads blocks of 64 variants of 30 samples, so the tests
+    cover more than one block. Other filter thresholds are given by their
+    Normalise attribute name, e.g. {"MIN_DP": 50}.
+    """
+    monkeypatch.setattr(Normalise, "COLUMNAR_BLOCK_SIZE", 30 * 64)
+
+    def run(
+        vcf_path,
+        prefix,
+        engine="record",
+        allsamples=False,
+        threads=1,
+        raw_format=False,
+        thresholds=None,
+        output_type="vcf",
+    ):
+        with monkeypatch.context() as patch:
+            for name, value in (thresholds or {}).items():
+                patch.setattr(Normalise, name, value)
+            return Normalise(
+                debug=False,
+                vcf=vcf_path,
+                reference_fasta=REFERENCE,
+                genome=None,
+                output_dir=os.path.dirname(vcf_path),
+                prefix=prefix,
+                allsamples=allsamples,
+                engine=engine,
+                threads=threads,
+                native_norm=True,
+                raw_format=raw_format,
+                output_type=output_type,
+            )
+
+    return run
+
+
+@pytest.fixture
+def normalise(tmp_path, make_freebayes_vcf, run_normalise):
+    """
+    Returns a Normalise object that has normalised a small vcf, with the
+    reference and the default blacklist loaded.
+    """
+    vcf_path = str(tmp_path / "fixture.vcf")
+    make_freebayes_vcf(vcf_path, num_samples=1, num_variants=5)
+    return run_normalise(vcf_path, "fixture")
+
+
+@pytest.fixture
+def variant_lines():
+    """
+    Returns a function that reads the variant lines of a bgzipped vcf.
+    """
+
+    def read(vcf_path):
+        with gzip.open(vcf_path, "rt") as f:
+            return [line for line in f if not line.startswith("#")]
+
+    return read
+
+
+@pytest.fixture
+def make_call(tmp_path):
+    """
+    Returns a function that runs mity call on a BAM of a few MT reads, by
+    default with the pileup engine and without normalising, and returns the
+    Call object. Other keyword arguments are passed to Call.
+    """
+    bam_path = str(tmp_path / "sample.bam")
+    header = {
+        "HD": {"VN": "1.6", "SO": "coordinate"},
+        "SQ": [{"SN": "MT", "LN": 16569}],
+        "RG": [{"ID": "rg1", "SM": "sample"}],
+    }
+    with pysam.FastaFile(REFERENCE) as fasta:
+        sequence = fasta.fetch("MT", 1000, 1050)
+    with pysam.AlignmentFile(bam_path, "wb", header=header) as bam:
+        for i in range(5):
+            read = pysam.AlignedSegment(bam.header)
+            read.query_name = f"read{i}"
+            read.reference_id = 0
+            read.reference_start = 1000
+            read.query_sequence = sequence
+            read.query_qualities = pysam.qualitystring_to_array("I" * len(sequence))
+            read.cigarstring = f"{len(sequence)}M"
+            read.mapping_quality = 60
+            read.set_tag("RG", "rg1")
+            bam.write(read)
+    pysam.index(bam_path)
+
+    def run(region, threads, **kwargs):
+        options = {"normalise": False, "engine": "pileup", **kwargs}
+        return Call(
+            debug=False,
+            files=[[bam_path]],
+            reference=REFERENCE,
+            output_dir=str(tmp_path),
+            region=region,
+            threads=threads,
+            **options,
+        )
+
+    return run
@@ -0,0 +1,348 @@
+import logging
+import os
+import sqlite3
+import time
+import zipfile
+import pysam
+import pytest
+import mitylib
+from mitylib.annotate import AnnotationBundle, AnnotationCache, AnnotationLookup, Annotator
+from mitylib.report import Report, SingleReport
+
+MITY_DIR = mitylib.__path__[0]
+MT_CONFIG = os.path.join(MITY_DIR, "config", "vcfanno-config-mt.toml")
+REPORT_CONFIG = os.path.join(MITY_DIR, "config", "report-config.yaml")
+
+HEADER = """##fileformat=VCFv4.2
+##contig=<ID=MT,length=16569>
+##INFO=<ID=DP,Number=1,Type=Integer,Description="Total read depth at the locus">
+##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
+##FORMAT=<ID=VAF,Number=A,Type=Float,Description="Allele fraction">
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1
+"""
+
+
+def test_native_annotator_joins_vcf_and_bed_sources():
+    """
+    VCF sources are joined by pos, ref and alt, and BED sources by overlap.
+    """
+    annotator = Annotator(MT_CONFIG, MITY_DIR)
+
+    header = pysam.VariantHeader()
+    header.contigs.add("MT", length=16569)
+    variant = header.new_record(contig="MT", start=576, alleles=("G", "A"))
+    annotations = annotator.annotate(variant)
+
+    assert annotations["MITOTIP_SCORE"] == 17.75
+    assert annotations["GENE"] == '"MT-TF"'
+
+    # another alt at the same position only gets the BED annotations
+    variant = header.new_record(contig="MT", start=576, alleles=("G", "GT"))
+    annotations = annotator.annotate(variant)
+    assert "MITOTIP_SCORE" not in annotations
+    assert annotations["GENE"] == '"MT-TF"'
+
+
+def test_native_annotator_rejects_other_ops(tmp_path):
+    """
+    Only the self op is supported.
+    """
+    config = tmp_path / "config.toml"
+    config.write_text(
+        '[[annotation]]\nfile="annot_mt/mgrb_variants.vcf.gz"\n'
+        'fields=["MGRB_AC"]\nnames=["MGRB_AC"]\nops=["max"]\n'
+    )
+    with pytest.raises(ValueError, match="self"):
+        Annotator(str(config), MITY_DIR)
+
+
+def test_report_with_native_annotator(tmp_path):
+    """
+    mity report annotates the variants in memory, without a vcfanno output.
+    """
+    vcf_path = str(tmp_path / "sample.normalise.vcf.gz")
+    with pysam.BGZFile(vcf_path, "wb") as vcf:
+        vcf.write(HEADER.encode())
+        vcf.write(b"MT\t577\t.\tG\tA\t50\tPASS\tDP=10\tGT:VAF\t0/1:0.5\n")
+
+    report = SingleReport(
+        vcf_path=vcf_path,
+        min_vaf=0.0,
+        keep=False,
+        vcfanno_base_path=MITY_DIR,
+        vcfanno_config=MT_CONFIG,
+        report_config=REPORT_CONFIG,
+        prefix="sample",
+        output_dir=str(tmp_path),
+        annotator=Annotator(MT_CONFIG, MITY_DIR),
+    )
+    df = report.get_df()
+
+    assert list(df["GENE"]) == ["MT-TF"]
+    assert list(df["HGVS"]) == ["m.577G>A"]
+    assert "MITOTIP_SCORE=17.75" in df["INFO"][0]
+    assert sorted(os.listdir(tmp_path)) == ["sample.normalise.vcf.gz"]
+
+
+def test_annotated_vcf_keeps_vcfanno_info_headers(tmp_path):
+    """
+    --output-annotated-vcf declares the annotations with the INFO header lines
+    of the vcfanno output, and writes their values with those types.
+    """
+    vcf_path = str(tmp_path / "sample.normalise.vcf.gz")
+    with pysam.BGZFile(vcf_path, "wb") as vcf:
+        vcf.write(HEADER.encode())
+        vcf.write(b"MT\t577\t.\tG\tA\t50\tPASS\tDP=10\tGT:VAF\t0/1:0.5\n")
+
+    info_records = {
+        "MITOTIP_SCORE": "##INFO=<ID=MITOTIP_SCORE,Number=1,Type=Float,"
+        'Description="calculated by self of overlapping values in field '
+        'MITOTIP_SCORE from mitotip_score_fixed.vcf.gz">\n',
+        "MGRB_AC": "##INFO=<ID=MGRB_AC,Number=A,Type=Integer,"
+        'Description="calculated by self of overlapping values in field '
+        'MGRB_AC from mgrb_variants.vcf.gz">\n',
+    }
+    lookup = AnnotationLookup(
+        ["MITOTIP_SCORE", "MGRB_AC", "GENE"],
+        {
+            ("MT", 577, "G", ("A",)): {
+                "MITOTIP_SCORE": 17.75,
+                "MGRB_AC": (3,),
+                "GENE": "MT-TF",
+            }
+        },
+        info_records,
+    )
+    SingleReport(
+        vcf_path=vcf_path,
+        min_vaf=0.0,
+        keep=True,
+        vcfanno_base_path=MITY_DIR,
+        vcfanno_config=MT_CONFIG,
+        report_config=REPORT_CONFIG,
+        prefix="sample",
+        output_dir=str(tmp_path),
+        output_annotated_vcf=True,
+        annotator=lookup,
+    )
+
+    with pysam.VariantFile(str(tmp_path / "sample.normalise.mity.annotated.vcf")) as vcf:
+        for name, record in info_records.items():
+            assert str(vcf.header.info[name].record) == record
+        assert vcf.header.info["GENE"].type == "String"
+        variant = next(iter(vcf))
+        assert variant.info["MITOTIP_SCORE"] == 17.75
+        assert variant.info["MGRB_AC"] == (3,)
+        assert variant.info["GENE"] == ("MT-TF",)
+
+
+def test_annotation_bundle_matches_native_annotator(tmp_path):
+    """
+    The compiled bundle gives the same annotations as the annotation sources.
+    """
+    annotator = Annotator(MT_CONFIG, MITY_DIR)
+    bundle_path = str(tmp_path / "mt.bundle")
+    AnnotationBundle.compile(annotator, bundle_path)
+    bundle = AnnotationBundle(bundle_path)
+
+    header = pysam.VariantHeader()
+    header.contigs.add("MT", length=16569)
+    for start, alleles in [
+        (576, ("G", "A")),
+        (576, ("G", "GT")),
+        (3242, ("G", "A")),
+        (8992, ("ACGTA", "A")),
+        (16568, ("T", "C")),
+    ]:
+        variant = header.new_record(contig="MT", start=start, alleles=alleles)
+        assert bundle.annotate(variant) == annotator.annotate(variant)
+    assert bundle.names == annotator.names
+
+
+def test_annotation_bundle_is_compiled_again_when_a_source_changes(tmp_path):
+    """
+    AnnotationBundle.load compiles the bundle again when a source's checksum
+    changes.
+    """
+    source = tmp_path / "source.vcf"
+    source_header = (
+        "##fileformat=VCFv4.2\n##contig=<ID=MT,length=16569>\n"
+        '##INFO=<ID=SCORE,Number=1,Type=Float,Description="Score">\n'
+        "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"
+    )
+
+    def write_source(score):
+        source.write_text(source_header + f"MT\t577\t.\tG\tA\t.\t.\tSCORE={score}\n")
+        pysam.tabix_index(str(source), preset="vcf", force=True)
+
+    config = tmp_path / "config.toml"
+    config.write_text(
+        '[[annotation]]\nfile="source.vcf.gz"\nfields=["SCORE"]\nnames=["SCORE"]\nops=["self"]\n'
+    )
+    bundle_path = str(tmp_path / "config.bundle")
+
+    header = pysam.VariantHeader()
+    header.contigs.add("MT", length=16569)
+    variant = header.new_record(contig="MT", start=576, alleles=("G", "A"))
+
+    write_source(1.5)
+    bundle = AnnotationBundle.load(str(config), str(tmp_path), bundle_path)
+    assert isinstance(bundle, AnnotationBundle)
+    assert bundle.annotate(variant) == {"SCORE": 1.5}
+    assert AnnotationBundle.is_current(bundle_path, str(config), str(tmp_path))
+
+    write_source(2.5)
+    assert not AnnotationBundle.is_current(bundle_path, str(config), str(tmp_path))
+    bundle = AnnotationBundle.load(str(config), str(tmp_path), bundle_path)
+    assert bundle.annotate(variant) == {"SCORE": 2.5}
+
+
+def test_annotation_cache_hits_misses_and_eviction(tmp_path):
+    """
+    Cached variants are not annotated again, and the least recently used
+    variants are evicted beyond max_variants.
+    """
+    annotator = Annotator(MT_CONFIG, MITY_DIR)
+    cache_path = str(tmp_path / "annotations.sqlite")
+
+    header = pysam.VariantHeader()
+    header.contigs.add("MT", length=16569)
+    variants = [
+        header.new_record(contig="MT", start=start, alleles=alleles)
+        for start, alleles in [(576, ("G", "A")), (3242, ("A", "G")), (8992, ("T", "G"))]
+    ]
+
+    cache = AnnotationCache(annotator, cache_path, "config", max_variants=2)
+    for variant in variants[:2]:
+        assert cache.annotate(variant) == annotator.annotate(variant)
+    cache.close()
+    assert (cache.hits, cache.misses, cache.evicted) == (0, 2, 0)
+
+    time.sleep(0.01)
+    cache = AnnotationCache(annotator, cache_path, "config", max_variants=2)
+    for variant in variants[1:]:
+        assert cache.annotate(variant) == annotator.annotate(variant)
+    cache.close()
+    assert (cache.hits, cache.misses, cache.evicted) == (1, 1, 1)
+
+    # the first variant was the least recently used
+    cache = AnnotationCache(annotator, cache_path, "config", max_variants=2)
+    for variant in variants:
+        assert cache.annotate(variant) == annotator.annotate(variant)
+    cache.close()
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    # a different config does not share the cached annotations
+    with AnnotationCache(annotator, cache_path, "other config", max_variants=10) as cache:
+        cache.annotate(variants[0])
+    assert cache.connection is None
+    assert (cache.hits, cache.misses) == (0, 1)
+
+
+def test_report_annotates_distinct_variants_once(tmp_path, caplog):
+    """
+    mity report annotates the variants shared by several vcfs once.
+    """
+    vcf_paths = []
+    for name, rows in [
+        ("a", ["MT\t577\t.\tG\tA", "MT\t3243\t.\tA\tG"]),
+        ("b", ["MT\t577\t.\tG\tA", "MT\t8993\t.\tT\tG"]),
+    ]:
+        vcf_path = str(tmp_path / f"{name}.normalise.vcf.gz")
+        with pysam.BGZFile(vcf_path, "wb") as vcf:
+            vcf.write(HEADER.encode())
+            for row in rows:
+                vcf.write(f"{row}\t50\tPASS\tDP=10\tGT:VAF\t0/1:0.5\n".encode())
+        vcf_paths.append(vcf_path)
+
+    cache_path = str(tmp_path / "annotations.sqlite")
+    output_dir = tmp_path / "report"
+    caplog.set_level(logging.DEBUG, logger="mitylib.report")
+    Report(
+        debug=True,
+        vcfs=[vcf_paths],
+        contig="MT",
+        prefix="cohort",
+        output_dir=str(output_dir),
+        annotation_bundle=str(tmp_path / "mt.bundle"),
+        annotation_cache=cache_path,
+    )
+
+    assert os.listdir(output_dir) == ["cohort.mity.report.xlsx"]
+    assert "Annotating 3 distinct variants of 2 vcfs" in caplog.text
+    assert "Annotation cache: 0 hits, 3 misses" in caplog.text
+    with sqlite3.connect(cache_path) as connection:
+        rows = connection.execute("SELECT pos, ref, alt FROM annotations ORDER BY pos").fetchall()
+    assert rows == [(577, "G", "A"), (3243, "A", "G"), (8993, "T", "G")]
+
+
+def test_report_closes_the_annotation_cache_when_annotating_fails(tmp_path, monkeypatch):
+    """
+    If annotating a variant raises, mity report still closes the annotation
+    cache, which keeps the annotations of the variants annotated before it.
+    """
+    vcf_path = str(tmp_path / "a.normalise.vcf.gz")
+    with pysam.BGZFile(vcf_path, "wb") as vcf:
+        vcf.write(HEADER.encode())
+        for row in ["MT\t577\t.\tG\tA", "MT\t3243\t.\tA\tG"]:
+            vcf.write(f"{row}\t50\tPASS\tDP=10\tGT:VAF\t0/1:0.5\n".encode())
+
+    annotate = AnnotationBundle.annotate
+
+    def fail_at_3243(self, variant):
+        if variant.pos == 3243:
+            raise RuntimeError("annotation failed")
+        return annotate(self, variant)
+
+    monkeypatch.setattr(AnnotationBundle, "annotate", fail_at_3243)
+    cache_path = str(tmp_path / "annotations.sqlite")
+    with pytest.raises(RuntimeError, match="annotation failed"):
+        Report(
+            debug=False,
+            vcfs=[[vcf_path]],
+            contig="MT",
+            prefix="a",
+            output_dir=str(tmp_path / "report"),
+            annotation_bundle=str(tmp_path / "mt.bundle"),
+            annotation_cache=cache_path,
+        )
+
+    with sqlite3.connect(cache_path) as connection:
+        rows = connection.execute("SELECT pos, ref, alt FROM annotations").fetchall()
+    assert rows == [(577, "G", "A")]
+
+
+def test_report_sheets_in_parallel_match_serial(tmp_path):
+    """
+    The sheets made in worker processes are the same, and in the same order,
+    as the sheets made one at a time.
+    """
+    vcf_paths = []
+    for i, pos in enumerate([577, 3243, 8993]):
+        vcf_path = str(tmp_path / f"s{i}.normalise.vcf.gz")
+        with pysam.BGZFile(vcf_path, "wb") as vcf:
+            vcf.write(HEADER.encode())
+            vcf.write(f"MT\t{pos}\t.\tG\tA\t50\tPASS\tDP=10\tGT:VAF\t0/1:0.5\n".encode())
+        vcf_paths.append(vcf_path)
+
+    sheets = {}
+    for threads in [1, 2]:
+        output_dir = tmp_path / f"threads{threads}"
+        Report(
+            debug=False,
+            vcfs=[vcf_paths],
+            contig="MT",
+            prefix="cohort",
+            output_dir=str(output_dir),
+            annotation_bundle=str(tmp_path / "mt.bundle"),
+            annotation_cache_size=0,
+            threads=threads,
+        )
+        # the workbook properties have the time it was written
+        with zipfile.ZipFile(output_dir / "cohort.mity.report.xlsx") as xlsx:
+            sheets[threads] = {
+                name: xlsx.read(name) for name in xlsx.namelist() if name != "docProps/core.xml"
+            }
+
+    assert sheets[1] == sheets[2]
+    assert b"s0.normalise" in sheets[1]["xl/workbook.xml"]
@@ -0,0 +1,138 @@
+import os
+import threading
+import pysam
+import mitylib
+from mitylib.call import Call
+
+MITY_DIR = mitylib.__path__[0]
+
+
+def test_tiles_cover_region(make_call):
+    """
+    The tile cores partition the region, and each tile extends past its core
+    by at most TILE_OVERLAP bases.
+    """
+    call = make_call("MT:1-16569", 4)
+    tiles = call.make_tiles()
+
+    assert len(tiles) == 4
+    assert tiles[0][0] == 1
+    assert tiles[-1][1] == 16569
+    for (_, prev_end, _), (next_start, _, _) in zip(tiles, tiles[1:]):
+        assert next_start == prev_end + 1
+
+    for core_start, core_end, tile_region in tiles:
+        contig, start, end = call.parse_region(tile_region)
+        assert contig == "MT"
+        assert start == max(1, core_start - Call.TILE_OVERLAP)
+        assert end == min(16569, core_end + Call.TILE_OVERLAP)
+
+
+def test_more_threads_than_bases(make_call):
+    """
+    Small regions give fewer tiles than threads.
+    """
+    call = make_call("MT:1-3", 8)
+    assert [tile[:2] for tile in call.make_tiles()] == [(1, 1), (2, 2), (3, 3)]
+
+
+def test_stitch_tiles_deduplicates_overlaps(tmp_path, make_call):
+    """
+    Variants called in the overlap of two tiles are written once.
+    """
+    header = (
+        "##fileformat=VCFv4.2\n"
+        "##contig=<ID=MT,length=16569>\n"
+        "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"
+    )
+    tile_records = [[100, 200, 250], [200, 250, 300]]
+    tile_paths = []
+    for i, positions in enumerate(tile_records):
+        tile_path = str(tmp_path / f"tile{i}.vcf")
+        with open(tile_path, "w", encoding="utf-8") as tile:
+            tile.write(header)
+            for pos in positions:
+                tile.write(f"MT\t{pos}\t.\tA\tG\t50\t.\t.\n")
+        tile_paths.append(tile_path)
+
+    call = make_call("MT:1-400", 2)
+    call.call_vcf_path = str(tmp_path / "call.vcf.gz")
+    call.stitch_tiles([(1, 200, "MT:1-400"), (201, 400, "MT:1-400")], tile_paths)
+
+    with pysam.VariantFile(call.call_vcf_path) as call_vcf:
+        assert [variant.pos for variant in call_vcf] == [100, 200, 250, 300]
+
+
+def test_fill_missing_genotypes(tmp_path, make_call):
+    """
+    Samples without values at a site get zero counts so the matrix is complete.
+    """
+    input_path = tmp_path / "merged.vcf"
+    input_path.write_text(
+        "##fileformat=VCFv4.2\n"
+        "##contig=<ID=MT,length=16569>\n"
+        '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n'
+        '##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read depth">\n'
+        '##FORMAT=<ID=RO,Number=1,Type=Integer,Description="Reference count">\n'
+        '##FORMAT=<ID=AO,Number=A,Type=Integer,Description="Alternate count">\n'
+        "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\tS2\n"
+        "MT\t100\t.\tA\tG,T\t50\t.\t.\tGT:DP:RO:AO\t0/1:20:10:6,4\t.:.:.:.\n"
+    )
+    output_path = str(tmp_path / "filled.vcf.gz")
+
+    call = make_call("MT:1-400", 1)
+    call.fill_missing_genotypes(str(input_path), output_path)
+
+    with pysam.VariantFile(output_path) as filled_vcf:
+        variant = next(iter(filled_vcf))
+        assert variant.samples["S1"]["AO"] == (6, 4)
+        assert variant.samples["S2"]["DP"] == 0
+        assert variant.samples["S2"]["RO"] == 0
+        assert variant.samples["S2"]["AO"] == (0, 0)
+
+
+def test_stream_normalise_failure_does_not_hang(tmp_path, monkeypatch, make_call):
+    """
+    When mity normalise fails on the stream while freebayes is still writing,
+    mity call --stream raises the normalise error instead of waiting on the
+    full pipe.
+    """
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    freebayes = bin_dir / "freebayes"
+    # the REF of the first variant does not match the reference, and the
+    # output is much larger than the pipe buffer
+    freebayes.write_text(
+        "#!/bin/sh\n"
+        "printf '##fileformat=VCFv4.2\\n##contig=<ID=MT,length=16569>\\n'\n"
+        "printf '#CHROM\\tPOS\\tID\\tREF\\tALT\\tQUAL\\tFILTER\\tINFO\\n'\n"
+        "yes 'MT\t302\t.\tTTTT\tT\t50\t.\t.' | head -n 200000\n"
+        "echo 'freebayes was writing' >&2\n"
+    )
+    freebayes.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+    errors = []
+
+    def run():
+        try:
+            make_call(
+                "MT:1-400",
+                1,
+                engine="freebayes",
+                normalise=True,
+                stream=True,
+                genome=os.path.join(MITY_DIR, "reference", "hs37d5.genome"),
+            )
+        except Exception as error:
+            errors.append(error)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(60)
+
+    assert not thread.is_alive()
+    (error,) = errors
+    assert isinstance(error, ValueError)
+    assert "Reference allele mismatch" in str(error)
+    assert "FreeBayes stderr" in str(error.__cause__)
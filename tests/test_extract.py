@@ -0,0 +1,66 @@
+import os
+import pysam
+from mitylib.extract import Extract
+
+
+def make_bam(path):
+    """
+    Writes a small BAM with reads on 1 and MT.
+    """
+    header = {
+        "HD": {"VN": "1.6", "SO": "coordinate"},
+        "SQ": [{"SN": "1", "LN": 10000}, {"SN": "MT", "LN": 16569}],
+        "RG": [{"ID": "rg1", "SM": "sample1"}],
+    }
+    with pysam.AlignmentFile(path, "wb", header=header) as bam:
+        for contig_id, start in [(0, 100), (0, 200), (1, 300), (1, 400), (1, 500)]:
+            read = pysam.AlignedSegment(bam.header)
+            read.query_name = f"read{contig_id}_{start}"
+            read.reference_id = contig_id
+            read.reference_start = start
+            read.query_sequence = "A" * 10
+            read.query_qualities = pysam.qualitystring_to_array("I" * 10)
+            read.cigarstring = "10M"
+            read.mapping_quality = 60
+            read.set_tag("RG", "rg1")
+            bam.write(read)
+    pysam.index(path)
+
+
+def test_extract_mt_reads(tmp_path):
+    """
+    Only the MT reads are extracted, and a second run uses the cache.
+    """
+    bam_path = str(tmp_path / "sample1.bam")
+    make_bam(bam_path)
+    cache_dir = str(tmp_path / "cache")
+
+    extract = Extract(debug=False, files=[[bam_path]], cache_dir=cache_dir)
+    (cached_bam,) = extract.extracted_files
+
+    with pysam.AlignmentFile(cached_bam) as bam:
+        assert [read.reference_name for read in bam.fetch()] == ["MT"] * 3
+
+    summary = extract.summaries[cached_bam]
+    assert summary["mt_contig"] == ["MT", 16569]
+    assert summary["has_rg"]
+    assert summary["samples"] == ["sample1"]
+
+    mtime = os.stat(cached_bam).st_mtime_ns
+    extract = Extract(debug=False, files=[[bam_path]], cache_dir=cache_dir)
+    assert extract.extracted_files == [cached_bam]
+    assert os.stat(cached_bam).st_mtime_ns == mtime
+
+    # no temporary files are left in the cache
+    key = os.path.basename(cached_bam)[: -len(".mt.bam")]
+    assert sorted(os.listdir(cache_dir)) == [key + ".json", key + ".mt.bam", key + ".mt.bam.bai"]
+
+
+def test_remote_files_are_not_cached():
+    """
+    http / https inputs are read in place, since their URL does not change with
+    their contents.
+    """
+    assert Extract.is_remote("https://example.com/sample1.bam")
+    assert Extract.is_remote("HTTP://example.com/sample1.bam")
+    assert not Extract.is_remote("httpdata/sample1.bam")
@@ -0,0 +1,212 @@
+import gzip
+import os
+import pysam
+from mitylib.merge import Merge
+from mitylib.util import MityUtil
+
+GENOME = os.path.join(os.path.dirname(__file__), "..", "mitylib", "reference", "hs37d5.genome")
+
+HEADER = """##fileformat=VCFv4.2
+##contig=<ID=1,length=249250621>
+##contig=<ID=X,length=155270560>
+##contig=<ID=MT,length=16569>
+##INFO=<ID=DP,Number=1,Type=Integer,Description="{} depth">
+##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1
+"""
+
+
+def write_vcf(path, source, rows, header=HEADER):
+    """
+    Writes a bgzipped and indexed vcf with one sample.
+    """
+    with pysam.BGZFile(path, "wb") as vcf:
+        vcf.write(header.format(source).encode())
+        for contig, pos in rows:
+            line = f"{contig}\t{pos}\t.\tA\tG\t50\tPASS\tDP=10\tGT\t0/1\n"
+            vcf.write(line.encode())
+    pysam.tabix_index(path, preset="vcf", force=True)
+
+
+def test_merge_splices_mity_variants(tmp_path):
+    """
+    The mity variants are merged into the nuclear variants in genome order.
+    """
+    nuclear_vcf = str(tmp_path / "nuclear.vcf.gz")
+    mity_vcf = str(tmp_path / "sample.mity.vcf.gz")
+    write_vcf(nuclear_vcf, "Nuclear", [("1", 100), ("1", 200), ("X", 5), ("MT", 10)])
+    write_vcf(mity_vcf, "Mity", [("MT", 10), ("MT", 20)])
+
+    merge = Merge(
+        debug=False,
+        nuclear_vcf_path=nuclear_vcf,
+        mity_vcf_path=mity_vcf,
+        genome=GENOME,
+        output_dir=str(tmp_path),
+        prefix="sample",
+    )
+
+    with gzip.open(merge.merged_sorted_vcf_path, "rt") as vcf:
+        lines = vcf.read().splitlines()
+    rows = [tuple(line.split("\t")[:2]) for line in lines if not line.startswith("#")]
+    assert rows == [("1", "100"), ("1", "200"), ("X", "5"), ("MT", "10"), ("MT", "20")]
+    assert any(
+        "If CHR=MT OR CHR=chrM: Mity depth, otherwise: Nuclear depth" in line for line in lines
+    )
+    assert os.path.exists(merge.merged_sorted_vcf_path + ".tbi")
+
+
+def test_merge_bcf(tmp_path):
+    """
+    A mity bcf can be merged, and the merged variants written as a bcf.
+    """
+    nuclear_vcf = str(tmp_path / "nuclear.vcf.gz")
+    mity_vcf = str(tmp_path / "sample.mity.vcf.gz")
+    mity_bcf = str(tmp_path / "sample.mity.bcf")
+    write_vcf(nuclear_vcf, "Nuclear", [("1", 100), ("X", 5), ("MT", 10)])
+    write_vcf(mity_vcf, "Mity", [("MT", 10), ("MT", 20)])
+    MityUtil.convert_to_bcf(mity_vcf, mity_bcf)
+
+    merge = Merge(
+        debug=False,
+        nuclear_vcf_path=nuclear_vcf,
+        mity_vcf_path=mity_bcf,
+        genome=GENOME,
+        output_dir=str(tmp_path),
+        output_type="bcf",
+    )
+
+    assert merge.merged_sorted_vcf_path == str(tmp_path / "sample.mity.merge.bcf")
+    assert os.path.exists(merge.merged_sorted_vcf_path + ".csi")
+    with pysam.VariantFile(merge.merged_sorted_vcf_path) as vcf:
+        rows = [(variant.chrom, variant.pos) for variant in vcf]
+        description = vcf.header.info["DP"].description
+    assert rows == [("1", 100), ("X", 5), ("MT", 10), ("MT", 20)]
+    assert description == "If CHR=MT OR CHR=chrM: Mity depth, otherwise: Nuclear depth"
+
+
+def test_merge_drops_nuclear_mt_variants(tmp_path):
+    """
+    All the nuclear MT variants are replaced by the mity variants, which are
+    spliced in at the MT contig of the nuclear header, in one pass.
+    """
+    nuclear_vcf = str(tmp_path / "nuclear.vcf.gz")
+    mity_vcf = str(tmp_path / "sample.mity.vcf.gz")
+    write_vcf(nuclear_vcf, "Nuclear", [("1", 100), ("MT", 10), ("MT", 30)])
+    write_vcf(mity_vcf, "Mity", [("MT", 20)])
+
+    merge = Merge(
+        debug=False,
+        nuclear_vcf_path=nuclear_vcf,
+        mity_vcf_path=mity_vcf,
+        genome=GENOME,
+        output_dir=str(tmp_path),
+        prefix="sample",
+    )
+
+    lines = MityUtil.read_vcf_lines(merge.merged_sorted_vcf_path)
+    rows = [line.split("\t")[:2] for line in lines]
+    assert rows == [["1", "100"], ["MT", "20"]]
+    assert merge.num_dropped == 2
+    assert sorted(os.listdir(tmp_path)) == [
+        "nuclear.vcf.gz",
+        "nuclear.vcf.gz.tbi",
+        "sample.mity.merge.vcf.gz",
+        "sample.mity.merge.vcf.gz.tbi",
+        "sample.mity.vcf.gz",
+        "sample.mity.vcf.gz.tbi",
+    ]
+
+
+def test_merge_copies_nuclear_blocks(tmp_path):
+    """
+    With an indexed nuclear vcf, the whole BGZF blocks of the nuclear variants
+    are copied byte for byte, and the merged variants are the same as when
+    every nuclear variant is parsed.
+    """
+    nuclear_vcf = str(tmp_path / "nuclear.vcf.gz")
+    mity_vcf = str(tmp_path / "sample.mity.vcf.gz")
+    rows = [("1", pos) for pos in range(1, 20001)]
+    rows += [("X", 5), ("MT", 10), ("MT", 30), ("GL000207.1", 7)]
+    write_vcf(nuclear_vcf, "Nuclear", rows)
+    write_vcf(mity_vcf, "Mity", [("MT", 20)])
+
+    def merge(prefix):
+        merge = Merge(
+            debug=False,
+            nuclear_vcf_path=nuclear_vcf,
+            mity_vcf_path=mity_vcf,
+            genome=GENOME,
+            output_dir=str(tmp_path),
+            prefix=prefix,
+        )
+        assert merge.num_dropped == 2
+        return merge.merged_sorted_vcf_path
+
+    copied_vcf = merge("copied")
+    os.remove(nuclear_vcf + ".tbi")
+    streamed_vcf = merge("streamed")
+
+    assert list(MityUtil.read_vcf_lines(copied_vcf)) == list(MityUtil.read_vcf_lines(streamed_vcf))
+    assert os.path.exists(copied_vcf + ".tbi")
+
+    # the second block of the nuclear vcf only has variants on contig 1
+    with open(nuclear_vcf, "rb") as nuclear_file:
+        _, first_block_size = MityUtil.read_bgzf_block(nuclear_file, 0)
+        _, second_block_size = MityUtil.read_bgzf_block(nuclear_file, first_block_size)
+        nuclear_file.seek(first_block_size)
+        second_block = nuclear_file.read(second_block_size)
+    with open(copied_vcf, "rb") as copied_file:
+        assert second_block in copied_file.read()
+
+
+def test_merged_header(tmp_path):
+    """
+    The merged header is the nuclear header with merged descriptions, followed
+    by the mity header lines that are not in the nuclear header. It is the same
+    whether the nuclear blocks are copied or every variant is parsed.
+    """
+    nuclear_vcf = str(tmp_path / "nuclear.vcf.gz")
+    mity_vcf = str(tmp_path / "sample.mity.vcf.gz")
+    nuclear_header = HEADER.replace("VCFv4.2", "VCFv4.1").replace(
+        "##INFO", '##source=nuclear\n##INFO=<ID=AF,Number=A,Type=Float,Description="AF">\n##INFO'
+    )
+    mity_header = HEADER.replace(
+        "##FORMAT",
+        '##mityCommandline="mity call"\n'
+        '##FORMAT=<ID=VAF,Number=A,Type=Float,Description="Allele fraction">\n##FORMAT',
+    )
+    write_vcf(nuclear_vcf, "Nuclear", [("1", 100), ("MT", 10)], header=nuclear_header)
+    write_vcf(mity_vcf, "Mity", [("MT", 10)], header=mity_header)
+
+    def merge(prefix):
+        merge = Merge(
+            debug=False,
+            nuclear_vcf_path=nuclear_vcf,
+            mity_vcf_path=mity_vcf,
+            genome=GENOME,
+            output_dir=str(tmp_path),
+            prefix=prefix,
+        )
+        with gzip.open(merge.merged_sorted_vcf_path, "rt") as vcf:
+            return [line for line in vcf.read().splitlines() if line.startswith("#")]
+
+    expected = [
+        "##fileformat=VCFv4.2",
+        '##FILTER=<ID=PASS,Description="All filters passed">',
+        "##contig=<ID=1,length=249250621>",
+        "##contig=<ID=X,length=155270560>",
+        "##contig=<ID=MT,length=16569>",
+        "##source=nuclear",
+        '##INFO=<ID=AF,Number=A,Type=Float,Description="AF">',
+        "##INFO=<ID=DP,Number=1,Type=Integer,"
+        'Description="If CHR=MT OR CHR=chrM: Mity depth, otherwise: Nuclear depth">',
+        "##FORMAT=<ID=GT,Number=1,Type=String,"
+        'Description="If CHR=MT OR CHR=chrM: Genotype, otherwise: Genotype">',
+        '##mityCommandline="mity call"',
+        '##FORMAT=<ID=VAF,Number=A,Type=Float,Description="Allele fraction">',
+        "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1",
+    ]
+    assert merge("copied") == expected
+    os.remove(nuclear_vcf + ".tbi")
+    assert merge("streamed") == expected
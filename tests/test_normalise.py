@@ -0,0 +1,353 @@
+import gzip
+import os
+import numpy as np
+import pytest
+import pysam
+import pysam.bcftools
+import mitylib
+from mitylib.normalise import Normalise
+from mitylib.util import MityUtil, SortedVcfWriter
+
+REFERENCE = os.path.join(mitylib.__path__[0], "reference", "hs37d5.MT.fa")
+
+VCF = """##fileformat=VCFv4.2
+##contig=<ID=MT,length=16569>
+##INFO=<ID=DP,Number=1,Type=Integer,Description="Depth">
+##INFO=<ID=AO,Number=A,Type=Integer,Description="Alternate count">
+##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
+##FORMAT=<ID=AD,Number=R,Type=Integer,Description="Allele depths">
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\tS2
+MT\t302\t.\tA\tAC\t50\t.\tDP=5;AO=2\tGT:AD\t1/1:1,2\t0/0:5,0
+MT\t308\t.\tC\tCC\t50\t.\tDP=5;AO=2\tGT:AD\t0/1:3,2\t0/0:5,0
+MT\t309\t.\tCT\tC,CTT\t50\t.\tDP=6;AO=2,3\tGT:AD\t1/2:1,2,3\t0/1:4,2,0
+MT\t521\t.\tACA\tA,ACACA\t50\t.\tDP=6;AO=2,3\tGT:AD\t1/2:1,2,3\t0/1:4,2,0
+MT\t1000\t.\tTCC\tTGA\t50\t.\tDP=5;AO=2\tGT:AD\t1/1:1,2\t./.:.
+MT\t2000\t.\tCCG\tC,CCGT\t50\t.\tDP=6;AO=2,3\tGT:AD\t1/2:1,2,3\t0/2:3,0,3
+MT\t3000\t.\tAG\tGG,AA\t50\t.\tDP=6;AO=2,3\tGT:AD\t1/2:1,2,3\t0/0:6,0,0
+"""
+
+
+def missing_to_none(value):
+    if isinstance(value, tuple) and all(v is None for v in value):
+        return None
+    return value
+
+
+def records(variants):
+    """
+    Returns comparable records, where all missing values are None.
+    """
+    return [
+        (
+            variant.pos,
+            variant.alleles,
+            dict(variant.info),
+            [
+                {key: missing_to_none(value) for key, value in sample.items()}
+                for sample in variant.samples.values()
+            ],
+        )
+        for variant in variants
+    ]
+
+
+def test_split_multiallelic_matches_bcftools(tmp_path, normalise):
+    """
+    Splitting and trimming in python gives the same records as bcftools norm -m-both.
+    """
+    vcf_path = tmp_path / "input.vcf"
+    vcf_path.write_text(VCF)
+    bcftools_path = str(tmp_path / "bcftools.vcf")
+    pysam.bcftools.norm(
+        "-m-both",
+        "-f",
+        REFERENCE,
+        "-o",
+        bcftools_path,
+        str(vcf_path),
+        catch_stdout=False,
+    )
+
+    with pysam.VariantFile(str(vcf_path)) as vcf:
+        split = [
+            split_variant
+            for variant in vcf
+            for split_variant in normalise.split_multiallelic(variant)
+        ]
+        split = records(split)
+
+    with pysam.VariantFile(bcftools_path) as vcf:
+        expected = records(vcf)
+
+    assert split == expected
+
+
+def test_native_norm_matches_bcftools_on_annotations(tmp_path, normalise):
+    """
+    Native splitting and left alignment gives the same variants as bcftools
+    norm on the mity annotation vcfs that bcftools can normalise.
+    """
+    for name in ["mgrb_variants", "mitomap_confirmed_mutations", "mitomap_polymorphisms"]:
+        vcf_path = os.path.join(mitylib.__path__[0], "annot_mt", name + ".vcf.gz")
+        bcftools_path = str(tmp_path / (name + ".vcf"))
+        pysam.bcftools.norm(
+            "-m-both", "-f", REFERENCE, "-o", bcftools_path, vcf_path, catch_stdout=False
+        )
+
+        with pysam.VariantFile(vcf_path) as vcf:
+            native = [
+                (split_variant.pos, split_variant.alleles)
+                for variant in vcf
+                for split_variant in normalise.split_multiallelic(variant)
+            ]
+        with pysam.VariantFile(bcftools_path) as vcf:
+            expected = [(variant.pos, variant.alleles) for variant in vcf]
+
+        # bcftools sorts variants moved by left alignment
+        assert sorted(native) == sorted(expected)
+
+
+def test_native_norm_reference_mismatch(normalise):
+    with pytest.raises(ValueError):
+        normalise.normalise_alleles("MT", 302, "C", "CC")
+
+
+def test_trim_alleles():
+    assert Normalise.trim_alleles(1000, "TCC", "TGA") == (1001, "CC", "GA")
+    assert Normalise.trim_alleles(2000, "CCG", "CCGT") == (2002, "G", "GT")
+    assert Normalise.trim_alleles(302, "A", "AC") == (302, "A", "AC")
+
+
+def test_sorted_vcf_writer(tmp_path):
+    """
+    Records written slightly out of order are written sorted.
+    """
+    vcf_path = tmp_path / "input.vcf"
+    vcf_path.write_text(VCF)
+    output_path = str(tmp_path / "sorted.vcf.gz")
+
+    with pysam.VariantFile(str(vcf_path)) as vcf:
+        variants = list(vcf)
+        writer = SortedVcfWriter(output_path, vcf.header)
+        for variant in reversed(variants):
+            writer.write(variant)
+        writer.close()
+
+    with pysam.VariantFile(output_path) as vcf:
+        assert [variant.pos for variant in vcf] == [302, 308, 309, 521, 1000, 2000, 3000]
+
+
+def test_sample_values_match_scalar(normalise):
+    """
+    The numpy q, VAF, AQA, AQR and tier values are identical to the scalar
+    calculation, including homoplasmic variants and the 3220 cap.
+    """
+    rng = np.random.default_rng(1)
+    AO = rng.integers(0, 3000, 2000)
+    RO = rng.integers(0, 3000, 2000)
+    AO[:10] = 0
+    RO[10:20] = 0
+    AO[20:30] = [1, 2, 5, 30, 130, 500, 1000, 2000, 5000, 20000]
+    RO[20:30] = 0
+    DP = AO + RO
+    QA = AO * rng.integers(10, 40, 2000)
+    QR = RO * rng.integers(10, 40, 2000)
+
+    values = Normalise.sample_values(RO=RO, QR=QR, AO=AO, QA=QA, DP=DP, p=0.002)
+
+    for i in range(len(AO)):
+        q = normalise.mity_qual(AO[i], DP[i], normalise.p)
+        AQR = float(QR[i]) / float(RO[i]) if RO[i] > 0 else 0
+        VAF = round(float(AO[i]) / float(DP[i]), 4) if DP[i] != 0 else 0
+        AQA = float(round(QA[i] / AO[i], 3)) if AO[i] > 0 else float(0)
+        if VAF >= 0.01:
+            tier = 1
+        elif AO[i] > 10:
+            tier = 2
+        else:
+            tier = 3
+
+        assert values["q"][i] == q
+        assert values["AQR"][i] == AQR
+        assert values["VAF"][i] == VAF
+        assert values["AQA"][i] == AQA
+        assert values["tier"][i] == tier
+
+    assert 3220.0 in values["q"]
+
+
+def test_blacklist_overlaps(tmp_path, normalise):
+    """
+    Variants are blacklisted if any reference position overlaps a region of
+    the blacklist bed file.
+    """
+    assert normalise.blacklist_regions == [(302, 318), (3105, 3108)]
+    assert len(normalise.blacklist_counts) == 16569 + 2
+
+    # (contig, first position, last position, blacklisted)
+    variants = [
+        ("MT", 301, 301, False),
+        ("MT", 302, 302, True),
+        ("MT", 318, 318, True),
+        ("MT", 319, 319, False),
+        ("MT", 299, 302, True),
+        ("MT", 296, 298, False),
+        ("MT", 3108, 3108, True),
+        ("MT", 16569, 16570, False),
+        ("1", 302, 302, False),
+    ]
+    contigs, starts, ends, expected = zip(*variants)
+    assert normalise.in_blacklist(contigs, starts, ends).tolist() == list(expected)
+
+    bed_path = str(tmp_path / "blacklist.bed")
+    with open(bed_path, "w") as f:
+        f.write("chrM\t9\t10\n1\t0\t100\n")
+    normalise.blacklist = bed_path
+    normalise.load_blacklist()
+    assert normalise.blacklist_regions == [(10, 10)]
+    assert normalise.in_blacklist("MT", 8, 10)
+    assert not normalise.in_blacklist("MT", 302, 302)
+
+
+def read_text(vcf_path):
+    with gzip.open(vcf_path, "rt") as f:
+        return f.read()
+
+
+def test_columnar_engine_matches_record_engine(tmp_path, make_freebayes_vcf, run_normalise):
+    """
+    The columnar engine writes exactly the same vcf as the record engine, for
+    more variants than fit in one block.
+    """
+    vcf_path = str(tmp_path / "input.vcf")
+    make_freebayes_vcf(vcf_path, num_samples=30, num_variants=300)
+
+    for allsamples in (False, True):
+        record = run_normalise(vcf_path, "record", "record", allsamples)
+        columnar = run_normalise(vcf_path, "columnar", "columnar", allsamples)
+        columnar = read_text(columnar.normalised_vcf_path)
+        assert "PASS" in columnar and "FAIL" in columnar
+        assert columnar == read_text(record.normalised_vcf_path)
+
+
+def test_threads_match_single_process(tmp_path, make_freebayes_vcf, run_normalise):
+    """
+    Filtering chunks of samples in worker processes gives the same vcf as one
+    process, including the PASS / FAIL decision across chunks.
+    """
+    vcf_path = str(tmp_path / "input.vcf")
+    make_freebayes_vcf(vcf_path, num_samples=30, num_variants=300)
+
+    for allsamples in (False, True):
+        record = run_normalise(vcf_path, "record", "record", allsamples)
+        for threads in (2, 7):
+            threaded = run_normalise(vcf_path, "threaded", "record", allsamples, threads)
+            assert read_text(threaded.normalised_vcf_path) == read_text(record.normalised_vcf_path)
+
+
+def test_raw_format_matches_pysam(tmp_path, make_freebayes_vcf, run_normalise):
+    """
+    Writing the new FORMAT values as text gives the same vcf as setting them
+    through pysam, and pysam reads back the same values.
+    """
+    vcf_path = str(tmp_path / "input.vcf")
+    make_freebayes_vcf(vcf_path, num_samples=30, num_variants=300)
+
+    for allsamples in (False, True):
+        record_path = run_normalise(vcf_path, "record", "record", allsamples).normalised_vcf_path
+        raw_path = run_normalise(
+            vcf_path, "raw", "record", allsamples, raw_format=True
+        ).normalised_vcf_path
+        assert read_text(raw_path) == read_text(record_path)
+
+        with pysam.VariantFile(record_path) as vcf:
+            expected = records(vcf)
+        with pysam.VariantFile(raw_path) as vcf:
+            assert records(vcf) == expected
+
+
+def test_bcf_output_matches_vcf(tmp_path, make_freebayes_vcf, run_normalise):
+    """
+    Reading a bcf and writing a bcf gives the same records as vcf text, and
+    the bcf gets a CSI index.
+    """
+    vcf_path = str(tmp_path / "input.vcf")
+    make_freebayes_vcf(vcf_path, num_samples=30, num_variants=100)
+    bcf_path = str(tmp_path / "input.bcf")
+    MityUtil.convert_to_bcf(vcf_path, bcf_path)
+
+    vcf_output = run_normalise(vcf_path, "output").normalised_vcf_path
+    for engine in ("record", "columnar"):
+        input_path = bcf_path if engine == "record" else vcf_path
+        bcf_output = run_normalise(
+            input_path, engine, engine, output_type="bcf"
+        ).normalised_vcf_path
+        assert bcf_output.endswith(".bcf")
+        assert os.path.exists(bcf_output + ".csi")
+
+        with pysam.VariantFile(vcf_output) as vcf:
+            expected = records(vcf)
+        with pysam.VariantFile(bcf_output) as vcf:
+            assert records(vcf) == expected
+
+
+def test_stream_matches_bcftools_norm(tmp_path, make_freebayes_vcf):
+    """
+    Normalising a stream gives the same variants as normalising the vcf with
+    bcftools norm -f, including indels that bcftools norm left aligns and
+    multiallelic variants that it splits.
+    """
+    vcf_path = str(tmp_path / "input.vcf")
+    make_freebayes_vcf(vcf_path, num_samples=3, num_variants=20)
+    with open(vcf_path) as f:
+        lines = f.read().splitlines()
+    header = [line for line in lines if line.startswith("#")]
+    variants = [line.split("\t") for line in lines if not line.startswith("#")]
+
+    # indels in the C tract at 303-315 and the CA repeat at 514-523 of hs37d5
+    indels = [
+        (308, "C", "CC"),
+        (309, "CT", "C,CTT"),
+        (521, "ACA", "A,ACACA"),
+        (2000, "CCG", "C"),
+    ]
+    for pos, ref, alt in indels:
+        num_alts = len(alt.split(","))
+        fields = list(variants[-1])
+        fields[1:5] = [str(pos), ".", ref, alt]
+        fields[7] = "SRF=10;SRR=12;SAF={0};SAR={0};MQMR=60".format(",".join(["5"] * num_alts))
+        fields[9:] = [
+            "0/1:30:20:600:{}:{}".format(",".join(["5"] * num_alts), ",".join(["150"] * num_alts))
+        ] * 3
+        variants.append(fields)
+    variants.sort(key=lambda fields: int(fields[1]))
+    with open(vcf_path, "w") as f:
+        f.write("\n".join(header + ["\t".join(fields) for fields in variants]) + "\n")
+
+    bcftools = Normalise(
+        debug=False,
+        vcf=vcf_path,
+        reference_fasta=REFERENCE,
+        genome=None,
+        output_dir=str(tmp_path),
+        prefix="bcftools",
+    )
+    with pysam.VariantFile(vcf_path) as stream:
+        streamed = Normalise(
+            debug=False,
+            vcf=vcf_path,
+            reference_fasta=REFERENCE,
+            genome=None,
+            output_dir=str(tmp_path),
+            prefix="stream",
+            stream=stream,
+        )
+
+    with pysam.VariantFile(bcftools.normalised_vcf_path) as vcf:
+        expected = records(vcf)
+    with pysam.VariantFile(streamed.normalised_vcf_path) as vcf:
+        normalised = records(vcf)
+
+    # the insertion at 308 is left aligned to 302
+    assert (302, ("A", "AC")) in [(pos, alleles) for pos, alleles, _, _ in expected]
+    assert normalised == expected
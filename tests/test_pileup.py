@@ -0,0 +1,166 @@
+import os
+import pysam
+import pytest
+import mitylib
+from mitylib.pileup import Pileup, PileupCaller
+
+REFERENCE = os.path.join(mitylib.__path__[0], "reference", "hs37d5.MT.fa")
+
+
+def make_bam(path, sample, alt_reads, ref_reads, snv_pos=1000, unqualified_reads=0):
+    """
+    Writes a BAM of 50 bp MT reads covering snv_pos, where alt_reads of the reads
+    carry an alternate base at snv_pos (1-based). Every other read is reversed.
+    The last unqualified_reads reads are stored without base qualities.
+    """
+    with pysam.FastaFile(REFERENCE) as fasta:
+        sequence = fasta.fetch("MT", snv_pos - 26, snv_pos + 24)
+    ref_base = sequence[25]
+    alt_base = "G" if ref_base != "G" else "T"
+    alt_sequence = sequence[:25] + alt_base + sequence[26:]
+
+    header = {
+        "HD": {"VN": "1.6", "SO": "coordinate"},
+        "SQ": [{"SN": "MT", "LN": 16569}],
+        "RG": [{"ID": "rg1", "SM": sample}],
+    }
+    with pysam.AlignmentFile(path, "wb", header=header) as bam:
+        num_reads = alt_reads + ref_reads
+        for i in range(num_reads):
+            read = pysam.AlignedSegment(bam.header)
+            read.query_name = f"read{i}"
+            read.reference_id = 0
+            read.reference_start = snv_pos - 26
+            read.query_sequence = alt_sequence if i < alt_reads else sequence
+            if i < num_reads - unqualified_reads:
+                read.query_qualities = pysam.qualitystring_to_array("I" * 50)
+            read.cigarstring = "50M"
+            read.mapping_quality = 60
+            read.is_reverse = i % 2 == 1
+            read.set_tag("RG", "rg1")
+            bam.write(read)
+    pysam.index(path)
+
+    return ref_base, alt_base
+
+
+def test_pileup_caller_counts(tmp_path):
+    """
+    The pileup caller reports the FreeBayes fields used by mity normalise.
+    """
+    bam1 = str(tmp_path / "s1.bam")
+    bam2 = str(tmp_path / "s2.bam")
+    ref_base, alt_base = make_bam(bam1, "s1", alt_reads=10, ref_reads=30)
+    make_bam(bam2, "s2", alt_reads=0, ref_reads=20)
+
+    output_path = str(tmp_path / "pileup.vcf.gz")
+    PileupCaller(
+        files=[bam1, bam2],
+        reference=REFERENCE,
+        contig="MT",
+        contig_length=16569,
+        start=1,
+        end=16569,
+        min_mq=30,
+        min_bq=24,
+        min_af=0.01,
+        min_ac=4,
+    ).call(output_path)
+
+    with pysam.VariantFile(output_path) as vcf:
+        (variant,) = list(vcf)
+
+    assert (variant.pos, variant.ref, variant.alts) == (1000, ref_base, (alt_base,))
+    assert variant.info["DP"] == 60
+    assert variant.info["RO"] == 50
+    assert variant.info["AO"] == (10,)
+    assert variant.info["SRF"] + variant.info["SRR"] == 50
+    assert variant.info["SAF"] == (5,)
+    assert variant.info["SAR"] == (5,)
+    assert variant.info["MQMR"] == 60.0
+
+    s1 = variant.samples["s1"]
+    assert (s1["DP"], s1["RO"], s1["AO"], s1["QR"], s1["QA"]) == (40, 30, (10,), 1200, (400,))
+    assert s1["GT"] == (0, 1)
+    assert variant.samples["s2"]["GT"] == (0, 0)
+
+
+def test_call_from_pileup_histogram(tmp_path):
+    """
+    Calling from the histogram of mity pileup gives the same vcf as calling
+    from the BAM, at any quality cutoff that is a bin edge.
+    """
+    bam = str(tmp_path / "s1.bam")
+    make_bam(bam, "s1", alt_reads=10, ref_reads=30)
+    (histogram,) = Pileup(
+        debug=False, files=[[bam]], reference=REFERENCE, output_dir=str(tmp_path)
+    ).pileup_paths
+    assert histogram == str(tmp_path / "s1.pileup.npz")
+
+    def call(files, min_mq, min_bq, output_path):
+        PileupCaller(
+            files=files,
+            reference=REFERENCE,
+            contig="MT",
+            contig_length=16569,
+            start=1,
+            end=16569,
+            min_mq=min_mq,
+            min_bq=min_bq,
+            min_af=0.01,
+            min_ac=4,
+        ).call(output_path)
+        with pysam.VariantFile(output_path) as vcf:
+            return [str(variant) for variant in vcf]
+
+    for min_mq, min_bq in [(30, 24), (60, 40), (0, 0)]:
+        expected = call([bam], min_mq, min_bq, str(tmp_path / "bam.vcf.gz"))
+        assert len(expected) == 1
+        assert call([histogram], min_mq, min_bq, str(tmp_path / "npz.vcf.gz")) == expected
+
+    # the reads have base quality 40, so none pass a cutoff of 41
+    (histogram_41,) = Pileup(
+        debug=False,
+        files=[[bam]],
+        reference=REFERENCE,
+        output_dir=str(tmp_path / "bins"),
+        bq_bins=[0, 30, 41],
+    ).pileup_paths
+    assert call([histogram_41], 30, 41, str(tmp_path / "npz.vcf.gz")) == []
+    with pytest.raises(ValueError, match="base quality 25"):
+        call([histogram], 30, 25, str(tmp_path / "npz.vcf.gz"))
+
+
+def test_reads_without_base_qualities(tmp_path):
+    """
+    Reads stored without base qualities are counted with base quality 0.
+    """
+    bam = str(tmp_path / "s1.bam")
+    make_bam(bam, "s1", alt_reads=10, ref_reads=30, unqualified_reads=5)
+
+    def call(files, min_bq):
+        output_path = str(tmp_path / "pileup.vcf.gz")
+        PileupCaller(
+            files=files,
+            reference=REFERENCE,
+            contig="MT",
+            contig_length=16569,
+            start=1,
+            end=16569,
+            min_mq=30,
+            min_bq=min_bq,
+            min_af=0.01,
+            min_ac=4,
+        ).call(output_path)
+        with pysam.VariantFile(output_path) as vcf:
+            (variant,) = list(vcf)
+        return variant
+
+    assert call([bam], 0).info["DP"] == 40
+    assert call([bam], 24).info["DP"] == 35
+
+    (histogram,) = Pileup(
+        debug=False, files=[[bam]], reference=REFERENCE, output_dir=str(tmp_path)
+    ).pileup_paths
+    assert call([histogram], 0).info["DP"] == 40
+    assert call([histogram], 24).info["DP"] == 35
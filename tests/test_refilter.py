@@ -0,0 +1,46 @@
+import os
+import shutil
+from mitylib.refilter import Refilter
+
+
+def test_refilter_matches_normalise(tmp_path, make_freebayes_vcf, run_normalise, variant_lines):
+    """
+    Refiltering with the default thresholds gives the same variants as mity
+    normalise, and new thresholds give the same variants as normalising with
+    those thresholds.
+    """
+    vcf_path = str(tmp_path / "input.vcf")
+    make_freebayes_vcf(vcf_path, num_samples=30, num_variants=300)
+    normalised_path = run_normalise(vcf_path, "sample").normalised_vcf_path
+    assert normalised_path == str(tmp_path / "sample.normalise.vcf.gz")
+
+    refilter = Refilter(debug=False, vcfs=[normalised_path], output_dir=str(tmp_path))
+    (refiltered_path,) = refilter.refiltered_vcf_paths
+    assert refiltered_path == str(tmp_path / "sample.refilter.vcf.gz")
+    assert os.path.exists(refiltered_path + ".tbi")
+    assert variant_lines(refiltered_path) == variant_lines(normalised_path)
+
+    thresholds = {"MIN_DP": 50, "SB_RANGE_LO": 0.2, "MIN_MQMR": 25, "MIN_AQR": 22}
+    expected_path = run_normalise(
+        vcf_path, "expected", allsamples=True, thresholds=thresholds
+    ).normalised_vcf_path
+
+    other_path = str(tmp_path / "other.normalise.vcf.gz")
+    shutil.copy(normalised_path, other_path)
+    refilter_dir = tmp_path / "refilter"
+    refilter_dir.mkdir()
+    refilter = Refilter(
+        debug=False,
+        vcfs=[refiltered_path, other_path],
+        output_dir=str(refilter_dir),
+        allsamples=True,
+        min_dp=50,
+        sb_range_lo=0.2,
+        min_mqmr=25,
+        min_aqr=22,
+        threads=2,
+    )
+    expected = variant_lines(expected_path)
+    assert expected != variant_lines(normalised_path)
+    for path in refilter.refiltered_vcf_paths:
+        assert variant_lines(path) == expected
@@ -0,0 +1,67 @@
+import pytest
+from mitylib.refilter import Refilter
+from mitylib.sweep import Sweep
+
+
+def test_sweep_matches_refilter(tmp_path, make_freebayes_vcf, run_normalise, variant_lines):
+    """
+    Each grid point gives the same variants as refiltering with its thresholds,
+    after dropping the variants that would not be called.
+    """
+    vcf_path = str(tmp_path / "input.vcf")
+    make_freebayes_vcf(vcf_path, num_samples=30, num_variants=300)
+    normalised_path = run_normalise(vcf_path, "sample").normalised_vcf_path
+
+    grid_path = tmp_path / "grid.yaml"
+    grid_path.write_text("min_alternate_count: [0, 195]\nmin_dp: [15, 50]\nmin_vaf: 0.5\n")
+    sweep = Sweep(
+        debug=False,
+        grid=str(grid_path),
+        vcf=normalised_path,
+        output_dir=str(tmp_path),
+        write_vcfs=True,
+    )
+
+    with open(sweep.summary_path) as f:
+        header, *rows = [line.rstrip("\n").split("\t") for line in f]
+    rows = [dict(zip(header, row)) for row in rows]
+    assert len(rows) == 4
+
+    for i, row in enumerate(rows):
+        refilter_dir = tmp_path / f"refilter{i}"
+        refilter_dir.mkdir()
+        refilter = Refilter(
+            debug=False,
+            vcfs=[normalised_path],
+            output_dir=str(refilter_dir),
+            min_dp=int(row["min_dp"]),
+        )
+        expected = variant_lines(refilter.refiltered_vcf_paths[0])
+        if row["min_alternate_count"] != "0":
+            # keep the variants with a sample with at least 195 alternate reads
+            expected = [
+                line
+                for line in expected
+                if any(
+                    int(sample.split(":")[4]) >= 195 for sample in line.rstrip("\n").split("\t")[9:]
+                )
+            ]
+            assert 0 < len(expected) < 300
+
+        lines = variant_lines(str(tmp_path / f"sample.sweep.{i}.vcf.gz"))
+        assert lines == expected
+        assert int(row["variants"]) == len(expected)
+        assert int(row["pass"]) == sum("\tPASS\t" in line for line in expected)
+        assert int(row["pass"]) + int(row["fail"]) == len(expected)
+        assert int(row["report_rows"]) == sum(
+            float(sample.split(":")[7]) > 0.5
+            for line in expected
+            for sample in line.rstrip("\n").split("\t")[9:]
+        )
+
+
+def test_sweep_unknown_parameter(tmp_path):
+    grid_path = tmp_path / "grid.yaml"
+    grid_path.write_text("min_depth: [10, 20]\n")
+    with pytest.raises(ValueError):
+        Sweep.read_grid(str(grid_path))
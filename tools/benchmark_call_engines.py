@@ -0,0 +1,88 @@
+"""
+Compares the FreeBayes and pileup engines of mity call on the same BAM / CRAM
+files. Reports the run time of each engine and the concordance of the called
+SNVs, overall and per sample.
+
+Usage: python benchmark_call_engines.py output_dir reference.fa file.bam [file.bam ...]
+"""
+
+import os
+import sys
+import time
+import pysam
+from mitylib.call import Call
+
+
+def run_engine(engine, files, reference, output_dir):
+    """
+    Runs mity call without normalisation and returns the run time and output path.
+    """
+    engine_dir = os.path.join(output_dir, engine)
+    os.makedirs(engine_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    call = Call(
+        debug=False,
+        files=[files],
+        reference=reference,
+        prefix="benchmark",
+        normalise=False,
+        output_dir=engine_dir,
+        engine=engine,
+    )
+    return time.perf_counter() - start, call.call_vcf_path
+
+
+def get_snvs(vcf_path):
+    """
+    Returns the set of (pos, ref, alt) SNVs in a vcf, and the alternate
+    allele fraction of each SNV per sample.
+    """
+    snvs = set()
+    fractions = {}
+    with pysam.VariantFile(vcf_path) as vcf:
+        for variant in vcf:
+            for i, alt in enumerate(variant.alts):
+                if len(variant.ref) != 1 or len(alt) != 1:
+                    continue
+                snv = (variant.pos, variant.ref, alt)
+                snvs.add(snv)
+                for sample in variant.samples.values():
+                    depth = sample["DP"] or 0
+                    alt_count = (sample["AO"] or (0,) * len(variant.alts))[i] or 0
+                    fractions[(sample.name, snv)] = alt_count / depth if depth else 0.0
+    return snvs, fractions
+
+
+def main(output_dir, reference, files):
+    freebayes_time, freebayes_vcf = run_engine("freebayes", files, reference, output_dir)
+    pileup_time, pileup_vcf = run_engine("pileup", files, reference, output_dir)
+
+    freebayes_snvs, freebayes_fractions = get_snvs(freebayes_vcf)
+    pileup_snvs, pileup_fractions = get_snvs(pileup_vcf)
+    shared = freebayes_snvs & pileup_snvs
+
+    print(f"freebayes: {freebayes_time:.1f}s, {len(freebayes_snvs)} SNVs")
+    print(f"pileup:    {pileup_time:.1f}s, {len(pileup_snvs)} SNVs")
+    print(f"speedup:   {freebayes_time / pileup_time:.1f}x")
+    print(f"shared SNVs:         {len(shared)}")
+    print(f"only in freebayes:   {len(freebayes_snvs - pileup_snvs)}")
+    print(f"only in pileup:      {len(pileup_snvs - freebayes_snvs)}")
+
+    shared_keys = set(freebayes_fractions) & set(pileup_fractions)
+    if shared_keys:
+        max_difference = max(
+            abs(freebayes_fractions[key] - pileup_fractions[key]) for key in shared_keys
+        )
+        print(f"max per-sample allele fraction difference: {max_difference:.4f}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4:
+        print(
+            "Usage: python benchmark_call_engines.py output_dir reference.fa "
+            "file.bam [file.bam ...]"
+        )
+        sys.exit(1)
+
+    main(sys.argv[1], sys.argv[2], sys.argv[3:])
@@ -0,0 +1,141 @@
+"""
+Compares the record and columnar engines of mity normalise, and the record
+engine with --raw-format, on a synthetic cohort VCF with random FreeBayes
+values. Reports the run time of each engine, and checks that they write the
+same normalised VCF.
+
+Usage: python benchmark_normalise_engines.py output_dir [num_samples] [num_variants]
+"""
+
+import gzip
+import os
+import sys
+import time
+import numpy as np
+import pysam
+import mitylib
+from mitylib.normalise import Normalise
+from mitylib.util import MityUtil
+
+REFERENCE = os.path.join(mitylib.__path__[0], "reference", "hs37d5.MT.fa")
+
+
+def make_vcf(path, num_samples, num_variants, seed=0):
+    """
+    Writes a bgzipped vcf of SNVs at random MT positions, with random values for
+    the FreeBayes fields used by mity normalise.
+    """
+    rng = np.random.default_rng(seed)
+    with pysam.FastaFile(REFERENCE) as fasta:
+        sequence = fasta.fetch("MT")
+
+    header = ["##fileformat=VCFv4.2", "##contig=<ID=MT,length=16569>"]
+    for key, number in [("SRF", "1"), ("SRR", "1"), ("SAF", "A"), ("SAR", "A")]:
+        header.append(f'##INFO=<ID={key},Number={number},Type=Integer,Description="{key}">')
+    header.append('##INFO=<ID=MQMR,Number=1,Type=Float,Description="MQMR">')
+    header.append('##FORMAT=<ID=GT,Number=1,Type=String,Description="GT">')
+    for key, number in [("DP", "1"), ("RO", "1"), ("QR", "1"), ("AO", "A"), ("QA", "A")]:
+        header.append(f'##FORMAT=<ID={key},Number={number},Type=Integer,Description="{key}">')
+    samples = [f"S{i}" for i in range(num_samples)]
+    header.append(
+        "\t".join(
+            ["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT"] + samples
+        )
+    )
+
+    with pysam.BGZFile(path, "w") as vcf:
+        vcf.write(("\n".join(header) + "\n").encode())
+        positions = sorted(rng.choice(np.arange(1, len(sequence) + 1), num_variants, replace=False))
+        for pos in positions:
+            ref = sequence[pos - 1]
+            alt = "G" if ref != "G" else "T"
+            SRF, SRR, SAF, SAR = rng.integers(1, 1000, 4)
+            AO = rng.integers(0, 200, num_samples)
+            RO = rng.integers(0, 2000, num_samples)
+            QA = AO * rng.integers(10, 40, num_samples)
+            QR = RO * rng.integers(10, 40, num_samples)
+            DP = AO + RO
+            sample_columns = np.char.add(
+                "0/1:",
+                np.char.add(
+                    np.char.add(np.char.add(DP.astype(str), ":"), np.char.add(RO.astype(str), ":")),
+                    np.char.add(
+                        np.char.add(
+                            np.char.add(QR.astype(str), ":"), np.char.add(AO.astype(str), ":")
+                        ),
+                        QA.astype(str),
+                    ),
+                ),
+            )
+            fields = [
+                "MT",
+                str(pos),
+                ".",
+                ref,
+                alt,
+                "50",
+                ".",
+                f"SRF={SRF};SRR={SRR};SAF={SAF};SAR={SAR};MQMR=60",
+                "GT:DP:RO:QR:AO:QA",
+            ]
+            vcf.write(("\t".join(fields + sample_columns.tolist()) + "\n").encode())
+    pysam.tabix_index(path, preset="vcf", force=True)
+
+
+def run_engine(engine, vcf_path, output_dir, raw_format=False):
+    """
+    Runs mity normalise and returns the run time and the normalised vcf path.
+    """
+    engine_dir = os.path.join(output_dir, engine + (".raw" if raw_format else ""))
+    os.makedirs(engine_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    normalise = Normalise(
+        debug=False,
+        vcf=vcf_path,
+        reference_fasta=REFERENCE,
+        genome=MityUtil.select_reference_genome("hs37d5", None),
+        output_dir=engine_dir,
+        prefix="benchmark",
+        engine=engine,
+        raw_format=raw_format,
+    )
+    return time.perf_counter() - start, normalise.normalised_vcf_path
+
+
+def main(output_dir, num_samples, num_variants):
+    os.makedirs(output_dir, exist_ok=True)
+    vcf_path = os.path.join(output_dir, f"synthetic.{num_samples}.vcf.gz")
+    make_vcf(vcf_path, num_samples, num_variants)
+
+    results = {}
+    for engine in Normalise.ENGINES:
+        results[engine] = run_engine(engine, vcf_path, output_dir)
+    results["raw"] = run_engine("record", vcf_path, output_dir, raw_format=True)
+
+    cells = num_samples * num_variants
+    for engine, (seconds, _) in results.items():
+        print(f"{engine:9s} {seconds:.1f}s, {cells / seconds:,.0f} sample-variants/s")
+    print(f"columnar speedup:   {results['record'][0] / results['columnar'][0]:.1f}x")
+    print(f"raw format speedup: {results['record'][0] / results['raw'][0]:.1f}x")
+
+    # the ##bcftools_normCommand lines differ, so only the variants are compared
+    outputs = []
+    for _, normalised_vcf_path in results.values():
+        with gzip.open(normalised_vcf_path, "rt") as f:
+            outputs.append([line for line in f if not line.startswith("##")])
+    print("identical output:", all(output == outputs[0] for output in outputs))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(
+            "Usage: python benchmark_normalise_engines.py output_dir [num_samples] [num_variants]"
+        )
+        sys.exit(1)
+
+    main(
+        sys.argv[1],
+        int(sys.argv[2]) if len(sys.argv) > 2 else 10000,
+        int(sys.argv[3]) if len(sys.argv) > 3 else 200,
+    )